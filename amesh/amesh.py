@@ -3,26 +3,54 @@ import os
 import sys
 import time
 import uuid
-import subprocess
+import queue
 import threading
 import ipaddress
 
 import etcd3
 
 if not "amesh." in __name__:
-    from node import Node
+    from node import Node, NodeTable
     from fib import Fib
     from devtracker import DevTracker
-    from static import (IPCMD, WGCMD,
+    from dataplane import create_dataplane
+    from nexthop import NexthopTable
+    from reconciler import Reconciler
+    from liveness import LivenessMonitor
+    from engine import AsyncioEngine
+    from metrics import Metrics, MetricsServer
+    from static import (DATAPLANE, DATAPLANE_WORKERS, ENGINE,
+                        ADDRESS_DEBOUNCE,
+                        NEXTHOP_GROUPS, NEXTHOP_ID_BASE,
+                        RECONCILE_INTERVAL, RECONCILE_BACKOFF,
+                        FAILOVER_TIMEOUT, FAILOVER_CHECKS,
+                        ETCD_RECORD_FORMAT,
+                        ETCD_GROUP_SHARDING,
                         ETCD_LEASE_LIFETIME,
-                        ETCD_LEASE_KEEPALIVE)
+                        ETCD_LEASE_KEEPALIVE,
+                        ETCD_WATCH_COALESCE_WINDOW,
+                        ETCD_WATCH_COALESCE_MAX_BATCH)
 else:
-    from amesh.node import Node
+    from amesh.node import Node, NodeTable
     from amesh.fib import Fib
     from amesh.devtracker import DevTracker
-    from amesh.static import (IPCMD, WGCMD,
+    from amesh.dataplane import create_dataplane
+    from amesh.nexthop import NexthopTable
+    from amesh.reconciler import Reconciler
+    from amesh.liveness import LivenessMonitor
+    from amesh.engine import AsyncioEngine
+    from amesh.metrics import Metrics, MetricsServer
+    from amesh.static import (DATAPLANE, DATAPLANE_WORKERS, ENGINE,
+                              ADDRESS_DEBOUNCE,
+                              NEXTHOP_GROUPS, NEXTHOP_ID_BASE,
+                              RECONCILE_INTERVAL, RECONCILE_BACKOFF,
+                              FAILOVER_TIMEOUT, FAILOVER_CHECKS,
+                              ETCD_RECORD_FORMAT,
+                              ETCD_GROUP_SHARDING,
                               ETCD_LEASE_LIFETIME,
-                              ETCD_LEASE_KEEPALIVE)
+                              ETCD_LEASE_KEEPALIVE,
+                              ETCD_WATCH_COALESCE_WINDOW,
+                              ETCD_WATCH_COALESCE_MAX_BATCH)
 
 
 from logging import getLogger, INFO, StreamHandler
@@ -44,7 +72,7 @@ class Amesh(object):
         self.logger.info("Load config and initialize amesh")
 
         # node_table: hash of nodes, key is etcd id, value is Node
-        self.node_table = {}
+        self.node_table = NodeTable()
 
         # self node parameteres
         self.node = Node()
@@ -63,6 +91,23 @@ class Amesh(object):
             self.etcd_password = cnf["etcd"]["etcd_password"]
         else:
             self.etcd_password = None
+
+        # format of self node entry: "keys" or "record"
+        if "etcd_record_format" in cnf["etcd"]:
+            self.etcd_record_format = cnf["etcd"]["etcd_record_format"].strip()
+        else:
+            self.etcd_record_format = ETCD_RECORD_FORMAT
+        if not self.etcd_record_format in ("keys", "record"):
+            raise RuntimeError("invalid etcd_record_format '{}'"
+                               .format(self.etcd_record_format))
+
+        # publish and watch nodes under the prefixes of their groups
+        if "etcd_group_sharding" in cnf["etcd"]:
+            self.etcd_group_sharding = (cnf["etcd"]["etcd_group_sharding"]
+                                        .strip().lower()
+                                        in ("yes", "true", "1"))
+        else:
+            self.etcd_group_sharding = ETCD_GROUP_SHARDING
             
         # node id
         self.node_id = cnf["amesh"]["node_id"]
@@ -83,6 +128,13 @@ class Amesh(object):
         else:
             self.wg_dev = None
 
+        # wg device shared by outbound connections to servers. if not
+        # configured, each server has a dedicated wg device.
+        if "shared_device" in cnf["wireguard"]:
+            self.wg_shared_dev = cnf["wireguard"]["shared_device"]
+        else:
+            self.wg_shared_dev = None
+
         # wg endpoint for incomming connections (server only)
         if "endpoint" in cnf["wireguard"]:
             self.node.update("endpoint", cnf["wireguard"]["endpoint"])
@@ -107,6 +159,41 @@ class Amesh(object):
         else:
             self.tracked_devices = set()
 
+        # debounce of address changes on tracked devices in msec
+        if "address_debounce" in cnf["amesh"]:
+            self.address_debounce = \
+                int(cnf["amesh"]["address_debounce"]) / 1000
+        else:
+            self.address_debounce = ADDRESS_DEBOUNCE / 1000
+
+        # coalescing etcd watch events: window in msec and max batch size
+        if "watch_coalesce_window" in cnf["amesh"]:
+            self.watch_coalesce_window = \
+                int(cnf["amesh"]["watch_coalesce_window"]) / 1000
+        else:
+            self.watch_coalesce_window = ETCD_WATCH_COALESCE_WINDOW / 1000
+
+        if "watch_coalesce_max_batch" in cnf["amesh"]:
+            self.watch_coalesce_max_batch = \
+                int(cnf["amesh"]["watch_coalesce_max_batch"])
+        else:
+            self.watch_coalesce_max_batch = ETCD_WATCH_COALESCE_MAX_BATCH
+
+        # graceful restart: leave peers and routes on exit, and adopt
+        # them on start.
+        if "graceful_restart" in cnf["amesh"]:
+            self.graceful_restart = (cnf["amesh"]["graceful_restart"]
+                                     .strip().lower() in ("yes", "true", "1"))
+        else:
+            self.graceful_restart = False
+        self.warm_start = self.graceful_restart
+
+        if "route_aggregation" in cnf["amesh"]:
+            self.route_aggregation = (cnf["amesh"]["route_aggregation"]
+                                      .strip().lower() in ("yes", "true", "1"))
+        else:
+            self.route_aggregation = False
+
         if "vrf" in cnf["amesh"]:
             self.vrf = cnf["amesh"]["vrf"]
             if not os.path.exists("/sys/class/net/{}".format(self.vrf)):
@@ -117,59 +204,264 @@ class Amesh(object):
         if self.node.endpoint and not self.wg_dev:
             raise RuntimeError("'endpoint' needs 'device'")
 
-        # etcd lease
+        # local HTTP endpoint exposing metrics: "address:port"
+        if "metrics_listen" in cnf["amesh"]:
+            self.metrics_listen = cnf["amesh"]["metrics_listen"].strip()
+        else:
+            self.metrics_listen = None
+
+        # counters, gauges and histograms
+        self.metrics = Metrics()
+        self.metrics_server = None
+
+        # control plane engine: threads or asyncio
+        if "engine" in cnf["amesh"]:
+            self.engine_type = cnf["amesh"]["engine"].strip()
+        else:
+            self.engine_type = ENGINE
+        if not self.engine_type in ("threads", "asyncio"):
+            raise RuntimeError("invalid engine '{}', must be threads or "
+                               "asyncio".format(self.engine_type))
+
+        # dataplane backend: netlink or ipcmd
+        if "dataplane" in cnf["amesh"]:
+            self.dataplane_type = cnf["amesh"]["dataplane"].strip()
+        else:
+            self.dataplane_type = DATAPLANE
+
+        # number of threads programming wg devices in parallel
+        if "dataplane_workers" in cnf["amesh"]:
+            self.dataplane_workers = int(cnf["amesh"]["dataplane_workers"])
+        else:
+            self.dataplane_workers = DATAPLANE_WORKERS
+
+        self.dataplane = create_dataplane(self.dataplane_type,
+                                          workers = self.dataplane_workers,
+                                          metrics = self.metrics,
+                                          logger = self.logger)
+
+        # routes refer to kernel nexthop groups of their wg devices.
+        # inline nexthops are used if nexthop objects are unsupported.
+        if "nexthop_groups" in cnf["amesh"]:
+            self.nexthop_groups = (cnf["amesh"]["nexthop_groups"]
+                                   .strip().lower() in ("yes", "true", "1"))
+        else:
+            self.nexthop_groups = NEXTHOP_GROUPS
+
+        if "nexthop_id_base" in cnf["amesh"]:
+            self.nexthop_id_base = int(cnf["amesh"]["nexthop_id_base"], 0)
+        else:
+            self.nexthop_id_base = NEXTHOP_ID_BASE
+
+        self.nexthop_table = None
+        if self.nexthop_groups:
+            if self.dataplane.nexthop_supported():
+                self.nexthop_table = NexthopTable(self.dataplane,
+                                                  id_base =
+                                                  self.nexthop_id_base,
+                                                  logger = self.logger)
+            else:
+                self.logger.warning("nexthop objects are not supported, "
+                                    "use inline nexthops")
+
+        # interval in sec of comparing Fib with the dataplane and
+        # repairing the differences. 0 disables periodic passes, and
+        # differences left by failed operations are still repaired.
+        if "reconcile_interval" in cnf["amesh"]:
+            self.reconcile_interval = \
+                float(cnf["amesh"]["reconcile_interval"])
+        else:
+            self.reconcile_interval = RECONCILE_INTERVAL
+
+        # interval in sec of checking whether a pass is due
+        self.reconcile_check = RECONCILE_BACKOFF
+        if self.reconcile_interval > 0:
+            self.reconcile_check = min(self.reconcile_interval,
+                                       RECONCILE_BACKOFF)
+
+        self.reconciler = Reconciler(metrics = self.metrics,
+                                     logger = self.logger)
+
+        # seconds without response from a server before its wg device
+        # is withdrawn from ECMP routes. 0 disables it.
+        if "failover_timeout" in cnf["amesh"]:
+            self.failover_timeout = float(cnf["amesh"]["failover_timeout"])
+        else:
+            self.failover_timeout = FAILOVER_TIMEOUT
+        self.failover_interval = self.failover_timeout / FAILOVER_CHECKS
+
+        self.liveness = None
+        if self.failover_timeout > 0:
+            self.liveness = LivenessMonitor(self.failover_timeout,
+                                            metrics = self.metrics,
+                                            logger = self.logger)
+
+        # etcd client shared by threads, and etcd lease
+        self.etcd = None
+        self.etcd_lock = threading.Lock()
         self.etcd_lease = None
 
+        # key/values of self node last published to etcd
+        self.etcd_published = {}
+
+        # False until self node is registered on the current lease
+        self.etcd_registered = False
+
+        self.devtracker = None
+
+        # self.fib is updated, replaced and reconciled with the lock.
+        # it is reconciled after it is built from the etcd snapshot.
+        self.fib_lock = threading.Lock()
+        self.fib_built = False
+
         # initialize Fib
         self.fib = Fib(self.wg_dev, self.node, self.node_table, 
-                       self.wg_prvkey_path, self.vrf, logger = self.logger)
+                       self.wg_prvkey_path, self.vrf,
+                       dataplane = self.dataplane,
+                       aggregate = self.route_aggregation,
+                       shared_dev = self.wg_shared_dev,
+                       nexthop_table = self.nexthop_table,
+                       logger = self.logger)
 
+        self.init_metrics()
 
         # thread cancel events
         self.th_maintainer = threading.Thread(target = self.etcd_maintainer)
         self.th_watcher = threading.Thread(target = self.etcd_watcher)
+        self.th_reconciler = threading.Thread(target = self.reconcile_loop)
+        self.th_liveness = threading.Thread(target = self.liveness_loop)
         self.stop_maintainer = threading.Event()
         self.stop_watcher = threading.Event()
+        self.stop_reconciler = threading.Event()
+        self.stop_liveness = threading.Event()
         self.cancel_watcher = None # cancel of etcd3.watch_prefix()
 
+        # asyncio engine runs the tasks of the threads above
+        self.engine = None
+        if self.engine_type == "asyncio":
+            self.engine = AsyncioEngine(self, logger = self.logger)
+            self.th_engine = threading.Thread(target = self.engine.run)
+
+        # last etcd revision applied to node_table
+        self.etcd_revision = None
+
+        # prefixes to be watched, and the last revision applied for
+        # each of them. with group sharding, nodes of the groups that
+        # self belongs to and of "any" are watched, or all the groups
+        # if self belongs to "any".
+        if not self.etcd_group_sharding:
+            self.etcd_watch_prefixes = [ "{}/".format(self.etcd_prefix) ]
+        elif "any" in self.node.groups:
+            self.etcd_watch_prefixes = [ "{}/groups/"
+                                         .format(self.etcd_prefix) ]
+        else:
+            self.etcd_watch_prefixes = [
+                self.etcd_shard_prefix(group) + "/"
+                for group in sorted(self.node.groups | { "any" })
+            ]
+        self.etcd_watch_revisions = {}
+
+        # node_shards: key is node_id, value is set of groups under
+        # which the node is published (group sharding only)
+        self.node_shards = {}
+
         self.logger.info("node_id:        %s", self.node_id)
         self.logger.info("etcd endpoint:  %s", self.etcd_endpoint)
         self.logger.info("etcd prefix:    %s", self.etcd_prefix)
+        self.logger.info("etcd format:    %s", self.etcd_record_format)
+        self.logger.info("etcd sharding:  %s", self.etcd_group_sharding)
         self.logger.info("wg device:      %s", self.wg_dev)
+        self.logger.info("wg shared dev:  %s", self.wg_shared_dev)
         self.logger.info("wg endpoint:    %s", self.node.endpoint)
         self.logger.info("wg prvkey path: %s", self.wg_prvkey_path)
         self.logger.info("wg pubkey:      %s", self.node.pubkey)
         self.logger.info("wg keepalive:   %s", self.node.keepalive)
         self.logger.info("wg allowed_ips: %s", self.node.allowed_ips)
         self.logger.info("amesh groups:   %s", self.node.groups)
+        self.logger.info("addr debounce:  %s", self.address_debounce)
+        self.logger.info("engine:         %s", self.engine_type)
+        self.logger.info("dataplane:      %s", self.dataplane_type)
+        self.logger.info("dp workers:     %d", self.dataplane_workers)
+        self.logger.info("graceful restart: %s", self.graceful_restart)
+        self.logger.info("route aggregation: %s", self.route_aggregation)
+        self.logger.info("nexthop groups: %s", self.nexthop_table is not None)
+        self.logger.info("reconcile interval: %s", self.reconcile_interval)
+        self.logger.info("failover timeout: %s", self.failover_timeout)
+        self.logger.info("metrics listen: %s", self.metrics_listen)
 
 
     def start(self):
 
+        if self.metrics_listen:
+            address, port = self.metrics_listen.rsplit(":", 1)
+            self.metrics_server = MetricsServer(self.metrics,
+                                                address.strip("[]"),
+                                                int(port),
+                                                logger = self.logger)
+            self.metrics_server.start()
+
         self.devtracker = DevTracker(self.tracked_devices,
                                      logger = self.logger)
-        self.devtracker.start()
+        # the asyncio engine reads the netlink socket of devtracker
+        self.devtracker.start(thread = not self.engine)
 
         if self.node.endpoint:
             self.init_wg_dev()
-        self.th_maintainer.start()
-        self.th_watcher.start()
+
+        if self.nexthop_table:
+            self.nexthop_table.load()
+            if not self.warm_start:
+                # nexthops left by the previous amesh process are not
+                # adopted, and their wg devices are recreated.
+                self.nexthop_table.collect()
+
+        if self.engine:
+            self.th_engine.start()
+        else:
+            self.th_maintainer.start()
+            self.th_watcher.start()
+            self.th_reconciler.start()
+            if self.liveness:
+                self.th_liveness.start()
 
     def join(self):
-        self.th_maintainer.join()
-        self.th_watcher.join()
+        if self.engine:
+            self.th_engine.join()
+            self.devtracker.stop()
+        else:
+            self.th_maintainer.join()
+            self.th_watcher.join()
+            self.th_reconciler.join()
+            if self.liveness:
+                self.th_liveness.join()
+
+        if self.graceful_restart:
+            self.logger.info("leave routes and peers for graceful restart")
+        else:
+            self.logger.info("uninstall routes...")
+            self.fib.uninstall()
+        self.dataplane.close()
 
-        self.logger.info("uninstall routes...")
-        self.fib.uninstall()
+        with self.etcd_lock:
+            self.etcd_close()
+
+        if self.metrics_server:
+            self.metrics_server.stop()
 
 
     def cancel(self):
 
         self.logger.info("stopping amesh...")
 
-        self.devtracker.stop()
+        if self.engine:
+            self.engine.cancel()
+            return
+
         self.stop_maintainer.set()
         self.stop_watcher.set()
+        self.stop_reconciler.set()
+        self.stop_liveness.set()
+        self.devtracker.stop()
 
         if self.cancel_watcher:
             self.cancel_watcher()
@@ -178,7 +470,7 @@ class Amesh(object):
 
         self.logger.info("set up wireguard interface %s", self.wg_dev)
 
-        cmds = []
+        dp = self.dataplane
 
         # check prvkey can be opened
         try:
@@ -187,50 +479,159 @@ class Amesh(object):
         except Exception as e:
             self.logger.error(e)
 
-        if not os.path.exists("/sys/class/net/{}".format(self.wg_dev)):
-            cmds.append([ IPCMD, "link", "add", self.wg_dev,
-                          "type", "wireguard" ],)
+        # Do not check exception. when fail, then crash the process.
+        if not dp.link_exists(self.wg_dev):
+            dp.link_add(self.wg_dev, "wireguard")
 
         if self.vrf:
-            cmds.append([ IPCMD, "link", "set", "dev", self.wg_dev,
-                          "master", self.vrf])
-
-        cmds += [
-            [ IPCMD, "link", "set", "dev", self.wg_dev, "up" ],
-            [ WGCMD, "set", self.wg_dev,
-              "private-key",  self.wg_prvkey_path,
-              "listen-port", self.node.endpoint.split(":")[1],
-            ]
-        ]
+            dp.link_set_master(self.wg_dev, self.vrf)
 
-        for cmd in cmds:
-            # Do not check exception. when fail, then crash the process.
-            subprocess.check_call(cmd)
+        dp.link_up(self.wg_dev)
+        dp.wg_set(self.wg_dev, [ "private-key",  self.wg_prvkey_path,
+                                 "listen-port",
+                                 self.node.endpoint.rsplit(":", 1)[1] ])
 
 
     def etcd_client(self):
-        host, port = self.etcd_endpoint.split(":")
-        return etcd3.client(host = host, port = port,
-                            user = self.etcd_username,
-                            password = self.etcd_password)
+        """
+        returns the etcd client shared by the maintainer and watcher
+        threads. a new client is connected only when there is no
+        client, or the last one was closed by etcd_check().
+        """
+
+        with self.etcd_lock:
+            if self.etcd:
+                return self.etcd
+
+            host, port = self.etcd_endpoint.rsplit(":", 1)
+            host = host.strip("[]")
+            start = time.monotonic()
+            etcd = etcd3.client(host = host, port = port,
+                                user = self.etcd_username,
+                                password = self.etcd_password)
+            try:
+                # status completes the connection and checks health
+                etcd.status()
+            except Exception:
+                etcd.close()
+                raise
+            elapsed = time.monotonic() - start
+
+            self.m_etcd_connections.inc()
+            self.m_etcd_connect_seconds.set(elapsed)
+            self.m_etcd_connect_seconds_total.inc(elapsed)
+            self.logger.debug("etcd client connected in %.6f sec", elapsed)
+
+            self.etcd = etcd
+            return self.etcd
+
+
+    def etcd_check(self):
+        """
+        check health of the shared etcd client, and close it if
+        unhealthy so that the next etcd_client() reconnects.
+        """
+
+        with self.etcd_lock:
+            if not self.etcd:
+                return
+            try:
+                self.etcd.status()
+            except Exception as e:
+                self.logger.debug("etcd client is unhealthy: %s", e)
+                self.etcd_close()
+
+
+    def etcd_close(self):
+        # call with etcd_lock
+        if self.etcd:
+            self.etcd.close()
+            self.etcd = None
 
 
     def etcd_lease_allocate(self):
         etcd = self.etcd_client()
         lease = int(uuid.uuid3(uuid.NAMESPACE_DNS, self.node_id)) % sys.maxsize
-        self.etcd_lease = etcd.lease(ETCD_LEASE_LIFETIME, lease_id = lease)
-        self.logger.debug("allocated etcd lease is %x", self.etcd_lease.id)
-
+        try:
+            self.etcd_lease = etcd.lease(ETCD_LEASE_LIFETIME, lease_id = lease)
+            self.logger.debug("allocated etcd lease is %x", self.etcd_lease.id)
+        except etcd3.exceptions.PreconditionFailedError:
+            # the lease of the previous process is still alive. take
+            # it over, so that self node does not disappear from etcd.
+            self.etcd_lease = etcd3.Lease(lease, ETCD_LEASE_LIFETIME,
+                                          etcd_client = etcd)
+            self.etcd_lease.refresh()
+            self.logger.debug("took over etcd lease %x", self.etcd_lease.id)
+
+        # keys must be put again to be attached to the new lease. keys
+        # on the lease taken over that self node no longer publishes,
+        # e.g., under groups it left, are deleted by etcd_register().
+        self.etcd_published = dict.fromkeys([ k.decode("utf-8") for k
+                                              in self.etcd_lease.keys ])
+        self.etcd_registered = False
+
+
+    def etcd_register(self):
+        """
+        put keys of self node whose values differ from the last
+        published ones, and delete published keys that self node no
+        longer has, in a single transaction.
+        """
+
+        d = {}
+        other = {}
+        for prefix in self.etcd_node_prefixes():
+            record = self.node.serialize_for_etcd_record(prefix,
+                                                         self.node_id)
+            keys = self.node.serialize_for_etcd(prefix, self.node_id)
+            if self.etcd_record_format == "record":
+                d.update(record)
+                other.update(keys)
+            else:
+                d.update(keys)
+                other.update(record)
+
+        changed = dict([ (k, v) for k, v in d.items()
+                         if self.etcd_published.get(k) != v ])
+        removed = set([ k for k in self.etcd_published if not k in d ])
+        if not self.etcd_registered:
+            # keys of the other format left by the previous process,
+            # which readers would apply over the current ones.
+            removed |= set(other)
+        if not changed and not removed:
+            return
 
-    def etcd_register(self, key = None):
         etcd = self.etcd_client()
-        d = self.node.serialize_for_etcd(self.etcd_prefix, self.node_id)
-
-        for k, v in d.items():
-            if key and not key in k:
-                continue
+        ops = []
+        # deletes precede puts, so that a node moving between shards
+        # is removed and added again at the same revision.
+        for k in sorted(removed):
+            self.logger.debug("unregister self: %s", k)
+            ops.append(etcd.transactions.delete(k))
+        for k, v in sorted(changed.items()):
             self.logger.debug("register self: %s, %s", k, v)
-            etcd.put(k, v, lease = self.etcd_lease.id)
+            ops.append(etcd.transactions.put(k, v, lease = self.etcd_lease.id))
+
+        etcd.transaction(compare = [], success = ops, failure = [])
+        for k in removed:
+            self.etcd_published.pop(k, None)
+        self.etcd_published.update(changed)
+        self.etcd_registered = True
+
+
+    def etcd_shard_prefix(self, group):
+        return "{}/groups/{}".format(self.etcd_prefix, group)
+
+
+    def etcd_node_prefixes(self):
+        """
+        returns prefixes under which self node is published. with
+        group sharding, self node is published under all its groups.
+        """
+        if not self.etcd_group_sharding:
+            return [ self.etcd_prefix ]
+        return [ self.etcd_shard_prefix(group)
+                 for group in sorted(self.node.groups) ]
 
 
     def etcd_maintainer(self):
@@ -245,119 +646,505 @@ class Amesh(object):
                 self.etcd_lease_allocate()
                 self.etcd_register()
 
-                cnt = 0
+                refresh = time.monotonic() + ETCD_LEASE_KEEPALIVE
 
                 connected = True
                 self.logger.info("etcd maintainer connected to %s",
                                  self.etcd_endpoint)
 
                 while True:
-                    time.sleep(1)
+                    # sleep until an address changes or the lease
+                    # needs to be refreshed.
+                    timeout = max(0, refresh - time.monotonic())
+                    if self.devtracker.wait(timeout):
+                        # wait for successive changes, e.g., addresses
+                        # assigned by a script one by one.
+                        self.stop_maintainer.wait(self.address_debounce)
 
                     if self.stop_maintainer.is_set():
                         return
 
                     self.handle_devtracker()
 
-                    cnt += 1
-                    if cnt % ETCD_LEASE_KEEPALIVE == 0:
-                        self.etcd_lease.refresh()
-                        cnt = 0
+                    if time.monotonic() >= refresh:
+                        self.etcd_lease_refresh()
+                        refresh = time.monotonic() + ETCD_LEASE_KEEPALIVE
 
             except etcd3.exceptions.Etcd3Exception as e:
                 if connected:
                     self.logger.error("etcd maintainer failed: %s",
                                       e.__class__)
                     connected = False
+                self.etcd_check()
                 time.sleep(1)
 
 
+    def etcd_lease_refresh(self):
+        start = time.monotonic()
+        try:
+            self.etcd_lease.refresh()
+        except Exception:
+            self.m_lease_refresh_failures.inc()
+            raise
+        self.m_lease_refresh_seconds.observe(time.monotonic() - start)
+
+
+    def init_metrics(self):
+        m = self.metrics
+        self.m_watch_events = m.counter("amesh_watch_events_total",
+                                        "etcd watch events received")
+        self.m_watch_batches = m.counter("amesh_watch_batches_total",
+                                         "batches of coalesced watch events")
+        self.m_watch_batch_size = m.gauge("amesh_watch_batch_size",
+                                          "size of the last watch batch")
+        self.m_watch_batch_size_max = m.gauge("amesh_watch_batch_size_max",
+                                              "largest watch batch size")
+        self.m_fib_updates = m.counter("amesh_fib_updates_total",
+                                       "incremental Fib updates")
+        self.m_fib_updates_saved = m.counter(
+            "amesh_fib_updates_saved_total",
+            "Fib updates saved by coalescing watch events")
+        self.m_watch_resumes = m.counter(
+            "amesh_watch_resumes_total",
+            "etcd watches resumed from the last applied revision")
+        self.m_watch_resyncs = m.counter(
+            "amesh_watch_resyncs_total",
+            "snapshots obtained from etcd")
+        self.m_etcd_connections = m.counter(
+            "amesh_etcd_connections_total",
+            "connections established to etcd")
+        self.m_etcd_connect_seconds = m.gauge(
+            "amesh_etcd_connect_seconds",
+            "seconds to establish the last etcd connection")
+        self.m_etcd_connect_seconds_total = m.counter(
+            "amesh_etcd_connect_seconds_total",
+            "seconds spent to establish etcd connections")
+        self.m_watch_events_applied = m.counter(
+            "amesh_watch_events_applied_total",
+            "etcd watch events that changed the node table")
+        self.m_watch_reconnects = m.counter(
+            "amesh_watch_reconnects_total",
+            "etcd watches reconnected after failures")
+        self.m_lease_refresh_seconds = m.histogram(
+            "amesh_etcd_lease_refresh_seconds",
+            "latency of etcd lease refreshes")
+        self.m_lease_refresh_failures = m.counter(
+            "amesh_etcd_lease_refresh_failures_total",
+            "failed etcd lease refreshes")
+        self.m_fib_rebuild_seconds = m.histogram(
+            "amesh_fib_rebuild_seconds",
+            "latency of building whole Fib and programming the diff")
+        self.m_fib_update_diff_seconds = m.histogram(
+            "amesh_fib_update_diff_seconds",
+            "latency of Fib.update_diff")
+        self.m_fib_update_nodes_seconds = m.histogram(
+            "amesh_fib_update_nodes_seconds",
+            "latency of incremental Fib updates for watch batches")
+        m.gauge("amesh_fib_peers", "wg peers installed",
+                function = lambda: len(self.fib.peers))
+        m.gauge("amesh_fib_routes", "routes installed",
+                function = lambda: len(self.fib.routes))
+        m.gauge("amesh_devtracker_queue_depth",
+                "address changes queued by devtracker",
+                function = lambda: (self.devtracker.qsize()
+                                    if self.devtracker else 0))
+
+
     def etcd_watcher(self):
 
         connected = True
 
         while True:
 
+            etcd = None
+            watch_ids = []
+
             try:
                 if self.stop_watcher.is_set():
                     return
 
-                # initialize node_table
-                self.node_table = {}
-                self.etcd_obtain()
+                if self.etcd_revision is None:
+                    # no revision to resume from. obtain a snapshot
+                    self.etcd_obtain()
+                else:
+                    self.m_watch_resumes.inc()
+                    self.logger.info("resume etcd watch from revision %d",
+                                     self.etcd_revision + 1)
 
                 etcd = self.etcd_client()
-                wtach_prefix = "{}/".format(self.etcd_prefix)
 
-                event_iter, cancel = etcd.watch_prefix(wtach_prefix)
+                # watch responses are queued by the etcd3 watcher
+                # thread, and coalesced to batches in this thread.
+                # None in the queue means cancel.
+                responses = queue.Queue()
+                watch_ids = self.etcd_add_watches(etcd, responses.put)
+
+                def cancel():
+                    for watch_id in watch_ids:
+                        etcd.cancel_watch(watch_id)
+                    responses.put(None)
                 self.cancel_watcher = cancel
 
+                if not connected:
+                    self.m_watch_reconnects.inc()
                 connected = True
                 self.logger.info("etcd watch connected to %s",
                                  self.etcd_endpoint)
 
-                for ev in event_iter:
-                    preflen = len(self.etcd_prefix) + 1
-                    node_id, key = ev.key.decode("utf-8")[preflen:].split("/")
-                    value = ev.value.decode("utf-8")
-                    if type(ev) == etcd3.events.PutEvent:
-                        ev_type = "put"
-                    else:
-                        ev_type = "delete"
-                    self.process_etcd_kv(node_id, key, value, ev_type)
+                while True:
+                    events = self.etcd_watch_batch(responses)
+                    if events is None:
+                        break
+                    self.process_etcd_events(events)
+
+            except etcd3.exceptions.RevisionCompactedError as e:
+                # events after the revision are no longer available.
+                # fall back to a snapshot.
+                self.logger.info("etcd revision %d is compacted, resync",
+                                 self.etcd_revision)
+                self.etcd_revision = None
 
             except etcd3.exceptions.Etcd3Exception as e:
                 if connected:
                     self.logger.error("etcd watch failed: %s", e.__class__)
                     connected = False
 
-                self.cancel_watcher = None
+                self.etcd_check()
                 time.sleep(1)
 
+            finally:
+                self.cancel_watcher = None
+                for watch_id in watch_ids:
+                    try:
+                        etcd.cancel_watch(watch_id)
+                    except Exception as e:
+                        self.logger.debug("failed to cancel watch: %s", e)
+
+
+    def etcd_add_watches(self, etcd, callback):
+        """
+        watch the prefixes to be watched, and returns the watch ids.
+        each watch starts just after the last revision applied for
+        the prefix, so that no events are lost between the snapshot
+        or the last watch.
+        """
+
+        watch_ids = []
+        try:
+            for prefix in self.etcd_watch_prefixes:
+                watch_ids.append(etcd.add_watch_prefix_callback(
+                    prefix, callback,
+                    start_revision = self.etcd_watch_revisions[prefix] + 1))
+        except Exception:
+            for watch_id in watch_ids:
+                etcd.cancel_watch(watch_id)
+            raise
+
+        return watch_ids
+
+
+    def etcd_watch_batch(self, responses):
+        """
+        wait for watch events, and returns events arrived within
+        the coalescing window or up to the max batch size. returns None
+        when the watch is canceled.
+        """
+
+        events = []
+        response = responses.get()
+        deadline = time.monotonic() + self.watch_coalesce_window
+
+        while True:
+            if response is None:
+                return None
+
+            events += self.etcd_watch_events(response)
+            if len(events) >= self.watch_coalesce_max_batch:
+                break
+
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                response = responses.get(timeout = timeout)
+            except queue.Empty:
+                break
+
+        return events
+
+
+    def etcd_watch_events(self, response):
+        """
+        returns events in a watch response, or raises the error that
+        the etcd3 watcher passed instead of a response.
+        """
+
+        if isinstance(response, etcd3.exceptions.Etcd3Exception):
+            raise response
+        elif isinstance(response, Exception):
+            # grpc errors when watch stream is disconnected
+            self.logger.debug("etcd watch error: %s", response)
+            raise etcd3.exceptions.ConnectionFailedError()
+
+        return response.events
+
+
+    def process_etcd_events(self, events):
+
+        changed = set()
+        nchanged = 0
+
+        # events of each watch are in the order of revisions, but
+        # events of different watches may be interleaved.
+        prefixes = [ (prefix, prefix.encode("utf-8"))
+                     for prefix in self.etcd_watch_prefixes ]
+
+        for ev in events:
+            for prefix, prefix_bytes in prefixes:
+                if ev.key.startswith(prefix_bytes):
+                    self.etcd_watch_revisions[prefix] = ev.mod_revision
+                    break
+
+            shard, node_id, key = self.parse_etcd_key(ev.key)
+            if node_id is None:
+                continue
+            value = ev.value.decode("utf-8")
+            if type(ev) == etcd3.events.PutEvent:
+                ev_type = "put"
+            else:
+                ev_type = "delete"
+            if self.apply_etcd_kv(node_id, key, value, ev_type,
+                                  shard = shard):
+                changed.add(node_id)
+                nchanged += 1
+
+        if events:
+            self.etcd_revision = max([ ev.mod_revision for ev in events ] +
+                                     [ self.etcd_revision ])
+
+        self.m_watch_events.inc(len(events))
+        self.m_watch_events_applied.inc(nchanged)
+        self.m_watch_batches.inc()
+        self.m_watch_batch_size.set(len(events))
+        if len(events) > self.m_watch_batch_size_max.value:
+            self.m_watch_batch_size_max.set(len(events))
+
+        if not changed:
+            return
+
+        # recompute peers and routes of only the changed nodes at once
+        start = time.monotonic()
+        with self.fib_lock:
+            self.fib.update_nodes(self.node_table, changed)
+            self.queue_failures()
+        elapsed = time.monotonic() - start
+        self.m_fib_update_nodes_seconds.observe(elapsed)
+
+        # without coalescing, each changed event updates Fib for a node.
+        self.m_fib_updates.inc()
+        self.m_fib_updates_saved.inc(nchanged - 1)
+
+        self.logger.debug("watch batch: %d events, %d changed nodes, "
+                          "%.6f sec", len(events), len(changed), elapsed)
+
+
+    def parse_etcd_key(self, key):
+        """
+        returns shard, node_id and key from etcd key bytes. shard is
+        the group under which the node is published, or None without
+        group sharding. key is None if the etcd key is a record of a
+        node. node_id is None if the etcd key is not of a node.
+        """
+        preflen = len(self.etcd_prefix) + 1
+        path = key.decode("utf-8")[preflen:].split("/")
+
+        shard = None
+        if self.etcd_group_sharding:
+            if len(path) < 3 or path[0] != "groups":
+                return None, None, None
+            shard = path[1]
+            path = path[2:]
+        elif len(path) > 2:
+            # an entry published with group sharding
+            return None, None, None
+
+        if len(path) == 1:
+            return shard, path[0], None
+        if len(path) == 2:
+            return shard, path[0], path[1]
+        return None, None, None
+
 
     def etcd_obtain(self):
 
+        self.m_watch_resyncs.inc()
+
         etcd = self.etcd_client()
 
-        for value, meta in etcd.get_prefix(self.etcd_prefix):
-            preflen = len(self.etcd_prefix) + 1
-            node_id, key = meta.key.decode("utf-8")[preflen:].split("/")
+        # initialize node_table
+        self.node_table = NodeTable()
+        self.node_shards = {}
+
+        # each prefix is watched from the revision at which it is read.
+        # etcd3 does not read a prefix at a given revision.
+        revisions = {}
+        for prefix in self.etcd_watch_prefixes:
+            resp = etcd.get_prefix_response(prefix)
+            revisions[prefix] = resp.header.revision
+            for kv in resp.kvs:
+                shard, node_id, key = self.parse_etcd_key(kv.key)
+                if node_id is None:
+                    continue
+                value = kv.value.decode("utf-8")
+                self.apply_etcd_kv(node_id, key, value, "put",
+                                   shard = shard)
+
+        # build whole Fib from the obtained node_table at once
+        self.rebuild_fib()
+
+        # node_table is consistent with each prefix at its revision
+        self.etcd_revision = max(revisions.values())
+        self.etcd_watch_revisions = revisions
+
+
+    def rebuild_fib(self):
+        start = time.monotonic()
+        new_fib = Fib(self.wg_dev, self.node, self.node_table, 
+                      self.wg_prvkey_path, self.vrf,
+                      dataplane = self.dataplane,
+                      aggregate = self.route_aggregation,
+                      shared_dev = self.wg_shared_dev,
+                      nexthop_table = self.nexthop_table,
+                      down_devs = self.fib.down_devs,
+                      logger = self.logger)
+
+        with self.fib_lock:
+            if self.warm_start:
+                # the first Fib is compared with peers and routes left
+                # on the dataplane by the previous amesh process.
+                self.fib.adopt_dataplane(new_fib)
+                self.warm_start = False
+
+            diff_start = time.monotonic()
+            new_fib.update_diff(self.fib)
+            self.fib = new_fib
+            self.fib_built = True
+            self.queue_failures()
+
+        end = time.monotonic()
+        self.m_fib_update_diff_seconds.observe(end - diff_start)
+        self.m_fib_rebuild_seconds.observe(end - start)
+
+
+    def queue_failures(self):
+        """
+        queue differences left by failed dataplane operations for
+        retry. called with fib_lock after Fib is updated.
+        """
+        failures = self.dataplane.failures()
+        if failures:
+            self.reconciler.enqueue(failures)
+
+
+    def reconcile_loop(self):
+
+        while not self.stop_reconciler.wait(self.reconcile_check):
+            self.reconcile()
+
+
+    def reconcile(self):
+        """
+        compare Fib with the dataplane and repair the differences if
+        a periodic pass or a retry is due.
+        """
+
+        with self.fib_lock:
+            if not self.fib_built:
+                return
+            if not self.reconciler.pending(self.reconcile_interval):
+                return
+            try:
+                self.reconciler.reconcile(self.fib)
+            except Exception as e:
+                self.logger.error("failed to reconcile dataplane: %s", e)
+            self.queue_failures()
+
+
+    def liveness_loop(self):
 
-            value = value.decode("utf-8")
-            self.process_etcd_kv(node_id, key, value, "put")
+        while not self.stop_liveness.wait(self.failover_interval):
+            self.check_liveness()
 
 
-    def process_etcd_kv(self, node_id, key, value, ev_type):
+    def check_liveness(self):
+        """
+        withdraw wg devices of unresponsive servers from ECMP routes,
+        and restore them when they respond.
+        """
+
+        with self.fib_lock:
+            if not self.fib_built:
+                return
+            try:
+                self.liveness.check(self.fib)
+            except Exception as e:
+                self.logger.error("failed to check liveness: %s", e)
+            self.queue_failures()
+
+
+    def apply_etcd_kv(self, node_id, key, value, ev_type, shard = None):
 
         self.logger.debug("k/v: ev_type=%s, node_id=%s, key=%s, value=%s",
                           ev_type, node_id, key, value)
 
         if node_id == self.node_id:
-            return
+            return False
 
 
         changed = False
 
         if ev_type == "put":
+            if shard is not None:
+                self.node_shards.setdefault(node_id, set()).add(shard)
             changed = self.update_node(node_id, key, value)
 
         elif ev_type == "delete":
+            node = self.node_table.get(node_id)
+            if key and node and node.record_version:
+                # a key of the old layout is deleted after the node
+                # migrated to the record layout. ignore it.
+                return False
+            if shard is not None:
+                shards = self.node_shards.get(node_id, set())
+                shards.discard(shard)
+                if shards:
+                    # the node is still published under other groups
+                    return False
+                self.node_shards.pop(node_id, None)
             changed = self.remove_node(node_id)
 
-        if changed:
-            new_fib = Fib(self.wg_dev, self.node, self.node_table, 
-                          self.wg_prvkey_path, self.vrf, logger = self.logger)
-            new_fib.update_diff(self.fib)
-            self.fib = new_fib
+        return changed
 
 
     def update_node(self, node_id, key, value):
 
+        node = self.node_table.get(node_id)
+        if key and node and node.record_version:
+            # a key of the old layout left after the node migrated to
+            # the record layout. ignore it.
+            return False
+
         if not node_id in self.node_table:
             self.node_table[node_id] = Node(logger = self.logger)
 
         node = self.node_table[node_id]
-        changed = node.update(key, value)
+        if key:
+            changed = node.update(key, value)
+        else:
+            changed = node.update_record(value)
+        if changed:
+            self.node_table.index(node_id)
         return changed
 
 
@@ -375,9 +1162,11 @@ class Amesh(object):
 
     def handle_devtracker(self):
 
+        changed = False
+
         while self.devtracker.queued():
             msg = self.devtracker.pop()
-            print(msg)
+            self.logger.debug("devtracker: %s", msg)
             if not msg:
                 self.logger.debug("pop from devtracker failed")
                 break
@@ -389,4 +1178,9 @@ class Amesh(object):
             else:
                 self.logger.error("invalid device track action %s", str(msg))
 
-            self.etcd_register(key = "allowed_ips")
+            changed = True
+
+        # publish all the address changes at once. etcd_register
+        # writes nothing if the addresses are eventually not changed.
+        if changed:
+            self.etcd_register()
@@ -0,0 +1,776 @@
+
+import os
+import abc
+import json
+import errno
+import time
+import socket
+import struct
+import ipaddress
+import threading
+import contextlib
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyroute2 import IPRoute, NetlinkError
+from pyroute2.netlink.rtnl import rt_proto
+
+if not "amesh." in __name__:
+    from static import IPCMD, WGCMD
+    from metrics import Metrics
+else:
+    from amesh.static import IPCMD, WGCMD
+    from amesh.metrics import Metrics
+
+from logging import getLogger, INFO, StreamHandler
+from logging.handlers import SysLogHandler
+default_logger = getLogger(__name__)
+default_logger.setLevel(INFO)
+stream = StreamHandler()
+syslog = SysLogHandler(address = "/dev/log")
+default_logger.addHandler(stream)
+default_logger.addHandler(syslog)
+default_logger.propagate = False
+
+
+class Dataplane(abc.ABC):
+
+    def __init__(self, workers = 1, metrics = None, logger = None):
+        """
+        Dataplane: programs wireguard devices and routes on the kernel.
+        @workers: number of threads that run tasks given to parallel()
+        @metrics: Metrics to count commands, failures and durations
+        @logger: logger
+
+        Route operations issued between begin() and commit() are
+        queued and sent as a batch at commit(). Link operations flush
+        the queued routes first so that the order of operations is
+        kept as it is issued. Subclasses implement route and link
+        operations, and the other operations are done by ip and wg
+        commands.
+        """
+
+        self.logger = logger or default_logger
+        self.metrics = metrics or Metrics()
+        self.batch = None
+        self.lock = threading.RLock()
+
+        # wg devices created by this process, or adopted from the
+        # previous one. other devices are not repaired.
+        self.owned_links = set()
+
+        # differences left by failed operations, as (kind, key) of
+        # Reconciler, until they are taken by failures().
+        self.failed = set()
+
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers = workers)
+
+    def begin(self):
+        if self.batch is None:
+            self.batch = []
+
+    def commit(self):
+        self.flush()
+        self.batch = None
+
+    def flush(self):
+        with self.lock:
+            if not self.batch:
+                return
+            batch = self.batch
+            self.batch = []
+            self.route_batch(batch)
+
+    def parallel(self, tasks):
+        """
+        run callables in @tasks and wait for all of them. tasks are
+        run concurrently by the worker threads, so that they must not
+        depend on each other, e.g., tasks for different wg devices.
+        """
+
+        self.flush()
+
+        if not self.executor or len(tasks) < 2:
+            for task in tasks:
+                self.run_task(task)
+            return
+
+        for future in [ self.executor.submit(self.run_task, task)
+                        for task in tasks ]:
+            future.result()
+
+    def run_task(self, task):
+        try:
+            task()
+        except Exception as e:
+            self.logger.error("dataplane task failed: %s", e)
+
+    def fail(self, kind, key):
+        """
+        record a difference of @kind and @key left by a failed
+        operation, so that it is repaired by Reconciler.
+        """
+        with self.lock:
+            self.failed.add((kind, key))
+
+    def failures(self):
+        """
+        returns set of (kind, key) of differences recorded by fail()
+        since the last call.
+        """
+        with self.lock:
+            failed = self.failed
+            self.failed = set()
+        return failed
+
+    @contextlib.contextmanager
+    def command(self, command):
+        """
+        count and measure a dataplane command executed in the block.
+        an exception raised in the block is counted as a failure.
+        """
+
+        labels = { "command": command }
+        m = self.metrics
+        m.counter("amesh_dataplane_commands_total",
+                  "dataplane commands executed", labels).inc()
+
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            m.counter("amesh_dataplane_command_failures_total",
+                      "dataplane commands failed", labels).inc()
+            raise
+        finally:
+            m.histogram("amesh_dataplane_command_seconds",
+                        "duration of dataplane commands",
+                        labels).observe(time.monotonic() - start)
+
+    def route(self, op, prefix, wg_devs, vrf, nhid = None):
+        """
+        @op: "add", "del", or "replace"
+        @prefix: destination prefix string
+        @wg_devs: list of nexthop devices
+        @vrf: VRF name or None
+        @nhid: id of nexthop group that the route refers to, or None
+        """
+        with self.lock:
+            if self.batch is not None:
+                self.batch.append((op, prefix, wg_devs, vrf, nhid))
+            else:
+                self.route_batch([(op, prefix, wg_devs, vrf, nhid)])
+
+    @abc.abstractmethod
+    def route_batch(self, batch):
+        """
+        program route operations in @batch, list of (op, prefix,
+        wg_devs, vrf, nhid). called with self.lock held.
+        """
+
+    def route_failed(self, entry, e):
+        op, prefix, wg_devs, vrf, nhid = entry
+        self.metrics.counter("amesh_dataplane_route_failures_total",
+                             "route operations failed",
+                             { "op": op }).inc()
+        self.logger.error("failed to %s route: %s dev %s vrf %s: %s",
+                          op, prefix, ",".join(wg_devs), vrf, e)
+        self.fail(ROUTE_DRIFT[op], ("route", prefix))
+
+    def route_args(self, op, prefix, wg_devs, vrf, nhid):
+        """
+        returns arguments of ip command for a route operation.
+        """
+
+        args = [ "route", op, "to", prefix ]
+        if vrf:
+            args += [ "vrf", vrf ]
+        if op == "del":
+            return args
+        if nhid:
+            return args + [ "nhid", str(nhid) ]
+        if len(wg_devs) == 1:
+            return args + [ "dev", wg_devs[0] ]
+
+        for wg_dev in wg_devs:
+            args += [ "nexthop" ]
+            if self.family(prefix) == socket.AF_INET6:
+                args += [ "via", IPV6_ECMP_GATEWAY ]
+            args += [ "dev", wg_dev ]
+        return args
+
+    def family(self, prefix):
+        """
+        returns address family of @prefix string, AF_INET or AF_INET6.
+        """
+        return socket.AF_INET6 if ":" in prefix else socket.AF_INET
+
+    def link_exists(self, dev):
+        return os.path.exists("/sys/class/net/{}".format(dev))
+
+    def ipcmd(self, command, args):
+        self.flush()
+        cmd = [ IPCMD ] + list(map(str, args))
+        self.logger.debug("ip: %s", " ".join(cmd))
+        with self.command(command):
+            subprocess.check_call(cmd)
+
+    def nexthop_supported(self):
+        """
+        returns True if the kernel and ip command support nexthop
+        objects.
+        """
+        try:
+            subprocess.check_output([ IPCMD, "nexthop", "show" ],
+                                     stderr = subprocess.STDOUT)
+        except Exception as e:
+            self.logger.debug("nexthop objects are not supported: %s", e)
+            return False
+        return True
+
+    # nexthop objects are always programmed by ip command, because
+    # pyroute2 does not support them.
+
+    def nexthop_add(self, nhid, dev):
+        # device-only IPv6 nexthops are usable by IPv4 routes too
+        self.ipcmd("nexthop_add",
+                   [ "-6", "nexthop", "add", "id", nhid, "dev", dev ])
+
+    def nexthop_group(self, nhid, members):
+        """
+        create the nexthop group @nhid, or replace its members, with
+        the nexthop ids in @members.
+        """
+        self.ipcmd("nexthop_group",
+                   [ "nexthop", "replace", "id", nhid,
+                     "group", "/".join(map(str, members)) ])
+
+    def nexthop_del(self, nhid):
+        self.ipcmd("nexthop_del", [ "nexthop", "del", "id", nhid ])
+
+    def nexthop_dump(self):
+        """
+        returns list of nexthop objects. a nexthop object is a dict
+        of id, and dev for a nexthop or group (list of member ids) for
+        a nexthop group.
+        """
+
+        self.flush()
+        with self.command("nexthop_dump"):
+            out = subprocess.check_output([ IPCMD, "-j", "nexthop", "show" ],
+                                          universal_newlines = True)
+        nexthops = []
+        for nh in json.loads(out or "[]"):
+            if "group" in nh:
+                nexthops.append({ "id": nh["id"],
+                                  "group": [ m["id"] for m in nh["group"] ] })
+            elif "dev" in nh:
+                nexthops.append({ "id": nh["id"], "dev": nh["dev"] })
+        return nexthops
+
+    @abc.abstractmethod
+    def link_add(self, dev, kind):
+        """
+        create the device @dev of @kind, e.g., wireguard.
+        """
+
+    @abc.abstractmethod
+    def link_del(self, dev):
+        """
+        delete the device @dev.
+        """
+
+    @abc.abstractmethod
+    def link_up(self, dev):
+        """
+        set the device @dev up.
+        """
+
+    @abc.abstractmethod
+    def link_set_master(self, dev, master):
+        """
+        enslave the device @dev to @master, e.g., a VRF.
+        """
+
+    def wg_set(self, dev, args):
+        # wireguard configurations are always done by wg command
+        self.flush()
+        cmd = [ WGCMD, "set", dev ] + list(map(str, args))
+        self.logger.debug("wg: %s", " ".join(cmd))
+        with self.command("wg_set"):
+            subprocess.check_call(cmd)
+
+    def wg_addconf(self, dev, conf):
+        """
+        append peers in wireguard config @conf to @dev. peers on @dev
+        that are not in @conf are not changed.
+        """
+        self.flush()
+        cmd = [ WGCMD, "addconf", dev, "/dev/stdin" ]
+        self.logger.debug("wg: %s\n%s", " ".join(cmd), conf)
+        with self.command("wg_addconf"):
+            subprocess.run(cmd, input = conf, universal_newlines = True,
+                           check = True)
+
+    def wg_dump(self):
+        """
+        returns dict of wg device name and list of its peers. a peer
+        is a dict of pubkey, endpoint, allowed_ips, keepalive,
+        latest_handshake, rx_bytes and tx_bytes.
+        """
+
+        self.flush()
+        with self.command("wg_dump"):
+            out = subprocess.check_output([ WGCMD, "show", "all", "dump" ],
+                                          universal_newlines = True)
+        devs = {}
+        for line in out.splitlines():
+            f = line.split("\t")
+            if len(f) == 5:
+                # interface: name, prvkey, pubkey, listen-port, fwmark
+                devs[f[0]] = []
+            elif len(f) == 9:
+                (dev, pubkey, psk, endpoint, allowed_ips,
+                 handshake, rx, tx, keepalive) = f
+                if not dev in devs:
+                    devs[dev] = []
+                devs[dev].append({
+                    "pubkey": pubkey,
+                    "endpoint": None if endpoint == "(none)" else endpoint,
+                    "allowed_ips": ([] if allowed_ips == "(none)" else
+                                    allowed_ips.split(",")),
+                    "keepalive": 0 if keepalive == "off" else int(keepalive),
+                    "latest_handshake": int(handshake),
+                    "rx_bytes": int(rx),
+                    "tx_bytes": int(tx),
+                })
+        return devs
+
+    def link_masters(self):
+        """
+        returns dict of wireguard device names and names of their
+        master devices (None if not enslaved).
+        """
+
+        self.flush()
+        with self.command("link_dump"):
+            out = subprocess.check_output([ IPCMD, "-j", "link", "show",
+                                            "type", "wireguard" ],
+                                          universal_newlines = True)
+        # links of other types are printed as empty objects
+        return dict([ (link["ifname"], link.get("master"))
+                      for link in json.loads(out or "[]")
+                      if "ifname" in link ])
+
+    @abc.abstractmethod
+    def route_dump(self, vrf):
+        """
+        returns list of (prefix, [ nexthop devices ]) of routes in the
+        main table or the table of @vrf.
+        """
+
+    def route_nhids(self, vrf):
+        """
+        returns dict of prefix and nexthop id of routes that refer to
+        nexthop objects in the main table or the table of @vrf.
+        """
+        return dict([ (prefix, nhid) for prefix, devs, nhid
+                      in self.ipcmd_route_dump(vrf) if nhid ])
+
+    def ipcmd_route_dump(self, vrf):
+        """
+        returns list of (prefix, [ nexthop devices ], nexthop id) of
+        routes shown by ip command.
+        """
+
+        self.flush()
+        routes = []
+        for family, hostlen in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+            routes += self.ipcmd_route_dump_family(vrf, family, hostlen)
+        return routes
+
+    def ipcmd_route_dump_family(self, vrf, family, hostlen):
+
+        cmd = [ IPCMD, "-j", IPCMD_FAMILY[family], "route", "show" ]
+        if vrf:
+            cmd += [ "vrf", vrf ]
+        else:
+            cmd += [ "table", "main" ]
+
+        routes = []
+        for r in json.loads(subprocess.check_output(cmd) or "[]"):
+            if r.get("dst", "default") == "default":
+                continue
+            if r.get("protocol") == "kernel":
+                # e.g., IPv6 link-local prefix of the device
+                continue
+            if "nexthops" in r:
+                devs = [ nh["dev"] for nh in r["nexthops"] if "dev" in nh ]
+            elif "dev" in r:
+                devs = [ r["dev"] ]
+            else:
+                continue
+            prefix = r["dst"]
+            if not "/" in prefix:
+                # host routes are shown without prefix length
+                prefix += "/{}".format(hostlen)
+            routes.append((prefix, devs, r.get("nhid")))
+        return routes
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+
+
+# kind of difference that a failed route operation leaves
+ROUTE_DRIFT = {
+    "add": "routes_missing",
+    "replace": "routes_changed",
+    "del": "routes_extra",
+}
+
+# ip command option for address family
+IPCMD_FAMILY = {
+    socket.AF_INET: "-4",
+    socket.AF_INET6: "-6",
+}
+
+# IPv6 multipath routes cannot have device-only nexthops. wireguard
+# devices do not resolve neighbors, so that the gateway of nexthops is
+# just a placeholder that is never used.
+IPV6_ECMP_GATEWAY = "fe80::1"
+
+# rtnetlink constants for route messages built by NetlinkDataplane.
+# pyroute2 does not know RTA_NH_ID.
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_MULTIPATH = 9
+RTA_TABLE = 15
+RTA_NH_ID = 30
+RT_TABLE_MAIN = 254
+RTPROT_STATIC = 4
+RTN_UNICAST = 1
+RT_SCOPE_NOWHERE = 255
+
+# errors of netlink requests for an ifindex that no longer exists. the
+# requests are sent again with the ifindex looked up again.
+STALE_IFINDEX_ERRORS = (errno.ENODEV, errno.EINVAL)
+
+# route messages written by a single send(). their acks must fit in
+# the receive buffer of the socket (rmem_default), or they are lost
+# with ENOBUFS. and seconds to wait for the acks.
+NETLINK_BATCH_ROUTES = 64
+NETLINK_ACK_TIMEOUT = 10
+
+
+def nlattr(kind, data):
+    """
+    returns a netlink attribute of @kind padded to 4 bytes.
+    """
+    attr = struct.pack("=HH", 4 + len(data), kind) + data
+    return attr + b"\0" * (-len(attr) % 4)
+
+
+class IPCmdDataplane(Dataplane):
+    """
+    Dataplane that forks ip command for each operation.
+    """
+
+    def route_batch(self, batch):
+
+        for entry in batch:
+
+            op, prefix, wg_devs, vrf, nhid = entry
+            ipcmd = ([ IPCMD, IPCMD_FAMILY[self.family(prefix)] ] +
+                     self.route_args(op, prefix, wg_devs, vrf, nhid))
+
+            try:
+                with self.command("route_" + op):
+                    subprocess.check_call(ipcmd)
+                self.logger.debug("route: %s", " ".join(ipcmd))
+            except Exception as e:
+                self.route_failed(entry, e)
+
+    def route_dump(self, vrf):
+        return [ (prefix, devs) for prefix, devs, nhid
+                 in self.ipcmd_route_dump(vrf) ]
+
+    def link_add(self, dev, kind):
+        self.ipcmd("link_add", [ "link", "add", dev, "type", kind ])
+        self.owned_links.add(dev)
+
+    def link_del(self, dev):
+        self.ipcmd("link_del", [ "link", "del", "dev", dev ])
+        self.owned_links.discard(dev)
+
+    def link_up(self, dev):
+        self.ipcmd("link_up", [ "link", "set", "dev", dev, "up" ])
+
+    def link_set_master(self, dev, master):
+        self.ipcmd("link_set_master",
+                   [ "link", "set", "dev", dev, "master", master ])
+
+
+class NetlinkDataplane(Dataplane):
+    """
+    Dataplane that programs links and routes through netlink sockets
+    kept open during the lifetime of the process. Route messages of a
+    batch are written to the socket by a single send(), and their acks
+    are read after that. The sockets are used by one thread at a time.
+    """
+
+    def __init__(self, workers = 1, metrics = None, logger = None):
+        super().__init__(workers = workers, metrics = metrics,
+                         logger = logger)
+        self.ipr = IPRoute()
+        self.ifindex_cache = {}
+        self.vrf_table_cache = {}
+
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  socket.NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.sock.settimeout(NETLINK_ACK_TIMEOUT)
+        self.seq = 0
+
+    def close(self):
+        super().close()
+        self.ipr.close()
+        self.sock.close()
+
+    def ifindex(self, dev):
+        with self.lock:
+            if not dev in self.ifindex_cache:
+                idx = self.ipr.link_lookup(ifname = dev)
+                if not idx:
+                    raise RuntimeError("no such device {}".format(dev))
+                self.ifindex_cache[dev] = idx[0]
+            return self.ifindex_cache[dev]
+
+    def vrf_table(self, vrf):
+        with self.lock:
+            if not vrf in self.vrf_table_cache:
+                link = self.ipr.get_links(self.ifindex(vrf))[0]
+                data = (link.get_attr("IFLA_LINKINFO")
+                        .get_attr("IFLA_INFO_DATA"))
+                self.vrf_table_cache[vrf] = data.get_attr("IFLA_VRF_TABLE")
+            return self.vrf_table_cache[vrf]
+
+    def forget_ifindex(self, devs):
+        """
+        drop cached ifindexes of @devs, which are looked up again,
+        e.g., after the devices are re-created by others.
+        """
+        with self.lock:
+            for dev in devs:
+                self.ifindex_cache.pop(dev, None)
+                self.vrf_table_cache.pop(dev, None)
+
+    def route_batch(self, batch):
+
+        # routes rejected for stale ifindexes are sent again
+        stale = []
+        self.route_program(batch, stale)
+        if stale:
+            for op, prefix, wg_devs, vrf, nhid in stale:
+                self.forget_ifindex(list(wg_devs) + [ vrf ])
+            self.route_program(stale, None)
+
+    def route_program(self, batch, stale):
+
+        msgs = []
+        for entry in batch:
+            try:
+                self.seq += 1
+                msg = self.route_msg(self.seq, *entry)
+            except Exception as e:
+                self.route_failed(entry, e)
+                continue
+
+            msgs.append((self.seq, entry, msg))
+            if len(msgs) >= NETLINK_BATCH_ROUTES:
+                self.route_send(msgs, stale)
+                msgs = []
+
+        if msgs:
+            self.route_send(msgs, stale)
+
+    def route_msg(self, seq, op, prefix, wg_devs, vrf, nhid):
+        """
+        returns RTM_NEWROUTE or RTM_DELROUTE message of a route
+        operation with sequence number @seq.
+        """
+
+        family = self.family(prefix)
+        network = ipaddress.ip_network(prefix)
+        table = self.vrf_table(vrf) if vrf else RT_TABLE_MAIN
+
+        attrs = (nlattr(RTA_DST, network.network_address.packed) +
+                 nlattr(RTA_TABLE, struct.pack("=I", table)))
+
+        if op == "del":
+            # routes added by others, e.g., ip command, may have
+            # another scope. RT_SCOPE_NOWHERE matches any scope.
+            kind, flags = RTM_DELROUTE, 0
+            proto, scope, rtype = 0, RT_SCOPE_NOWHERE, 0
+        else:
+            kind = RTM_NEWROUTE
+            flags = NLM_F_CREATE | (NLM_F_EXCL if op == "add" else
+                                    NLM_F_REPLACE)
+            proto, scope, rtype = RTPROT_STATIC, 0, RTN_UNICAST
+
+            if nhid:
+                attrs += nlattr(RTA_NH_ID, struct.pack("=I", nhid))
+            elif len(wg_devs) == 1:
+                oif = self.ifindex(wg_devs[0])
+                attrs += nlattr(RTA_OIF, struct.pack("=i", oif))
+            else:
+                gateway = b""
+                if family == socket.AF_INET6:
+                    gateway = nlattr(RTA_GATEWAY, ipaddress.ip_address(
+                        IPV6_ECMP_GATEWAY).packed)
+                nexthops = [ struct.pack("=HBBi", 8 + len(gateway), 0, 0,
+                                         self.ifindex(wg_dev)) + gateway
+                             for wg_dev in wg_devs ]
+                attrs += nlattr(RTA_MULTIPATH, b"".join(nexthops))
+
+        rtm = struct.pack("=BBBBBBBBI", family, network.prefixlen, 0, 0,
+                          table if table < 256 else 0,
+                          proto, scope, rtype, 0)
+        header = struct.pack("=IHHII", 16 + len(rtm) + len(attrs), kind,
+                             NLM_F_REQUEST | NLM_F_ACK | flags, seq, 0)
+        return header + rtm + attrs
+
+    def route_send(self, msgs, stale = None):
+        """
+        write route messages @msgs, list of (seq, entry, message), by a
+        single send(), and read their acks. entries failed with ENODEV
+        or EINVAL are appended to @stale if it is not None.
+        """
+
+        pending = dict([ (seq, entry) for seq, entry, msg in msgs ])
+        try:
+            with self.command("route_batch"):
+                self.sock.send(b"".join([ msg for seq, entry, msg in msgs ]))
+                while pending:
+                    self.route_ack(self.sock.recv(65536),
+                                   pending, stale)
+        except Exception as e:
+            # e.g., timeout. acks of the remaining routes are lost.
+            for entry in pending.values():
+                self.route_failed(entry, e)
+
+    def route_ack(self, data, pending, stale = None):
+        offset = 0
+        while offset + 20 <= len(data):
+            length, kind, flags, seq = struct.unpack_from("=IHHI", data,
+                                                          offset)
+            entry = pending.pop(seq, None)
+            if kind == NLMSG_ERROR and entry:
+                error = struct.unpack_from("=i", data, offset + 16)[0]
+                if -error in STALE_IFINDEX_ERRORS and stale is not None:
+                    stale.append(entry)
+                elif error:
+                    self.route_failed(entry, os.strerror(-error))
+                else:
+                    self.logger.debug("route: %s %s dev %s vrf %s",
+                                      entry[0], entry[1],
+                                      ",".join(entry[2]), entry[3])
+            offset += (length + 3) & ~3
+
+    def route_dump(self, vrf):
+
+        self.flush()
+        table = self.vrf_table(vrf) if vrf else RT_TABLE_MAIN
+        with self.lock:
+            names = dict([ (link["index"], link.get_attr("IFLA_IFNAME"))
+                           for link in self.ipr.get_links() ])
+            msgs = []
+            for family in (socket.AF_INET, socket.AF_INET6):
+                msgs += self.ipr.get_routes(family = family, table = table)
+
+        routes = []
+        for msg in msgs:
+            dst = msg.get_attr("RTA_DST")
+            if dst is None or msg["proto"] == rt_proto["kernel"]:
+                continue
+            oif = msg.get_attr("RTA_OIF")
+            if oif:
+                devs = [ names.get(oif, "") ]
+            else:
+                devs = [ names.get(nh["oif"], "")
+                         for nh in msg.get_attr("RTA_MULTIPATH") or [] ]
+            routes.append(("{}/{}".format(dst, msg["dst_len"]), devs))
+        return routes
+
+    def link_add(self, dev, kind):
+        self.flush()
+        self.logger.debug("netlink: link add %s type %s", dev, kind)
+        with self.lock, self.command("link_add"):
+            self.ifindex_cache.pop(dev, None)
+            self.ipr.link("add", ifname = dev, kind = kind)
+            self.owned_links.add(dev)
+
+    def link_del(self, dev):
+        self.flush()
+        self.logger.debug("netlink: link del %s", dev)
+        with self.lock, self.command("link_del"):
+            self.link_retry([ dev ], lambda: self.ipr.link(
+                "del", index = self.ifindex(dev)))
+            self.ifindex_cache.pop(dev, None)
+            self.owned_links.discard(dev)
+
+    def link_up(self, dev):
+        self.flush()
+        self.logger.debug("netlink: link set %s up", dev)
+        with self.lock, self.command("link_up"):
+            self.link_retry([ dev ], lambda: self.ipr.link(
+                "set", index = self.ifindex(dev), state = "up"))
+
+    def link_set_master(self, dev, master):
+        self.flush()
+        self.logger.debug("netlink: link set %s master %s", dev, master)
+        with self.lock, self.command("link_set_master"):
+            self.link_retry([ dev, master ], lambda: self.ipr.link(
+                "set", index = self.ifindex(dev),
+                master = self.ifindex(master)))
+
+    def link_retry(self, devs, func):
+        """
+        call @func that programs links by ifindexes of @devs. if it
+        fails for stale ifindexes, e.g., the devices are re-created by
+        others, it is called again with the ifindexes looked up again.
+        """
+        try:
+            return func()
+        except NetlinkError as e:
+            if not e.code in STALE_IFINDEX_ERRORS:
+                raise
+            self.logger.debug("netlink: look up %s again: %s",
+                              ",".join(devs), e)
+        self.forget_ifindex(devs)
+        return func()
+
+
+DATAPLANES = {
+    "ipcmd": IPCmdDataplane,
+    "netlink": NetlinkDataplane,
+}
+
+def create_dataplane(name, workers = 1, metrics = None, logger = None):
+    if not name in DATAPLANES:
+        raise RuntimeError("invalid dataplane '{}', must be one of {}"
+                           .format(name, ", ".join(sorted(DATAPLANES))))
+    return DATAPLANES[name](workers = workers, metrics = metrics,
+                            logger = logger)
@@ -1,10 +1,17 @@
 
-
-
-import re
 import queue
+import select
+import socket
+import struct
+import threading
 import ipaddress
-from pyroute2 import IPDB
+
+from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import (RTM_NEWADDR, RTM_DELADDR,
+                                   RTM_NEWLINK, RTM_DELLINK, RTMGRP_LINK,
+                                   RTMGRP_IPV4_IFADDR, RTMGRP_IPV6_IFADDR)
+from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
 
 
 from logging import getLogger, INFO, StreamHandler
@@ -18,100 +25,222 @@ default_logger.addHandler(syslog)
 default_logger.propagate = False
 
 
-def whichipversion (addr) :
-
-    if re.match (r'^(\d{1,3}\.){3,3}\d{1,3}$', addr)  :
-        return 4
-
-    if re.match (r'((([0-9a-f]{1,4}:){7}([0-9a-f]{1,4}|:))|(([0-9a-f]{1,4}:){6}(:[0-9a-f]{1,4}|((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9a-f]{1,4}:){5}(((:[0-9a-f]{1,4}){1,2})|:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9a-f]{1,4}:){4}(((:[0-9a-f]{1,4}){1,3})|((:[0-9a-f]{1,4})?:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){3}(((:[0-9a-f]{1,4}){1,4})|((:[0-9a-f]{1,4}){0,2}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){2}(((:[0-9a-f]{1,4}){1,5})|((:[0-9a-f]{1,4}){0,3}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){1}(((:[0-9a-f]{1,4}){1,6})|((:[0-9a-f]{1,4}){0,4}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(:(((:[0-9a-f]{1,4}){1,7})|((:[0-9a-f]{1,4}){0,5}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:)))(%.+)?\s*$', addr) :
-        return 6
-
-    return -1
-
+RTM_ACTIONS = {
+    RTM_NEWADDR: "RTM_NEWADDR",
+    RTM_DELADDR: "RTM_DELADDR",
+}
 
 
 class DevTracker(object):
 
     def __init__(self, devlist, logger = None):
+        """
+        DevTracker: tracks addresses assigned to devices
+        @devlist: names of devices to be tracked
+        @logger: logger
+
+        DevTracker receives address and link notifications on a
+        netlink socket, and queues changes of addresses on the tracked
+        devices as messages of "action", "device" and "address"
+        (prefix). Link notifications keep the cache of ifindexes up
+        to date when a device is re-created or renamed.
+        """
         self.devlist = devlist
         self.queue = queue.Queue()
-        self.ipdb = IPDB()
         self.logger = logger or default_logger
-        
 
-    def _get_current(self):
+        # ifindex of tracked devices: key is ifindex, value is name
+        self.ifindexes = {}
 
-        for dev in self.devlist:
+        # ifindexes of devices not tracked
+        self.untracked = set()
 
-            if not dev in self.ipdb.interfaces:
-                continue
+        self.sock = None
+        self.thread = None
+        self.stopped = threading.Event()
 
-            devinfo = self.ipdb.by_name[dev]
+        # set when a message is queued
+        self.changed = threading.Event()
 
-            for addr, preflen in devinfo["ipaddr"]:
-                if whichipversion(addr) == 4:
-                    addr = "{}/{}".format(addr, preflen)
-                    prefix = ipaddress.ip_interface(addr).network
-                    msg = {
-                        "action": "RTM_NEWADDR",
-                        "device": dev,
-                        "address": prefix,
-                        }
-                    self.queue.put(msg)
 
+    def resolve(self, ifindex):
+        """
+        returns name of the tracked device of @ifindex, or None. a
+        tracked device created after start() is resolved here.
+        """
 
-    def start(self):
+        if ifindex in self.ifindexes:
+            return self.ifindexes[ifindex]
 
-        self.logger.debug("start to track devices: %s", " ".join(self.devlist))
+        if ifindex in self.untracked:
+            return None
 
-        self._get_current()
+        try:
+            dev = socket.if_indextoname(ifindex)
+        except OSError:
+            # deleted after the message was sent
+            return None
+
+        if not dev in self.devlist:
+            self.untracked.add(ifindex)
+            return None
 
-        def ipdb_callback(ipdb, msg, action):
-            
-            if not action in ("RTM_NEWADDR", "RTM_DELADDR"):
-                return
+        self.track(ifindex, dev)
+        return dev
 
-            if msg["family"] != 2:
-                # XXX: IPv4 only :(
-                return
 
+    def track(self, ifindex, dev):
+        # the device may be re-created with another ifindex
+        for idx in [ i for i, d in self.ifindexes.items() if d == dev ]:
+            del self.ifindexes[idx]
+        self.ifindexes[ifindex] = dev
+        self.untracked.discard(ifindex)
 
-            tracked_dev = None
-            tracked_dev_addr = None
-            for attr in msg["attrs"]:
-                if attr[0] == "IFA_LABEL" and attr[1] in self.devlist:
-                    tracked_dev = attr[1]
-                elif attr[0] == "IFA_ADDRESS":
-                    tracked_dev_addr = attr[1]
 
-            if not tracked_dev or not tracked_dev_addr:
-                return
+    def handle_link(self, msgtype, msg):
+        """
+        update the cache of ifindexes for a link created, changed,
+        e.g., renamed, or deleted. addresses of a deleted device are
+        notified before the link, and they are resolved by the cache.
+        """
 
-            addr = "{}/{}".format(tracked_dev_addr, msg["prefixlen"])
-            prefix = ipaddress.ip_interface(addr).network
+        ifindex = msg["index"]
+        dev = msg.get_attr("IFLA_IFNAME")
+        if msgtype == RTM_DELLINK or not dev:
+            self.ifindexes.pop(ifindex, None)
+            self.untracked.discard(ifindex)
+        elif dev in self.devlist:
+            self.track(ifindex, dev)
+        else:
+            self.ifindexes.pop(ifindex, None)
+            self.untracked.add(ifindex)
 
-            msg = {
-                "action": action,
-                "device": tracked_dev,
-                "address": prefix,
-            }
 
-            try:
-                self.logger.debug("device addr change: %s", str(msg))
-                self.queue.put(msg)
-            except queue.Full:
-                self.logger.error("devtracker queue full for msg %s", str(msg))
+    def handle_msg(self, action, msg):
 
+        dev = self.resolve(msg["index"])
+        if not dev:
+            return
+
+        addr = msg.get_attr("IFA_LOCAL") or msg.get_attr("IFA_ADDRESS")
+        if not addr:
+            return
+
+        prefix = ipaddress.ip_interface("{}/{}".format(addr, msg["prefixlen"]))
+        prefix = prefix.network
+        if prefix.version == 6 and prefix.is_link_local:
+            # link-local addresses are not routable through wg
+            return
+
+        msg = {
+            "action": action,
+            "device": dev,
+            "address": prefix,
+        }
+
+        self.logger.debug("device addr change: %s", str(msg))
+        self.queue.put(msg)
+        self.changed.set()
+
+
+    def _get_current(self):
+
+        with IPRoute() as ipr:
+            for dev in self.devlist:
+                try:
+                    ifindex = socket.if_nametoindex(dev)
+                except OSError:
+                    continue
+                self.ifindexes[ifindex] = dev
+                for msg in ipr.get_addr(index = ifindex):
+                    self.handle_msg("RTM_NEWADDR", msg)
+
+
+    def start(self, thread = True):
+        """
+        @thread: if False, no receiver thread is started. the owner
+        must call read() when the socket (self.sock) is readable.
+        """
+
+        self.logger.debug("start to track devices: %s", " ".join(self.devlist))
+
+        # subscribe before dumping current addresses so that no change
+        # is lost between them.
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_LINK |
+                        RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+
+        self._get_current()
+
+        if thread:
+            self.thread = threading.Thread(target = self.receive,
+                                           daemon = True)
+            self.thread.start()
+
+
+    def receive(self):
+
+        while not self.stopped.is_set():
+            r, w, x = select.select([ self.sock ], [], [], 1)
+            if r:
+                self.read()
+
+
+    def read(self):
+        """
+        receive netlink messages on the socket and queue address
+        changes of the tracked devices.
+        """
+
+        try:
+            data = self.sock.recv(65536)
+        except OSError as e:
+            self.logger.error("devtracker recv failed: %s", e)
+            return
+
+        offset = 0
+        while offset + 6 <= len(data):
+            length, msgtype = struct.unpack_from("=IH", data, offset)
+            if length < 16:
+                break
+            if msgtype in RTM_ACTIONS:
+                msg = ifaddrmsg(data[offset:offset + length])
+                msg.decode()
+                self.handle_msg(RTM_ACTIONS[msgtype], msg)
+            elif msgtype in (RTM_NEWLINK, RTM_DELLINK):
+                msg = ifinfmsg(data[offset:offset + length])
+                msg.decode()
+                self.handle_link(msgtype, msg)
+            # netlink messages are aligned to 4 bytes
+            offset += (length + 3) & ~3
 
-        self.cbid = self.ipdb.register_callback(ipdb_callback)
 
-        
     def stop(self):
-        self.ipdb.unregister_callback(self.cbid)
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.sock:
+            self.sock.close()
+        # wake up waiters
+        self.changed.set()
+
+    def wait(self, timeout = None):
+        """
+        block until a message is queued or @timeout (sec) elapses.
+        returns True if a message was queued since the last wait().
+        messages queued after wait() returns wake up the next wait().
+        """
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+        return changed
 
     def queued(self):
         return (not self.queue.empty())
 
+    def qsize(self):
+        return self.queue.qsize()
+
     def pop(self):
         try:
             return self.queue.get(block = False)
@@ -0,0 +1,291 @@
+
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+import etcd3
+
+if not "amesh." in __name__:
+    from static import ETCD_LEASE_KEEPALIVE
+else:
+    from amesh.static import ETCD_LEASE_KEEPALIVE
+
+
+from logging import getLogger, INFO, StreamHandler
+from logging.handlers import SysLogHandler
+default_logger = getLogger(__name__)
+default_logger.setLevel(INFO)
+stream = StreamHandler()
+syslog = SysLogHandler(address = "/dev/log")
+default_logger.addHandler(stream)
+default_logger.addHandler(syslog)
+default_logger.propagate = False
+
+
+class AsyncioEngine(object):
+
+    def __init__(self, amesh, logger = None):
+        """
+        AsyncioEngine: runs the control plane of Amesh on an asyncio
+        event loop instead of the maintainer and watcher threads.
+        @amesh: Amesh to be run
+        @logger: logger
+
+        The etcd watch stream, lease keepalive, and address changes
+        on tracked devices are tasks on a single event loop. Blocking
+        etcd requests run on the etcd worker thread, and node table
+        and Fib updates, reconciliation and liveness checks, which
+        program the dataplane, run on the fib worker thread. Thus,
+        watch responses are received and coalesced into the next batch
+        while the dataplane is being programmed, and lease keepalive
+        and address publishing never wait for the dataplane.
+        """
+
+        self.amesh = amesh
+        self.logger = logger or default_logger
+
+        self.loop = None
+        self.task = None
+        self.cancelled = False
+
+        self.etcd_executor = None
+        self.fib_executor = None
+
+        # set when DevTracker queued address changes
+        self.addresses = None
+
+
+    def run(self):
+        """
+        run the engine until cancel() is called.
+        """
+        asyncio.run(self.main())
+
+
+    def cancel(self):
+        """
+        cancel all the tasks. this can be called from any thread.
+        """
+        self.cancelled = True
+        if self.loop and self.task:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+
+    async def main(self):
+
+        self.loop = asyncio.get_running_loop()
+        self.etcd_executor = ThreadPoolExecutor(max_workers = 1,
+                                                thread_name_prefix = "etcd")
+        self.fib_executor = ThreadPoolExecutor(max_workers = 1,
+                                               thread_name_prefix = "fib")
+        self.addresses = asyncio.Event()
+
+        devtracker = self.amesh.devtracker
+        self.loop.add_reader(devtracker.sock, self.read_addresses)
+
+        tasks = [
+            asyncio.ensure_future(self.lease_keeper()),
+            asyncio.ensure_future(self.address_publisher()),
+            asyncio.ensure_future(self.watcher()),
+            asyncio.ensure_future(self.reconciler()),
+        ]
+        if self.amesh.liveness:
+            tasks.append(asyncio.ensure_future(self.liveness()))
+        self.task = asyncio.gather(*tasks)
+        if self.cancelled:
+            self.task.cancel()
+
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.error("asyncio engine failed: %s", e)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            self.loop.remove_reader(devtracker.sock)
+            self.etcd_executor.shutdown()
+            self.fib_executor.shutdown()
+
+
+    async def run_etcd(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            self.etcd_executor, functools.partial(func, *args, **kwargs))
+
+
+    async def run_fib(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            self.fib_executor, functools.partial(func, *args, **kwargs))
+
+
+    def read_addresses(self):
+        devtracker = self.amesh.devtracker
+        devtracker.read()
+        if devtracker.queued():
+            self.addresses.set()
+
+
+    async def lease_keeper(self):
+
+        a = self.amesh
+        connected = True
+
+        while True:
+            try:
+                await self.run_etcd(a.etcd_lease_allocate)
+                await self.run_etcd(a.etcd_register)
+
+                connected = True
+                self.logger.info("etcd maintainer connected to %s",
+                                 a.etcd_endpoint)
+
+                while True:
+                    await asyncio.sleep(ETCD_LEASE_KEEPALIVE)
+                    await self.run_etcd(a.etcd_lease_refresh)
+
+            except etcd3.exceptions.Etcd3Exception as e:
+                if connected:
+                    self.logger.error("etcd maintainer failed: %s",
+                                      e.__class__)
+                    connected = False
+                await self.run_etcd(a.etcd_check)
+                await asyncio.sleep(1)
+
+
+    async def address_publisher(self):
+
+        a = self.amesh
+
+        while True:
+            await self.addresses.wait()
+
+            # wait for successive changes, e.g., addresses assigned
+            # by a script one by one.
+            await asyncio.sleep(a.address_debounce)
+            self.addresses.clear()
+
+            try:
+                await self.run_etcd(a.handle_devtracker)
+            except etcd3.exceptions.Etcd3Exception as e:
+                # addresses are already applied to self node. they are
+                # published by the next etcd_register().
+                self.logger.error("failed to publish addresses: %s",
+                                  e.__class__)
+                await asyncio.sleep(1)
+                self.addresses.set()
+
+
+    async def watcher(self):
+
+        a = self.amesh
+        connected = True
+
+        while True:
+
+            etcd = None
+            watch_ids = []
+
+            try:
+                if a.etcd_revision is None:
+                    # no revision to resume from. obtain a snapshot
+                    await self.run_fib(a.etcd_obtain)
+                else:
+                    a.m_watch_resumes.inc()
+                    self.logger.info("resume etcd watch from revision %d",
+                                     a.etcd_revision + 1)
+
+                etcd = await self.run_etcd(a.etcd_client)
+
+                # watch responses are passed from the etcd3 watcher
+                # thread to this loop.
+                responses = asyncio.Queue()
+                put = functools.partial(self.loop.call_soon_threadsafe,
+                                        responses.put_nowait)
+                watch_ids = await self.run_etcd(a.etcd_add_watches,
+                                                etcd, put)
+
+                if not connected:
+                    a.m_watch_reconnects.inc()
+                connected = True
+                self.logger.info("etcd watch connected to %s",
+                                 a.etcd_endpoint)
+
+                while True:
+                    events = await self.watch_batch(responses)
+                    await self.run_fib(a.process_etcd_events, events)
+
+            except etcd3.exceptions.RevisionCompactedError as e:
+                # events after the revision are no longer available.
+                # fall back to a snapshot.
+                self.logger.info("etcd revision %d is compacted, resync",
+                                 a.etcd_revision)
+                a.etcd_revision = None
+
+            except etcd3.exceptions.Etcd3Exception as e:
+                if connected:
+                    self.logger.error("etcd watch failed: %s", e.__class__)
+                    connected = False
+
+                await self.run_etcd(a.etcd_check)
+                await asyncio.sleep(1)
+
+            finally:
+                # cancel_watch() waits for the lock of the etcd3
+                # watcher and sends a request, which must not block
+                # the event loop.
+                for watch_id in watch_ids:
+                    try:
+                        await self.run_etcd(etcd.cancel_watch, watch_id)
+                    except Exception as e:
+                        self.logger.debug("failed to cancel watch: %s", e)
+
+
+    async def reconciler(self):
+
+        a = self.amesh
+
+        while True:
+            await asyncio.sleep(a.reconcile_check)
+            await self.run_fib(a.reconcile)
+
+
+    async def liveness(self):
+
+        a = self.amesh
+
+        while True:
+            await asyncio.sleep(a.failover_interval)
+            await self.run_fib(a.check_liveness)
+
+
+    async def watch_batch(self, responses):
+        """
+        wait for watch events, and returns events arrived within the
+        coalescing window or up to the max batch size. responses
+        queued while the previous batch is processed are returned
+        without waiting.
+        """
+
+        a = self.amesh
+        events = []
+        response = await responses.get()
+        deadline = self.loop.time() + a.watch_coalesce_window
+
+        while True:
+            events += a.etcd_watch_events(response)
+            if len(events) >= a.watch_coalesce_max_batch:
+                break
+
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                response = await asyncio.wait_for(responses.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+        return events
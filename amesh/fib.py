@@ -1,14 +1,14 @@
 
-import os
-import subprocess
-import uuid
+import sys
+import functools
+import ipaddress
 
 if not "amesh." in __name__:
-    from node import Node
-    from static import WGCMD, IPCMD
+    from node import Node, NodeTable
+    from prefixtree import PrefixTree
 else:
-    from amesh.node import Node
-    from amesh.static import WGCMD, IPCMD
+    from amesh.node import Node, NodeTable
+    from amesh.prefixtree import PrefixTree
 
 from logging import getLogger, INFO, StreamHandler
 from logging.handlers import SysLogHandler
@@ -20,267 +20,353 @@ default_logger.addHandler(stream)
 default_logger.addHandler(syslog)
 default_logger.propagate = False
 
+# kinds of differences between Fib and the dataplane found by
+# Fib.reconcile()
+DRIFT_KINDS = ("links_extra", "peers_extra", "peers_changed",
+               "peers_missing", "nexthops", "routes_extra",
+               "routes_changed", "routes_missing")
+
+
 class Peer(object):
 
-    def __init__(self, wg_dev, node, vrf, outbound = False,
+    __slots__ = ("wg_dev", "outbound", "shared", "vrf", "pubkey",
+                 "endpoint", "allowed_ips", "keepalive", "prvkey_path",
+                 "logger", "ident", "key", "hash")
+
+    def __init__(self, wg_dev, node, vrf, outbound = False, shared = False,
                  prvkey_path = None, logger = None):
         """
-        Peer:
+        Peer: immutable value object of a wg peer
         @wg_dev: wireugard device name for this peer
         @vrf: VRF to which wg dev of this peer belong
         @node: Node class for this peer
         @outbound: Peer for incomming connection or not
+        @shared: outbound Peer on the device shared by servers
         @prvkey_path: private key path for egress wg device for this peer
         @logger: logger
         """
 
-        self.wg_dev = wg_dev
-        self.outbound = outbound
-        self.vrf = vrf
+        setattr = super().__setattr__
 
-        self.pubkey = node.pubkey
-        self.endpoint = node.endpoint
-        self.allowed_ips = node.allowed_ips
-        self.keepalive = node.keepalive
+        setattr("wg_dev", wg_dev)
+        setattr("outbound", outbound)
+        setattr("shared", shared)
+        setattr("vrf", vrf)
 
-        self.prvkey_path = prvkey_path
+        setattr("pubkey", node.pubkey)
+        setattr("endpoint", node.endpoint)
+        setattr("allowed_ips", frozenset(node.allowed_ips))
+        setattr("keepalive", node.keepalive)
 
-        self.logger = logger or default_logger
+        setattr("prvkey_path", prvkey_path)
 
-    def __str__(self):
+        setattr("logger", logger or default_logger)
 
-        return ("<Peer: hash={} pubkey={} endpoint={} allowed-ips={}>"
-                .format(self.__hash__(),
-                        self.pubkey, self.endpoint, self.allowed_ips))
-
-    def __eq__(self, other):
+        # identity of this peer on the dataplane. peers with the same
+        # identity can be updated in place.
+        setattr("ident", (self.wg_dev, self.pubkey))
 
-        return (self.wg_dev == other.wg_dev and
-                self.outbound == other.outbound and
-                self.pubkey == other.pubkey and
-                self.endpoint == other.endpoint and
-                self.allowed_ips == other.allowed_ips and
-                self.keepalive == self.keepalive)
+        # key for equality and hash. prefixes are compared as strings
+        # because hash and equality of ip_network are slow python code.
+        setattr("key", (self.wg_dev, self.outbound, self.pubkey,
+                        self.endpoint, frozenset(map(str, self.allowed_ips)),
+                        self.keepalive))
+        setattr("hash", hash(self.key))
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def __setattr__(self, name, value):
+        raise AttributeError("Peer is immutable")
 
-    def __hash__(self):
-        return int(uuid.uuid5(uuid.NAMESPACE_DNS,
-                              "{}{}{}{}{}{}".format(self.wg_dev,
-                                                      self.outbound,
-                                                      self.pubkey,
-                                                      self.endpoint,
-                                                      self.allowed_ips,
-                                                      self.keepalive)))
+    def __str__(self):
 
-    def install(self):
+        return ("<Peer: hash={} pubkey={} endpoint={} allowed-ips={}>"
+                .format(self.hash, self.pubkey, self.endpoint,
+                        ",".join(sorted(map(str, self.allowed_ips)))))
 
-        if not self.pubkey:
-            return
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Peer):
+            return NotImplemented
+        return self.key == other.key
 
-        cmds = []
-
-        if self.outbound:
-            # this peer is an oubbound peer for a server (it has an endpoint).
-            # thus, create the wg device and use it for egress connections
-            if os.path.exists("/sys/class/net/{}".format(self.wg_dev)):
-                cmds.append([ IPCMD, "link", "del", "dev", self.wg_dev ])
-            cmds += [
-                [ IPCMD, "link", "add", self.wg_dev, "type", "wireguard" ],
-                [ IPCMD, "link", "set", "dev", self.wg_dev, "up" ],
-                [ WGCMD , "set", self.wg_dev, "private-key", self.prvkey_path ]
-            ]
+    def __hash__(self):
+        return self.hash
 
-        if self.vrf:
-            cmds += [
-                [ IPCMD, "link", "set", "dev", self.wg_dev,
-                  "master", self.vrf ]
-            ]
+    def wg_config(self):
+        """
+        returns [Peer] section of wireguard config for this peer.
+        """
 
-        wgcmd = [ WGCMD, "set", self.wg_dev, "peer", self.pubkey ]
+        lines = [ "[Peer]", "PublicKey = {}".format(self.pubkey) ]
         if self.endpoint:
-            wgcmd += [ "endpoint", self.endpoint ]
+            lines.append("Endpoint = {}".format(self.endpoint))
         if self.allowed_ips:
-            wgcmd += [ "allowed-ips", ",".join(map(str, self.allowed_ips)) ]
+            lines.append("AllowedIPs = {}"
+                         .format(", ".join(map(str, self.allowed_ips))))
         if self.keepalive:
-            wgcmd += [ "persistent-keepalive", str(self.keepalive) ]
+            lines.append("PersistentKeepalive = {}".format(self.keepalive))
 
-        cmds.append(wgcmd)
+        return "\n".join(lines) + "\n"
 
-        self.logger.debug("install peer: %s", " ".join(map(str, cmds)))
-        for cmd in cmds:
-            try:
-                subprocess.check_call(map(str, cmd))
-            except Exception as e:
-                self.logger.error("failed to install peer: %s", " ".join(cmd))
 
+    def wg_update_args(self, old):
+        """
+        returns 'wg set' arguments that update @old peer, which has
+        the same identity, to this peer, or [] if nothing is to be set.
+        'wg set' cannot unset an endpoint, so that an outbound peer
+        losing its endpoint is removed and added again. endpoints of
+        inbound peers roam, and a lost one is left as it is.
+        """
 
-    def uninstall(self):
+        if self.outbound and old.endpoint and not self.endpoint:
+            args = [ "peer", self.pubkey, "remove", "peer", self.pubkey ]
+            if self.allowed_ips:
+                args += [ "allowed-ips",
+                          ",".join(sorted(map(str, self.allowed_ips))) ]
+            if self.keepalive:
+                args += [ "persistent-keepalive", str(self.keepalive) ]
+            return args
+
+        args = []
+        if self.endpoint and self.endpoint != old.endpoint:
+            args += [ "endpoint", self.endpoint ]
+        if self.allowed_ips != old.allowed_ips:
+            args += [ "allowed-ips",
+                      ",".join(sorted(map(str, self.allowed_ips))) ]
+        if self.keepalive != old.keepalive:
+            args += [ "persistent-keepalive", str(self.keepalive) ]
+
+        if not args:
+            return []
+        return [ "peer", self.pubkey ] + args
+
+
+    def dedicated(self):
+        """
+        returns True if this peer has its own outbound wg device.
+        """
+        return self.outbound and not self.shared
+
+
+    def install_link(self, dataplane):
+        """
+        create the wg device for this peer if this peer has a dedicated
+        outbound device. peer itself is configured through
+        Fib.install_peers().
+        """
 
-        if not self.pubkey:
+        if not self.dedicated():
             return
 
-        cmds = [
-            [ WGCMD, "set", self.wg_dev, "peer", self.pubkey, "remove" ],
+        ops = []
+
+        # this peer is an oubbound peer for a server (it has an endpoint).
+        # thus, create the wg device and use it for egress connections
+        if dataplane.link_exists(self.wg_dev):
+            ops.append((dataplane.link_del, self.wg_dev))
+        ops += [
+            (dataplane.link_add, self.wg_dev, "wireguard"),
+            (dataplane.link_up, self.wg_dev),
+            (dataplane.wg_set, self.wg_dev,
+             [ "private-key", self.prvkey_path ]),
         ]
 
-        if self.outbound:
-            # this peer is an oubbound peer for a server (it has an endpoint).
-            # thus, remove the outbound wg device.
-            cmds.append([ IPCMD, "link", "del", "dev", self.wg_dev])
+        if self.vrf:
+            ops.append((dataplane.link_set_master, self.wg_dev, self.vrf))
 
-        self.logger.debug("uninstall peer: %s", " ".join(map(str, cmds)))
-        for cmd in cmds:
+        for op in ops:
             try:
-                subprocess.check_call(map(str, cmd))
+                op[0](*op[1:])
             except Exception as e:
-                self.logger.error("failed to uninstall peer: \n%s",
-                                  " ".join(cmd))
+                self.logger.error("failed to install peer: %s %s: %s",
+                                  op[0].__name__,
+                                  " ".join(map(str, op[1:])), e)
+                dataplane.fail("peers_missing", ("peer",) + self.ident)
 
 
-class Route(object):
+    def uninstall_link(self, dataplane):
+        """
+        remove the wg device for this peer if this peer has a dedicated
+        outbound device.
+        """
 
-    def __init__(self, wg_dev, prefix, vrf, logger = None):
-        self.wg_devs = [ wg_dev ]
-        self.prefix = str(prefix)
-        self.vrf = vrf
-        self.logger = logger or default_logger
+        if not self.dedicated():
+            return
 
-        self.removed = False
-        # removed is a flag that indicates this route will be removed
-        # because of peer is uninstalled (and wg device is removed).
-        # this flag changes hash of this object, so that
-        # the same route in new FIB will be installed.
+        # this peer is an oubbound peer for a server (it has an endpoint).
+        # thus, remove the outbound wg device. peer is also removed.
+        try:
+            dataplane.link_del(self.wg_dev)
+        except Exception as e:
+            self.logger.error("failed to uninstall peer: link_del %s: %s",
+                              self.wg_dev, e)
+            dataplane.fail("links_extra", ("link", self.wg_dev))
 
-    def __str__(self):
-        return "<Route hash={} prefix={} dev={}>".format(self.__hash__(),
-                                                         self.prefix,
-                                                         self.wg_devs)
 
-    def __eq__(self, other):
-        return (self.wg_devs == other.wg_devs and
-                self.prefix == other.prefix and
-                self.removed == other.removed)
+class Route(object):
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    __slots__ = ("wg_devs", "prefix", "vrf", "logger", "key", "hash")
 
-    def __hash__(self):
-        return int(uuid.uuid5(uuid.NAMESPACE_DNS,
-                              "{}{}{}".format(self.wg_devs, self.prefix,
-                                              self.removed)))
+    def __init__(self, wg_devs, prefix, vrf, logger = None):
+        """
+        Route: immutable value object of a route
+        @wg_devs: list of nexthop wg devices
+        @prefix: destination prefix
+        @vrf: VRF to which this route belongs
+        @logger: logger
+        """
 
-    def append_nexthop_dev(self, wg_dev):
-        if wg_dev in self.wg_devs:
-            return
-        self.wg_devs.append(wg_dev)
+        setattr = super().__setattr__
 
-    def check_dev(self, wg_dev):
-        return (wg_dev in self.wg_devs)
+        # strings are interned, so that keys of equal routes built by
+        # different Fibs compare by identity.
+        setattr("wg_devs", tuple(map(sys.intern, wg_devs)))
+        setattr("prefix", sys.intern(str(prefix)))
+        setattr("vrf", vrf)
+        setattr("logger", logger or default_logger)
 
-    def make_this_removed(self):
-        self.removed = True
+        # key for equality and hash. a flat tuple starting with the
+        # prefix, which differs first between routes.
+        setattr("key", (self.prefix,) + self.wg_devs)
+        setattr("hash", hash(self.key))
 
-    def install(self):
+    def __setattr__(self, name, value):
+        raise AttributeError("Route is immutable")
 
-        ipcmd = [ IPCMD, "route", "add", "to", self.prefix ]
+    def __str__(self):
+        return "<Route hash={} prefix={} dev={}>".format(self.hash,
+                                                         self.prefix,
+                                                         self.wg_devs)
 
-        if self.vrf:
-            ipcmd += [ "vrf", self.vrf ]
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Route):
+            return NotImplemented
+        return self.key == other.key
 
-        for wg_dev in self.wg_devs:
-            ipcmd += [ "nexthop", "dev", wg_dev ]
+    def __hash__(self):
+        return self.hash
 
-        try:
-            subprocess.check_call(ipcmd)
-            self.logger.debug("install route: %s", " ".join(ipcmd))
-        except Exception as e:
-            self.logger.error("failed to install route: %s", " ".join(ipcmd))
+    def check_dev(self, wg_dev):
+        return (wg_dev in self.wg_devs)
 
-    def uninstall(self):
+    def install(self, dataplane, nhid = None):
+        self.logger.debug("install route: %s", str(self))
+        dataplane.route("add", self.prefix, self.wg_devs, self.vrf,
+                        nhid = nhid)
 
-        ipcmd = [ IPCMD, "route", "del", "to", self.prefix ]
-        if self.vrf:
-            ipcmd += [ "vrf", self.vrf ]
+    def replace(self, dataplane, nhid = None):
+        self.logger.debug("replace route: %s", str(self))
+        dataplane.route("replace", self.prefix, self.wg_devs, self.vrf,
+                        nhid = nhid)
 
-        try:
-            subprocess.check_call(ipcmd)
-            self.logger.debug("uninstall route: %s", " ".join(ipcmd))
-        except Exception as e:
-            self.logger.error("failed to uninstall route: %s", " ".join(ipcmd))
+    def uninstall(self, dataplane):
+        self.logger.debug("uninstall route: %s", str(self))
+        dataplane.route("del", self.prefix, self.wg_devs, self.vrf)
 
 
 
 class Fib(object):
 
     def __init__(self, wg_dev, self_node, node_table, prvkey_path, vrf,
-                 logger = None):
+                 dataplane = None, aggregate = False, shared_dev = None,
+                 nexthop_table = None, down_devs = None, logger = None):
         """
         Fib:
         @wg_dev: wg device for incomming connections
         @self_node: Node describing self (check my groups and ednpoints)
-        @node_table: dict of Node instances
+        @node_table: NodeTable or dict of Node instances
         @prvkey_path: wireguard private key path
         @vrf: VRF to which wg and router belong
+        @dataplane: Dataplane to install peers and routes
+        @aggregate: install contiguous prefixes with the same nexthops
+                    as an aggregated route
+        @shared_dev: wg device shared by outbound peers for servers. if
+                     None, each server has a dedicated wg device.
+        @nexthop_table: NexthopTable of nexthop groups that routes refer
+                        to. if None, routes have nexthops inline.
+        @down_devs: wg devices withdrawn from nexthops of routes that
+                    have other nexthops, e.g., unresponsive servers.
+
+        Fib can be updated incrementally by update_nodes(), which
+        recomputes only peers and routes of the specified nodes.
         """
 
         self.wg_dev = wg_dev
+        self.self_node = self_node
         self.groups = self_node.groups
         self.vrf = vrf
         self.peers = set()
         self.routes = set()
+
+        # routes_dict: key is prefix, value is Route
         self.routes_dict = {}
 
-        # prvkey for dedicated wg devices for outbound conncetions
-        self.prvkey_path = prvkey_path
+        # dev_routes: key is wg device, value is set of prefixes
+        # of the routes using the device as a nexthop
+        self.dev_routes = {}
 
-        self.logger = logger or default_logger
+        # per node entries.
+        # node_peers: key is node_id, value is list of Peers of the node
+        # node_routes: key is node_id, value is (wg_dev, prefixes)
+        self.node_peers = {}
+        self.node_routes = {}
 
-        # calculate wg peers and allowed-ips as routes from node_table
-        for node_id, node in node_table.items():
+        # nexthops: key is prefix, value is dict of nexthop wg device
+        # and the number of nodes using the device for the prefix
+        self.nexthops = {}
 
-            if not node.pubkey:
-                continue
+        # prefix_tree: radix tree of the prefixes in nexthops. values
+        # are the same dicts as nexthops.
+        self.prefix_tree = PrefixTree()
+        self.aggregate = aggregate
 
-            if not node.endpoint and not self_node.endpoint:
-                # Both self and this node DO NOT have endpoints.
-                # Thus, we are client mode, and do not install routes.
-                continue
+        # prvkey for dedicated wg devices for outbound conncetions
+        self.prvkey_path = prvkey_path
 
-            if not self.check_group(node):
-                # group does not match
-                continue
+        # shared outbound device. a wg device cannot have the same
+        # allowed-ip on multiple peers, so that servers advertising
+        # the same prefix (ECMP) still have dedicated devices.
+        # server_prefixes: key is node_id of a server, value is prefixes
+        # prefix_servers: key is prefix, value is set of server node_ids
+        self.shared_dev = shared_dev
+        self.server_prefixes = {}
+        self.prefix_servers = {}
 
+        self.nexthop_table = nexthop_table
 
-            wg_dev = self.wg_dev
+        # wg devices excluded from nexthops unless they are the last
+        # nexthops of a prefix. see set_down_devs().
+        self.down_devs = set(down_devs or ())
 
-            # Peer for outbound connection if the node is a server
-            if node.endpoint:
-                wg_dev = "wg-{}".format(node.pubkey)[:13]
-                self.peers.add(Peer(wg_dev, node, self.vrf,
-                                    outbound = True,
-                                    prvkey_path = self.prvkey_path,
-                                    logger = self.logger))
+        # routes adopted from the dataplane that do not refer to the
+        # nexthop groups for their wg devices. they are reinstalled.
+        self.stale_routes = set()
 
-            # Peer for incoming connection because i am a server
-            if self_node.endpoint:
-                self.peers.add(Peer(self.wg_dev, node, self.vrf,
-                                    logger = self.logger))
+        self.dataplane = dataplane
+        self.logger = logger or default_logger
+
+        # calculate wg peers and allowed-ips as routes from node_table.
+        # NodeTable gives only the nodes sharing groups with self.
+        if isinstance(node_table, NodeTable):
+            node_ids = node_table.select(self.groups)
+        else:
+            node_ids = node_table.keys()
+
+        if self.shared_dev:
+            for node_id in node_ids:
+                self.add_server(node_id, node_table[node_id])
 
-            #  routing table entries
-            for allowed_ip in node.allowed_ips:
+        for node_id in node_ids:
+            self.add_node(node_id, node_table[node_id])
+            self.peers.update(self.node_peers[node_id])
 
-                # check this prefix already exists
-                # if exist, append the device as a nexthop for ECMP
-                # if not, create a new route entry
-                if allowed_ip in self.routes_dict:
-                    self.routes_dict[allowed_ip].append_nexthop_dev(wg_dev)
-                else:
-                    route = Route(wg_dev, allowed_ip, self.vrf,
-                                  logger = self.logger)
-                    self.routes.add(route)
-                    self.routes_dict[allowed_ip] = route
+        if self.aggregate:
+            self.update_aggregated_routes()
+        else:
+            for prefix in self.nexthops:
+                self.update_route(prefix)
 
 
     def __str__(self):
@@ -290,8 +376,523 @@ class Fib(object):
                 ">")
 
     def check_group(self, node):
-        return ("any" in self.groups | node.groups or
-                self.groups & node.groups)
+        return ("any" in self.groups or "any" in node.groups or
+                not self.groups.isdisjoint(node.groups))
+
+
+    def node_entries(self, node_id, node):
+        """
+        returns list of Peers for the node and wg device that is
+        the nexthop for allowed_ips of the node. wg device is None if
+        no routes are installed for the node.
+        """
+
+        if not node.pubkey:
+            return [], None
+
+        if not node.endpoint and not self.self_node.endpoint:
+            # Both self and this node DO NOT have endpoints.
+            # Thus, we are client mode, and do not install routes.
+            return [], None
+
+        if not self.check_group(node):
+            # group does not match
+            return [], None
+
+        peers = []
+        wg_dev = self.wg_dev
+
+        # Peer for outbound connection if the node is a server
+        if node.endpoint:
+            wg_dev = self.outbound_dev(node_id, node)
+            peers.append(Peer(wg_dev, node, self.vrf,
+                              outbound = True,
+                              shared = (wg_dev == self.shared_dev),
+                              prvkey_path = self.prvkey_path,
+                              logger = self.logger))
+
+        # Peer for incoming connection because i am a server
+        if self.self_node.endpoint:
+            peers.append(Peer(self.wg_dev, node, self.vrf,
+                              logger = self.logger))
+
+        return peers, wg_dev
+
+
+    def outbound_dev(self, node_id, node):
+        """
+        returns wg device for outbound connections to the server node.
+        """
+
+        dedicated = "wg-{}".format(node.pubkey)[:13]
+        if not self.shared_dev:
+            return dedicated
+
+        for prefix in self.server_prefixes.get(node_id, ()):
+            if len(self.prefix_servers[prefix]) > 1:
+                # other servers advertise the same prefix
+                return dedicated
+
+        return self.shared_dev
+
+
+    def add_server(self, node_id, node):
+        """
+        count prefixes of the node if it is a server that self connects
+        to. returns the prefixes.
+        """
+
+        if not (node.pubkey and node.endpoint and self.check_group(node)):
+            return set()
+
+        prefixes = set(node.allowed_ips)
+        self.server_prefixes[node_id] = prefixes
+        for prefix in prefixes:
+            if not prefix in self.prefix_servers:
+                self.prefix_servers[prefix] = set()
+            self.prefix_servers[prefix].add(node_id)
+        return prefixes
+
+
+    def del_server(self, node_id):
+        """
+        uncount prefixes of the server node. returns the prefixes.
+        """
+
+        prefixes = self.server_prefixes.pop(node_id, set())
+        for prefix in prefixes:
+            servers = self.prefix_servers[prefix]
+            servers.discard(node_id)
+            if not servers:
+                del self.prefix_servers[prefix]
+        return prefixes
+
+
+    def update_servers(self, node_table, node_ids):
+        """
+        update prefixes of servers for the nodes @node_ids, and returns
+        node_ids of servers whose outbound device may change, that is,
+        servers sharing prefixes with the nodes before or after.
+        """
+
+        affected = set()
+        for node_id in node_ids:
+            for prefix in self.del_server(node_id):
+                affected |= self.prefix_servers.get(prefix, set())
+            if node_id in node_table:
+                for prefix in self.add_server(node_id, node_table[node_id]):
+                    affected |= self.prefix_servers[prefix]
+        return affected
+
+
+    def add_node(self, node_id, node):
+        """
+        add peers and nexthops of the node. routes are not updated.
+        """
+
+        peers, wg_dev = self.node_entries(node_id, node)
+        prefixes = set(node.allowed_ips) if wg_dev else set()
+
+        self.node_peers[node_id] = peers
+        self.node_routes[node_id] = (wg_dev, prefixes)
+
+        for prefix in prefixes:
+            if not prefix in self.nexthops:
+                self.nexthops[prefix] = {}
+                self.prefix_tree[prefix] = self.nexthops[prefix]
+                self.check_overlap(node_id, prefix, wg_dev)
+            nexthop = self.nexthops[prefix]
+            nexthop[wg_dev] = nexthop.get(wg_dev, 0) + 1
+
+        return peers, prefixes
+
+
+    def del_node(self, node_id):
+        """
+        delete peers and nexthops of the node. routes are not updated.
+        """
+
+        peers = self.node_peers.pop(node_id, [])
+        wg_dev, prefixes = self.node_routes.pop(node_id, (None, set()))
+
+        for prefix in prefixes:
+            nexthop = self.nexthops[prefix]
+            nexthop[wg_dev] -= 1
+            if nexthop[wg_dev] == 0:
+                del nexthop[wg_dev]
+            if not nexthop:
+                del self.nexthops[prefix]
+                del self.prefix_tree[prefix]
+
+        return peers, prefixes
+
+
+    def check_overlap(self, node_id, prefix, wg_dev):
+        """
+        warn if the prefix of the node overlaps with prefixes that
+        other nodes advertise through different nexthops.
+        """
+
+        covered = False
+        for other, nexthop in self.prefix_tree.overlaps(prefix):
+
+            if other.prefixlen < prefix.prefixlen:
+                if covered:
+                    # only the longest covering prefix matters
+                    continue
+                covered = True
+                if nexthop and set(nexthop) != { wg_dev }:
+                    self.logger.warning("prefix %s of node %s is covered "
+                                        "by %s via %s", prefix, node_id,
+                                        other, ",".join(sorted(nexthop)))
+
+            elif nexthop and set(nexthop) != { wg_dev }:
+                self.logger.warning("prefix %s of node %s covers %s via %s",
+                                    prefix, node_id, other,
+                                    ",".join(sorted(nexthop)))
+                break
+
+
+    def update_route(self, prefix):
+        """
+        rebuild Route for the prefix from nexthops. returns old and new
+        Routes (None if not exist).
+        """
+
+        wg_devs = None
+        if prefix in self.nexthops:
+            wg_devs = self.live_nexthops(self.nexthops[prefix])
+
+        return self.set_route(prefix, wg_devs)
+
+
+    def live_nexthops(self, nexthop):
+        """
+        returns sorted wg devices of @nexthop except for down devices,
+        or all of them if all are down.
+        """
+
+        wg_devs = sorted(nexthop)
+        if self.down_devs:
+            live = [ wg_dev for wg_dev in wg_devs
+                     if not wg_dev in self.down_devs ]
+            if live:
+                return live
+        return wg_devs
+
+
+    def update_aggregated_routes(self, prefixes = None):
+        """
+        rebuild Routes aggregated from prefixes in nexthops. only the
+        aggregated Routes affected by @prefixes, whose nexthops are
+        changed, are rebuilt, or all if None. returns list of old and
+        new Routes that are changed.
+        """
+
+        key = lambda nexthop: tuple(self.live_nexthops(nexthop))
+        if prefixes is None:
+            aggregated = self.prefix_tree.aggregate(key = key)
+            prefixes = set(self.routes_dict) | set(aggregated)
+        else:
+            aggregated = self.prefix_tree.aggregate_update(prefixes,
+                                                           key = key)
+            prefixes = aggregated
+
+        changes = []
+        for prefix in prefixes:
+            wg_devs = aggregated.get(prefix)
+            old = self.routes_dict.get(prefix)
+            if old and old.wg_devs == wg_devs:
+                continue
+            changes.append(self.set_route(prefix, wg_devs))
+
+        return changes
+
+
+    def set_route(self, prefix, wg_devs):
+        """
+        replace Route for the prefix with a Route via @wg_devs, or
+        remove it if @wg_devs is None. returns old and new Routes
+        (None if not exist).
+        """
+
+        old = self.routes_dict.pop(prefix, None)
+        if old:
+            self.routes.discard(old)
+            for wg_dev in old.wg_devs:
+                self.dev_routes[wg_dev].discard(prefix)
+                if not self.dev_routes[wg_dev]:
+                    del self.dev_routes[wg_dev]
+
+        new = None
+        if wg_devs:
+            new = Route(wg_devs, prefix, self.vrf, logger = self.logger)
+            self.routes.add(new)
+            self.routes_dict[prefix] = new
+            for wg_dev in new.wg_devs:
+                if not wg_dev in self.dev_routes:
+                    self.dev_routes[wg_dev] = set()
+                self.dev_routes[wg_dev].add(prefix)
+
+        return old, new
+
+
+    def update_nodes(self, node_table, node_ids):
+        """
+        recompute peers and routes of the nodes @node_ids in
+        @node_table, and install the difference. a node that is not
+        in @node_table is removed.
+        """
+
+        removed_peers = set()
+        added_peers = set()
+        prefixes = set()
+
+        if self.shared_dev:
+            # servers moving between the shared and dedicated devices
+            # are recomputed too.
+            node_ids = set(node_ids) | self.update_servers(node_table,
+                                                           node_ids)
+
+        for node_id in node_ids:
+
+            old_peers, old_prefixes = self.del_node(node_id)
+
+            if node_id in node_table:
+                new_peers, new_prefixes = self.add_node(node_id,
+                                                        node_table[node_id])
+            else:
+                new_peers, new_prefixes = [], set()
+
+            removed_peers |= set(old_peers) - set(new_peers)
+            added_peers |= set(new_peers) - set(old_peers)
+            prefixes |= old_prefixes | new_prefixes
+
+        self.peers -= removed_peers
+        self.peers |= added_peers
+
+        removed_peers, added_peers, updated_peers = \
+            self.pair_peers(removed_peers, added_peers)
+
+        # routes through outbound devices of removed peers will be
+        # removed by kernel. check them before updating routes.
+        lost = self.lost_prefixes(removed_peers)
+        removed_routes, added_routes = self.update_routes(prefixes)
+
+        self.program(lost, removed_peers, updated_peers, added_peers,
+                     removed_routes, added_routes)
+
+
+    def update_routes(self, prefixes):
+        """
+        rebuild Routes for @prefixes from nexthops. returns sets of
+        removed and added Routes.
+        """
+
+        if not self.aggregate:
+            changes = [ self.update_route(prefix) for prefix in prefixes ]
+        elif prefixes:
+            changes = self.update_aggregated_routes(prefixes)
+        else:
+            changes = []
+
+        removed_routes = set()
+        added_routes = set()
+        for old, new in changes:
+            if old and new and old == new:
+                continue
+            if old:
+                removed_routes.add(old)
+            if new:
+                added_routes.add(new)
+
+        return removed_routes, added_routes
+
+
+    def set_down_devs(self, down_devs):
+        """
+        withdraw @down_devs from nexthops of routes that have other
+        nexthops, and restore wg devices that are no longer down.
+        returns the number of routes changed.
+        """
+
+        down_devs = set(down_devs)
+        changed = down_devs ^ self.down_devs
+        if not changed:
+            return 0
+        self.down_devs = down_devs
+
+        prefixes = set()
+        for wg_dev, node_prefixes in self.node_routes.values():
+            if wg_dev in changed:
+                prefixes.update(node_prefixes)
+
+        removed_routes, added_routes = self.update_routes(prefixes)
+        self.program(set(), set(), [], set(), removed_routes, added_routes)
+        return len(added_routes)
+
+
+    def pair_peers(self, removed_peers, added_peers):
+        """
+        pair removed and added peers that have the same identity, i.e.,
+        wg device and pubkey. returns removed peers, added peers, and
+        list of (old, new) pairs that are updated in place without
+        removing their wg devices and routes.
+        """
+
+        removed = {}
+        for peer in removed_peers:
+            if peer.pubkey:
+                # ambiguous identities are not paired
+                removed[peer.ident] = None if peer.ident in removed else peer
+
+        updated_peers = []
+        for peer in added_peers:
+            old = removed.get(peer.ident)
+            if old:
+                updated_peers.append((old, peer))
+                removed[peer.ident] = None
+
+        if not updated_peers:
+            return removed_peers, added_peers, updated_peers
+
+        return (removed_peers - set([ old for old, new in updated_peers ]),
+                added_peers - set([ new for old, new in updated_peers ]),
+                updated_peers)
+
+
+    def lost_prefixes(self, removed_peers):
+        """
+        returns prefixes whose routes are removed by linux kernel when
+        outbound wg devices of the removed peers are deleted.
+        """
+        removed_devs = set([ peer.wg_dev for peer in removed_peers
+                             if peer.dedicated() ])
+        lost = set()
+        for wg_dev in removed_devs:
+            lost |= self.dev_routes.get(wg_dev, set())
+
+        if self.nexthop_table:
+            # a nexthop group loses only the nexthops of the removed
+            # devices, and is removed when all of them are removed.
+            lost = set([ prefix for prefix in lost
+                         if removed_devs.issuperset(
+                                 self.routes_dict[prefix].wg_devs) ])
+        return lost
+
+
+    def dev_routes_via(self, wg_devs):
+        """
+        returns Routes whose nexthops are exactly @wg_devs.
+        """
+        return [ self.routes_dict[prefix]
+                 for prefix in self.dev_routes.get(wg_devs[0], ())
+                 if self.routes_dict[prefix].wg_devs == wg_devs ]
+
+
+    def owns_dev(self, wg_dev):
+        """
+        returns True if the wg device is one that amesh manages
+        """
+        return (wg_dev == self.wg_dev or wg_dev == self.shared_dev or
+                (wg_dev.startswith("wg-") and len(wg_dev) == 13))
+
+
+    def created_dev(self, wg_dev):
+        """
+        returns True if the wg device is one that amesh manages and
+        this process created or adopted, not one of other amesh
+        instances or operators.
+        """
+        return (wg_dev == self.wg_dev or wg_dev == self.shared_dev or
+                wg_dev in self.dataplane.owned_links)
+
+
+    def dump_peers(self, desired):
+        """
+        returns wg devices of amesh on the dataplane and set of Peers
+        on them. endpoints of peers on the device for incomming
+        connections roam, so that they are taken from the peers in
+        @desired. wg devices out of the VRF of this Fib, e.g., of
+        other amesh instances, are ignored.
+        """
+
+        masters = self.dataplane.link_masters()
+
+        endpoints = dict([ ((peer.wg_dev, peer.pubkey), peer.endpoint)
+                           for peer in desired.peers if not peer.outbound ])
+
+        # allowed-ips of @desired are reused instead of parsing them
+        networks = dict([ (str(prefix), prefix) for peer in desired.peers
+                          for prefix in peer.allowed_ips ])
+
+        devs = set()
+        dumped = set()
+        for wg_dev, peers in self.dataplane.wg_dump().items():
+
+            if not self.owns_dev(wg_dev) or masters.get(wg_dev) != self.vrf:
+                continue
+
+            devs.add(wg_dev)
+            outbound = (wg_dev != self.wg_dev)
+
+            for p in peers:
+                endpoint = p["endpoint"]
+                if not outbound:
+                    endpoint = endpoints.get((wg_dev, p["pubkey"]))
+
+                allowed_ips = set([ networks.get(prefix) or
+                                    ipaddress.ip_network(prefix)
+                                    for prefix in p["allowed_ips"] ])
+                node = Node(pubkey = p["pubkey"], endpoint = endpoint,
+                            allowed_ips = allowed_ips,
+                            keepalive = p["keepalive"])
+                dumped.add(Peer(wg_dev, node, self.vrf,
+                                outbound = outbound,
+                                shared = (wg_dev == self.shared_dev),
+                                prvkey_path = self.prvkey_path,
+                                logger = self.logger))
+
+        return devs, dumped
+
+
+    def adopt_dataplane(self, desired):
+        """
+        load peers and routes already installed on the dataplane for
+        wg devices of amesh into this Fib, so that only differences
+        from @desired Fib are programmed by update_diff().
+        """
+
+        devs, peers = self.dump_peers(desired)
+        self.peers |= peers
+        self.dataplane.owned_links.update(devs)
+
+        nt = self.nexthop_table
+        if nt:
+            nhids = self.dataplane.route_nhids(self.vrf)
+
+        for prefix, wg_devs in self.dataplane.route_dump(self.vrf):
+
+            if not wg_devs or not all(map(self.owns_dev, wg_devs)):
+                continue
+
+            prefix = ipaddress.ip_network(prefix)
+            route = Route(sorted(wg_devs), prefix, self.vrf,
+                          logger = self.logger)
+            self.routes.add(route)
+            if nt:
+                if route.wg_devs in nt.refs:
+                    nt.refs[route.wg_devs] += 1
+                if nhids.get(route.prefix) != nt.groups.get(route.wg_devs):
+                    self.stale_routes.add(route)
+            self.routes_dict[prefix] = route
+            for wg_dev in route.wg_devs:
+                if not wg_dev in self.dev_routes:
+                    self.dev_routes[wg_dev] = set()
+                self.dev_routes[wg_dev].add(prefix)
+
+        self.logger.info("adopted %d peers and %d routes from dataplane",
+                         len(self.peers), len(self.routes))
 
 
     def update_diff(self, old):
@@ -310,47 +911,456 @@ class Fib(object):
         print("\n".join(map(str, self.routes)))
         """
 
-        # Step 1, Remove peers that are in old, but not in new Fib,
-        # and check routes associated with the removed peers
-        removed_peers = old.peers - self.peers
-        for removed_peer in removed_peers:
+        removed_peers, added_peers, updated_peers = \
+            self.pair_peers(old.peers - self.peers, self.peers - old.peers)
 
-            removed_peer.uninstall()
+        removed_routes = old.routes - self.routes
+        added_routes = self.routes - old.routes
+        if old.stale_routes:
+            removed_routes |= old.stale_routes
+            added_routes |= self.routes & old.stale_routes
 
-            if removed_peer.outbound:
-                for route in self.routes:
-                    if route.check_dev(removed_peer.wg_dev):
-                        # this associated route is also removed automatically
-                        # by linux kernel because the wg interface for
-                        # this outbound connction is removed.
-                        route.make_this_removed()
+        self.program(old.lost_prefixes(removed_peers),
+                     removed_peers, updated_peers, added_peers,
+                     removed_routes, added_routes)
 
 
-        # Step 2, Remove routes that are in old, but not in new Fib
-        # routes, which hav removed = True, are already removed
-        # at last step.
-        removed_routes = old.routes - self.routes
+    def program(self, lost, removed_peers, updated_peers, added_peers,
+                removed_routes, added_routes):
+        """
+        install the difference to the dataplane.
+        @lost: prefixes whose routes are removed along with wg devices
+        @updated_peers: list of (old, new) peers updated in place
+        """
+
+        nt = self.nexthop_table
+        moves = {}
+        if nt:
+            # nexthop groups, most routes of which move to other wg
+            # devices, are updated instead of the routes.
+            moves = nt.plan_moves(removed_routes, added_routes, lost)
+            new_devs = dict([ (route.prefix, route.wg_devs)
+                              for route in added_routes ])
+            moved = set([ route.prefix for route in removed_routes
+                          if route.wg_devs in moves and
+                          new_devs.get(route.prefix) == moves[route.wg_devs] ])
+            removed_routes = set([ route for route in removed_routes
+                                   if not route.prefix in moved ])
+            added_routes = set([ route for route in added_routes
+                                 if not route.prefix in moved ])
+
+        self.dataplane.begin()
+
+        # Step 1, Remove routes that are in old, but not in new Fib.
+        # lost routes are removed at the next step.
+        lost_routes = set(map(str, lost))
         for removed_route in removed_routes:
-            if not removed_route.removed:
-                removed_route.uninstall()
+            if not removed_route.prefix in lost_routes:
+                removed_route.uninstall(self.dataplane)
+                if nt:
+                    nt.release(removed_route.wg_devs)
+
+        # Step 2, Remove peers that are in old, but not in new Fib.
+        # routes associated with removed outbound peers (lost) are
+        # also removed automatically by linux kernel because the wg
+        # interfaces for the outbound connctions are removed.
+        self.uninstall_peers(removed_peers)
+
+        # Step 3, Update attributes of peers that have the same wg
+        # device and pubkey in old and new Fib. their wg devices and
+        # routes are kept.
+        self.update_peers(updated_peers)
+
+        # Step 4, Add peers that are not in old, but in new Fib
+        self.install_peers(added_peers)
+
+        # Step 5, Update nexthop groups whose routes move to other wg
+        # devices. nexthops of the removed wg devices are removed by
+        # linux kernel along with the devices.
+        if nt:
+            nt.forget_devs([ peer.wg_dev for peer in removed_peers
+                             if peer.dedicated() ])
+            for old, new in moves.items():
+                # routes staying on the old wg devices refer to another
+                # group before the group moves, and routes of the
+                # existing group for the new wg devices refer to the
+                # moved group after that.
+                staying = [ route for route in self.dev_routes_via(old)
+                            if not route in added_routes ]
+                merged = [ route for route in self.dev_routes_via(new)
+                           if not route in added_routes and
+                           not route.prefix in moved ]
+                if staying:
+                    nhid = nt.split(old, len(staying))
+                    for route in staying:
+                        route.replace(self.dataplane, nhid)
+                nhid = nt.move(old, new)
+                for route in merged:
+                    route.replace(self.dataplane, nhid)
+
+        # Step 6, Add routes that are not in old, but in new Fib,
+        # and lost routes that still exist in new Fib.
+        for prefix in lost:
+            if prefix in self.routes_dict:
+                added_routes.add(self.routes_dict[prefix])
+
+        nhids = {}
+        if nt:
+            # create nexthop groups before queueing routes to keep
+            # the routes in a batch
+            for added_route in added_routes:
+                nhids[added_route] = nt.acquire(added_route.wg_devs)
+
+        for added_route in added_routes:
+            added_route.install(self.dataplane, nhids.get(added_route))
 
+        # send queued route operations as a batch
+        self.dataplane.commit()
 
-        # Step 3, Add peers that are not in old, but in new Fib
-        added_peers = self.peers - old.peers
-        for added_peer in added_peers:
-            added_peer.install()
+        if nt:
+            nt.collect()
 
-        # Step 4, Add routes that are not in old, but in new Fib
-        added_routes = self.routes - old.routes
-        for added_route in added_routes:
-            added_route.install()
+
+    def reconcile(self, due = None):
+        """
+        compare peers, nexthop groups and routes on the dataplane with
+        this Fib, and repair the differences, e.g., left by operations
+        that failed or made by other tools. returns dict of kinds of
+        differences and the numbers of them found.
+        @due: function called with kind and key of a difference before
+              repairing it. the repair is postponed if it returns False.
+        """
+
+        drift = dict.fromkeys(DRIFT_KINDS, 0)
+
+        def found(kind, key):
+            drift[kind] += 1
+            return not due or due(kind, key)
+
+        dp = self.dataplane
+        nt = self.nexthop_table
+
+        # wg devices that this Fib does not use are repaired only if
+        # this process created or adopted them.
+        peer_devs = set([ peer.wg_dev for peer in self.peers ])
+        def repairable(wg_dev):
+            return wg_dev in peer_devs or self.created_dev(wg_dev)
+
+        devs, peers = self.dump_peers(self)
+        devs = set(filter(repairable, devs))
+        peers = set([ peer for peer in peers if peer.wg_dev in devs ])
+        removed_peers, added_peers, updated_peers = \
+            self.pair_peers(peers - self.peers, self.peers - peers)
+
+        # dedicated wg devices of no peers are removed along with their
+        # peers and routes.
+        for wg_dev in sorted(devs - peer_devs):
+            if wg_dev in (self.wg_dev, self.shared_dev):
+                continue
+            devs.discard(wg_dev)
+            if found("links_extra", ("link", wg_dev)):
+                try:
+                    dp.link_del(wg_dev)
+                except Exception as e:
+                    self.logger.error("failed to remove %s: %s", wg_dev, e)
+
+        removed = {}
+        for peer in removed_peers:
+            if not peer.wg_dev in devs:
+                continue
+            if found("peers_extra", ("peer",) + peer.ident):
+                if not peer.wg_dev in removed:
+                    removed[peer.wg_dev] = []
+                removed[peer.wg_dev] += [ "peer", peer.pubkey, "remove" ]
+        for wg_dev, wgargs in removed.items():
+            try:
+                dp.wg_set(wg_dev, wgargs)
+            except Exception as e:
+                self.logger.error("failed to uninstall %d peers on %s: %s",
+                                  len(wgargs) // 3, wg_dev, e)
+
+        if updated_peers:
+            # an allowed-ip belongs to one of the peers advertising it on
+            # a wg device, which are not repaired for the allowed-ip.
+            # peers on down devices have probing keepalives.
+            shared = self.shared_allowed_ips()
+            updated_peers = [
+                (old, new) for old, new in updated_peers
+                if (old.endpoint != new.endpoint or
+                    (old.keepalive != new.keepalive and
+                     not new.wg_dev in self.down_devs) or
+                    not all([ (new.wg_dev, prefix) in shared for prefix
+                              in old.allowed_ips ^ new.allowed_ips ]))
+            ]
+
+        self.update_peers([ (old, new) for old, new in updated_peers
+                            if found("peers_changed", ("peer",) + new.ident) ])
+
+        # wg devices that exist are kept, so that their routes are kept.
+        added = [ peer for peer in added_peers
+                  if found("peers_missing", ("peer",) + peer.ident) ]
+        dp.parallel([
+            functools.partial(self.install_dev_peers, wg_dev, dev_peers,
+                              link = not wg_dev in devs)
+            for wg_dev, dev_peers in self.group_peers_by_dev(added).items()
+        ])
+
+        if nt:
+            nt.reconcile(found)
+
+        # routes are dumped by ip command, which is much faster than
+        # pyroute2 on large tables.
+        desired = dict([ (route.prefix, route) for route in self.routes ])
+        dp.begin()
+
+        for prefix, wg_devs, nhid in dp.ipcmd_route_dump(self.vrf):
+
+            if not wg_devs or not all(map(repairable, wg_devs)):
+                continue
+
+            route = desired.pop(prefix, None)
+            if not route:
+                route = desired.pop(str(ipaddress.ip_network(prefix)), None)
+            if not route:
+                if found("routes_extra", ("route", prefix)):
+                    Route(wg_devs, prefix, self.vrf,
+                          logger = self.logger).uninstall(dp)
+                continue
+
+            if (tuple(sorted(wg_devs)) == route.wg_devs and
+                (not nt or nhid == nt.groups.get(route.wg_devs))):
+                continue
+            if found("routes_changed", ("route", route.prefix)):
+                self.repair_route(route)
+
+        for route in desired.values():
+            if found("routes_missing", ("route", route.prefix)):
+                self.repair_route(route)
+
+        dp.commit()
+
+        if nt:
+            nt.collect()
+
+        return drift
+
+
+    def shared_allowed_ips(self):
+        """
+        returns set of wg devices and allowed-ips that multiple peers
+        on the devices advertise.
+        """
+
+        advertised = set()
+        shared = set()
+        for peer in self.peers:
+            for prefix in peer.allowed_ips:
+                key = (peer.wg_dev, prefix)
+                if key in advertised:
+                    shared.add(key)
+                advertised.add(key)
+        return shared
+
+
+    def repair_route(self, route):
+        """
+        install or replace the route on the dataplane.
+        """
+
+        nhid = None
+        nt = self.nexthop_table
+        if nt:
+            nhid = nt.groups.get(route.wg_devs)
+            if not nhid:
+                nhid = nt.acquire(route.wg_devs)
+        route.replace(self.dataplane, nhid)
 
 
     def uninstall(self):
 
+        self.dataplane.begin()
+
+        nt = self.nexthop_table
+
         for route in self.routes:
-            route.uninstall()
+            route.uninstall(self.dataplane)
+            if nt:
+                nt.release(route.wg_devs)
 
-        for peer in self.peers:
-            peer.uninstall()
+        self.uninstall_peers(self.peers)
+
+        if nt:
+            nt.forget_devs([ peer.wg_dev for peer in self.peers
+                             if peer.dedicated() ])
+            nt.collect()
+
+        if self.shared_dev and self.dataplane.link_exists(self.shared_dev):
+            try:
+                self.dataplane.link_del(self.shared_dev)
+            except Exception as e:
+                self.logger.error("failed to remove %s: %s",
+                                  self.shared_dev, e)
+
+        self.dataplane.commit()
+
+
+    def group_peers_by_dev(self, peers):
+        devs = {}
+        for peer in peers:
+            if not peer.pubkey:
+                continue
+            if not peer.wg_dev in devs:
+                devs[peer.wg_dev] = []
+            devs[peer.wg_dev].append(peer)
+        return devs
+
+
+    def install_peers(self, peers):
+        """
+        install peers. wg devices are programmed in parallel by the
+        workers of the dataplane.
+        """
+
+        self.dataplane.parallel([
+            functools.partial(self.install_dev_peers, wg_dev, dev_peers)
+            for wg_dev, dev_peers in self.group_peers_by_dev(peers).items()
+        ])
+
+
+    def install_dev_peers(self, wg_dev, dev_peers, link = True):
+        """
+        install peers on a wg device. peers are configured by a
+        single 'wg addconf', so that peers not in the list are kept
+        untouched.
+        @link: create the wg device. if False, the device exists.
+        """
+
+        if link and wg_dev == self.shared_dev:
+            self.install_shared_dev()
+
+        for peer in dev_peers:
+            self.logger.debug("install peer: %s", str(peer))
+            if link:
+                peer.install_link(self.dataplane)
+
+        conf = "\n".join([ peer.wg_config() for peer in dev_peers ])
+        try:
+            self.dataplane.wg_addconf(wg_dev, conf)
+        except Exception as e:
+            self.logger.error("failed to install %d peers on %s: %s",
+                              len(dev_peers), wg_dev, e)
+            for peer in dev_peers:
+                self.dataplane.fail("peers_missing", ("peer",) + peer.ident)
+
+
+    def install_shared_dev(self):
+        """
+        create the shared outbound wg device if it does not exist.
+        """
+
+        dp = self.dataplane
+        if dp.link_exists(self.shared_dev):
+            return
+
+        ops = [
+            (dp.link_add, self.shared_dev, "wireguard"),
+            (dp.link_up, self.shared_dev),
+            (dp.wg_set, self.shared_dev, [ "private-key", self.prvkey_path ]),
+        ]
+        if self.vrf:
+            ops.append((dp.link_set_master, self.shared_dev, self.vrf))
+
+        for op in ops:
+            try:
+                op[0](*op[1:])
+            except Exception as e:
+                self.logger.error("failed to install %s: %s %s: %s",
+                                  self.shared_dev, op[0].__name__,
+                                  " ".join(map(str, op[1:])), e)
+
+
+    def update_peers(self, updated_peers):
+        """
+        update peers in place. @updated_peers is list of (old, new).
+        wg devices are programmed in parallel by the workers of the
+        dataplane.
+        """
+
+        devs = {}
+        for old, new in updated_peers:
+            if not new.wg_dev in devs:
+                devs[new.wg_dev] = []
+            devs[new.wg_dev].append((old, new))
+
+        self.dataplane.parallel([
+            functools.partial(self.update_dev_peers, wg_dev, dev_peers)
+            for wg_dev, dev_peers in devs.items()
+        ])
+
+
+    def update_dev_peers(self, wg_dev, dev_peers):
+        """
+        update peers on a wg device by a single 'wg set'. peers that
+        have nothing to set, e.g., inbound peers losing their
+        endpoints, are skipped.
+        """
+
+        wgargs = []
+        for old, new in dev_peers:
+            args = new.wg_update_args(old)
+            if args:
+                self.logger.debug("update peer: %s", str(new))
+                wgargs += args
+
+        if not wgargs:
+            return
+
+        try:
+            self.dataplane.wg_set(wg_dev, wgargs)
+        except Exception as e:
+            self.logger.error("failed to update %d peers on %s: %s",
+                              len(dev_peers), wg_dev, e)
+            for old, new in dev_peers:
+                self.dataplane.fail("peers_changed", ("peer",) + new.ident)
+
+
+    def uninstall_peers(self, peers):
+        """
+        uninstall peers. wg devices are programmed in parallel by the
+        workers of the dataplane.
+        """
+
+        self.dataplane.parallel([
+            functools.partial(self.uninstall_dev_peers, wg_dev, dev_peers)
+            for wg_dev, dev_peers in self.group_peers_by_dev(peers).items()
+        ])
+
+
+    def uninstall_dev_peers(self, wg_dev, dev_peers):
+        """
+        uninstall peers on a wg device. peers with dedicated outbound
+        devices are removed with their wg devices, and the other peers
+        are removed by a single 'wg set'.
+        """
+
+        wgargs = []
+        removed = []
+        for peer in dev_peers:
+            self.logger.debug("uninstall peer: %s", str(peer))
+            if peer.dedicated():
+                peer.uninstall_link(self.dataplane)
+            else:
+                wgargs += [ "peer", peer.pubkey, "remove" ]
+                removed.append(peer)
+
+        if not wgargs:
+            return
+
+        try:
+            self.dataplane.wg_set(wg_dev, wgargs)
+        except Exception as e:
+            self.logger.error("failed to uninstall %d peers on %s: %s",
+                              len(wgargs) // 3, wg_dev, e)
+            for peer in removed:
+                self.dataplane.fail("peers_extra", ("peer",) + peer.ident)
 
@@ -0,0 +1,187 @@
+import time
+import collections
+
+if not "amesh." in __name__:
+    from metrics import Metrics
+    from static import FAILOVER_PROBE_KEEPALIVE, FAILOVER_MIN_TX_BYTES
+else:
+    from amesh.metrics import Metrics
+    from amesh.static import FAILOVER_PROBE_KEEPALIVE, FAILOVER_MIN_TX_BYTES
+
+
+from logging import getLogger, INFO, StreamHandler
+from logging.handlers import SysLogHandler
+default_logger = getLogger(__name__)
+default_logger.setLevel(INFO)
+stream = StreamHandler()
+syslog = SysLogHandler(address = "/dev/log")
+default_logger.addHandler(stream)
+default_logger.addHandler(syslog)
+default_logger.propagate = False
+
+
+class LivenessMonitor(object):
+
+    def __init__(self, timeout, probe_keepalive = FAILOVER_PROBE_KEEPALIVE,
+                 min_tx_bytes = FAILOVER_MIN_TX_BYTES, metrics = None,
+                 logger = None):
+        """
+        LivenessMonitor: withdraws wg devices of unresponsive servers
+        from nexthops of ECMP routes
+        @timeout: seconds without receiving from a server while sending
+                  to it before its wg device is withdrawn
+        @probe_keepalive: persistent keepalive (sec) of withdrawn peers
+        @min_tx_bytes: bytes sent within @timeout to regard a server
+                       without response as unresponsive
+        @metrics: Metrics to count withdrawals
+        @logger: logger
+
+        check() is called periodically, and reads the counters of all
+        peers by a single wg dump. A dedicated outbound wg device is
+        down when more than @min_tx_bytes are sent to its peer within
+        the last @timeout seconds, and neither bytes nor a handshake
+        are received meanwhile. WireGuard answers data with a keepalive
+        in 10 seconds, so that @timeout shorter than that relies on
+        traffic in both directions. Down devices are withdrawn from
+        routes that have other nexthops. Their peers get
+        @probe_keepalive to keep initiating handshakes, and they are
+        restored when a handshake or bytes are received.
+        """
+
+        self.timeout = timeout
+        self.probe_keepalive = probe_keepalive
+        self.min_tx_bytes = min_tx_bytes
+        self.metrics = metrics or Metrics()
+        self.logger = logger or default_logger
+
+        # key is wg device, value is dict of pubkey, rx_bytes and
+        # latest_handshake of the last check, and samples, deque of
+        # (time, tx_bytes) since bytes or a handshake are received.
+        self.devs = {}
+
+        # wg devices withdrawn from nexthops
+        self.down = set()
+
+        m = self.metrics
+        self.m_checks = m.counter("amesh_failover_checks_total",
+                                  "checks of outbound peer liveness")
+        self.m_failures = m.counter("amesh_failover_failures_total",
+                                    "checks failed to dump wg peers")
+        self.m_withdrawals = m.counter("amesh_failover_withdrawals_total",
+                                       "wg devices withdrawn from nexthops")
+        self.m_restorations = m.counter("amesh_failover_restorations_total",
+                                        "wg devices restored to nexthops")
+        m.gauge("amesh_failover_down_devices",
+                "wg devices withdrawn from nexthops",
+                function = lambda: len(self.down))
+
+
+    def check(self, fib):
+        """
+        update liveness of dedicated outbound wg devices of @fib, and
+        withdraw or restore them. returns set of down wg devices.
+        """
+
+        now = time.monotonic()
+        self.m_checks.inc()
+        try:
+            dump = fib.dataplane.wg_dump()
+        except Exception:
+            self.m_failures.inc()
+            raise
+
+        peers = dict([ (peer.wg_dev, peer) for peer in fib.peers
+                       if peer.dedicated() ])
+
+        for wg_dev in set(self.devs) - set(peers):
+            del self.devs[wg_dev]
+        self.down &= set(peers)
+
+        down = []
+        up = []
+        for wg_dev, peer in peers.items():
+            p = [ p for p in dump.get(wg_dev, [])
+                  if p["pubkey"] == peer.pubkey ]
+            if not p:
+                # not installed yet, or repaired by the reconciler
+                continue
+
+            if self.update(wg_dev, peer.pubkey, p[0], now):
+                if wg_dev in self.down:
+                    up.append(wg_dev)
+            elif self.stale(wg_dev, now) and not wg_dev in self.down:
+                down.append(wg_dev)
+
+            if (wg_dev in self.down and not wg_dev in up and
+                p[0]["keepalive"] != self.probe_keepalive):
+                # the probe is reset by updates of the peer
+                self.set_keepalive(fib, peer, self.probe_keepalive)
+
+        for wg_dev in down:
+            self.logger.warning("withdraw %s from nexthops, no response "
+                                "from %s for %s sec", wg_dev,
+                                peers[wg_dev].endpoint, self.timeout)
+            self.set_keepalive(fib, peers[wg_dev], self.probe_keepalive)
+        for wg_dev in up:
+            self.logger.info("restore %s to nexthops", wg_dev)
+            self.set_keepalive(fib, peers[wg_dev], peers[wg_dev].keepalive)
+
+        self.m_withdrawals.inc(len(down))
+        self.m_restorations.inc(len(up))
+        self.down = (self.down | set(down)) - set(up)
+
+        fib.set_down_devs(self.down)
+        return self.down
+
+
+    def update(self, wg_dev, pubkey, p, now):
+        """
+        record counters @p of the peer on @wg_dev. returns True if
+        bytes or a handshake are received since the last check.
+        """
+
+        s = self.devs.get(wg_dev)
+        if not s or s["pubkey"] != pubkey:
+            s = { "pubkey": pubkey, "samples": collections.deque() }
+            self.devs[wg_dev] = s
+            received = False
+        else:
+            # counters are reset when the peer is reinstalled
+            received = (p["rx_bytes"] > s["rx_bytes"] or
+                        p["latest_handshake"] > s["latest_handshake"])
+
+        s["rx_bytes"] = p["rx_bytes"]
+        s["latest_handshake"] = p["latest_handshake"]
+
+        samples = s["samples"]
+        if received or p["tx_bytes"] < (samples or [(0, 0)])[-1][1]:
+            samples.clear()
+        samples.append((now, p["tx_bytes"]))
+
+        # keep the last sample older than the timeout
+        while len(samples) > 1 and samples[1][0] <= now - self.timeout:
+            samples.popleft()
+
+        return received
+
+
+    def stale(self, wg_dev, now):
+        """
+        returns True if more than min_tx_bytes are sent to the peer on
+        @wg_dev without response for the timeout.
+        """
+
+        samples = self.devs[wg_dev]["samples"]
+        t, tx = samples[0]
+        return (t <= now - self.timeout and
+                samples[-1][1] - tx > self.min_tx_bytes)
+
+
+    def set_keepalive(self, fib, peer, keepalive):
+        try:
+            fib.dataplane.wg_set(peer.wg_dev,
+                                 [ "peer", peer.pubkey,
+                                   "persistent-keepalive", str(keepalive) ])
+        except Exception as e:
+            self.logger.error("failed to set keepalive of %s: %s",
+                              peer.wg_dev, e)
@@ -0,0 +1,251 @@
+
+import socket
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from logging import getLogger, INFO, StreamHandler
+from logging.handlers import SysLogHandler
+default_logger = getLogger(__name__)
+default_logger.setLevel(INFO)
+stream = StreamHandler()
+syslog = SysLogHandler(address = "/dev/log")
+default_logger.addHandler(stream)
+default_logger.addHandler(syslog)
+default_logger.propagate = False
+
+
+# default buckets of histograms in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [ (k, str(v).replace("\\", "\\\\").replace("\"", "\\\"")
+                 .replace("\n", "\\n")) for k, v in labels ]
+    return "{" + ",".join([ "{}=\"{}\"".format(k, v)
+                            for k, v in escaped ]) + "}"
+
+
+class Counter(object):
+
+    type = "counter"
+
+    def __init__(self, name, help, labels = ()):
+        """
+        Counter: a value that only increases
+        @name: metric name
+        @help: description of this metric
+        @labels: tuple of label name and value pairs
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, value = 1):
+        with self.lock:
+            self.value += value
+
+    def get(self):
+        return self.value
+
+    def expose(self):
+        return [ "{}{} {}".format(self.name, format_labels(self.labels),
+                                  format_value(self.get())) ]
+
+
+class Gauge(Counter):
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels = (), function = None):
+        """
+        Gauge: a value that can go up and down
+        @name: metric name
+        @help: description of this metric
+        @labels: tuple of label name and value pairs
+        @function: if given, the value is obtained by calling it
+        """
+        super().__init__(name, help, labels = labels)
+        self.function = function
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def dec(self, value = 1):
+        self.inc(-value)
+
+    def get(self):
+        if self.function:
+            return self.function()
+        return self.value
+
+
+class Histogram(object):
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        """
+        Histogram: distribution of observed values
+        @name: metric name
+        @help: description of this metric
+        @labels: tuple of label name and value pairs
+        @buckets: upper bounds of buckets
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.counts = [ 0 ] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[n] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def get(self):
+        return { "count": self.count, "sum": self.sum }
+
+    def expose(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            labels = self.labels + (("le", format_value(bound)),)
+            lines.append("{}_bucket{} {}".format(self.name,
+                                                 format_labels(labels),
+                                                 cumulative))
+        labels = format_labels(self.labels)
+        lines.append("{}_sum{} {}".format(self.name, labels, total))
+        lines.append("{}_count{} {}".format(self.name, labels, count))
+        return lines
+
+
+class Metrics(object):
+
+    def __init__(self):
+        """
+        Metrics: registry of counters, gauges and histograms of an
+        amesh process. a metric is identified by its name and labels.
+        """
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help, labels, **kwargs):
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            if not (name, labels) in self.metrics:
+                self.metrics[(name, labels)] = cls(name, help,
+                                                   labels = labels, **kwargs)
+            return self.metrics[(name, labels)]
+
+    def counter(self, name, help = "", labels = None):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help = "", labels = None, function = None):
+        return self.register(Gauge, name, help, labels, function = function)
+
+    def histogram(self, name, help = "", labels = None,
+                  buckets = DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help, labels,
+                             buckets = buckets)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict([ (metric.name + format_labels(metric.labels),
+                       metric.get()) for metric in metrics ])
+
+    def expose(self):
+        """
+        returns metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        lines = []
+        last = None
+        for (name, labels), metric in metrics:
+            if name != last:
+                lines.append("# HELP {} {}".format(name, metric.help))
+                lines.append("# TYPE {} {}".format(name, metric.type))
+                last = name
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+
+    def __init__(self, metrics, address, port, logger = None):
+        """
+        MetricsServer: HTTP server exposing metrics on /metrics
+        @metrics: Metrics to be exposed
+        @address: address to listen on
+        @port: port to listen on
+        @logger: logger
+        """
+
+        self.metrics = metrics
+        self.logger = logger or default_logger
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.metrics.expose().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug("metrics: %s %s",
+                                    self.address_string(), format % args)
+
+        class HTTPServer(ThreadingHTTPServer):
+            address_family = (socket.AF_INET6 if ":" in address else
+                              socket.AF_INET)
+
+        self.httpd = HTTPServer((address, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target = self.httpd.serve_forever,
+                                       daemon = True)
+
+    def start(self):
+        self.logger.info("metrics endpoint is http://%s:%d/metrics",
+                         *self.httpd.server_address[:2])
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
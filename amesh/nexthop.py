@@ -0,0 +1,332 @@
+
+if not "amesh." in __name__:
+    from static import NEXTHOP_ID_BASE, NEXTHOP_ID_RANGE
+else:
+    from amesh.static import NEXTHOP_ID_BASE, NEXTHOP_ID_RANGE
+
+
+from logging import getLogger, INFO, StreamHandler
+from logging.handlers import SysLogHandler
+default_logger = getLogger(__name__)
+default_logger.setLevel(INFO)
+stream = StreamHandler()
+syslog = SysLogHandler(address = "/dev/log")
+default_logger.addHandler(stream)
+default_logger.addHandler(syslog)
+default_logger.propagate = False
+
+
+class NexthopTable(object):
+
+    def __init__(self, dataplane, id_base = NEXTHOP_ID_BASE, logger = None):
+        """
+        NexthopTable: kernel nexthop objects that routes refer to
+        @dataplane: Dataplane to program nexthop objects
+        @id_base: first nexthop id that this table allocates
+        @logger: logger
+
+        A nexthop is created for each wg device, and a nexthop group
+        is created for each set of wg devices that routes go through.
+        Routes via the same set of wg devices refer to the same group,
+        so that when most of them move to another set, e.g., a server
+        joins or leaves ECMP, the group is updated instead of the
+        routes. The table is shared by Fibs over their lifetime.
+        """
+
+        self.dataplane = dataplane
+        self.id_base = id_base
+        self.logger = logger or default_logger
+
+        self.next_id = id_base
+        self.free_ids = []
+
+        # key is wg device, value is nexthop id
+        self.dev_ids = {}
+
+        # key is tuple of wg devices, value is nexthop group id
+        self.groups = {}
+
+        # key is tuple of wg devices, value is number of routes
+        self.refs = {}
+
+        # key is wg devices of a group to be moved, value is id of
+        # the group for routes staying on the wg devices
+        self.splits = {}
+
+        # nexthop ids on the kernel not used by this table
+        self.orphans = set()
+
+
+    def owns(self, nhid):
+        return self.id_base <= nhid < self.id_base + NEXTHOP_ID_RANGE
+
+
+    def alloc_id(self):
+        if self.free_ids:
+            return self.free_ids.pop()
+        nhid = self.next_id
+        self.next_id += 1
+        return nhid
+
+
+    def free_id(self, nhid):
+        self.free_ids.append(nhid)
+
+
+    def load(self):
+        """
+        load nexthop objects in the id range of this table that are
+        left on the kernel, e.g., by the previous amesh process.
+        """
+
+        nexthops = [ nh for nh in self.dataplane.nexthop_dump()
+                     if self.owns(nh["id"]) ]
+        if not nexthops:
+            return
+
+        self.next_id = max([ nh["id"] for nh in nexthops ]) + 1
+
+        devs = {}
+        for nh in nexthops:
+            if "dev" in nh:
+                if nh["dev"] in self.dev_ids:
+                    self.orphans.add(nh["id"])
+                    continue
+                self.dev_ids[nh["dev"]] = nh["id"]
+                devs[nh["id"]] = nh["dev"]
+
+        for nh in nexthops:
+            if not "group" in nh:
+                continue
+            wg_devs = tuple(sorted([ devs.get(m) for m in nh["group"] ]))
+            if None in wg_devs or wg_devs in self.groups:
+                self.orphans.add(nh["id"])
+                continue
+            self.groups[wg_devs] = nh["id"]
+            self.refs[wg_devs] = 0
+
+        self.logger.info("loaded %d nexthops and %d nexthop groups",
+                         len(self.dev_ids), len(self.groups))
+
+
+    def acquire(self, wg_devs):
+        """
+        returns id of the nexthop group for @wg_devs used by a route.
+        the group is created if it does not exist.
+        """
+
+        wg_devs = tuple(wg_devs)
+        if not wg_devs in self.groups:
+            nhid = self.alloc_id()
+            self.set_group(nhid, wg_devs)
+            self.groups[wg_devs] = nhid
+            self.refs[wg_devs] = 0
+
+        self.refs[wg_devs] += 1
+        return self.groups[wg_devs]
+
+
+    def release(self, wg_devs):
+        """
+        a route via @wg_devs is removed. unused groups are removed by
+        collect().
+        """
+
+        wg_devs = tuple(wg_devs)
+        if wg_devs in self.refs and self.refs[wg_devs] > 0:
+            self.refs[wg_devs] -= 1
+
+
+    def set_group(self, nhid, wg_devs):
+        """
+        create or update the nexthop group @nhid with nexthops of
+        @wg_devs. nexthops of wg devices are created if not exist.
+        """
+
+        for wg_dev in wg_devs:
+            if wg_dev in self.dev_ids:
+                continue
+            nhid_dev = self.alloc_id()
+            try:
+                self.dataplane.nexthop_add(nhid_dev, wg_dev)
+                self.dev_ids[wg_dev] = nhid_dev
+            except Exception as e:
+                self.free_id(nhid_dev)
+                self.logger.error("failed to add nexthop %d dev %s: %s",
+                                  nhid_dev, wg_dev, e)
+                self.dataplane.fail("nexthops", ("nexthop", nhid))
+
+        members = [ self.dev_ids[wg_dev] for wg_dev in wg_devs
+                    if wg_dev in self.dev_ids ]
+        try:
+            self.dataplane.nexthop_group(nhid, members)
+        except Exception as e:
+            self.logger.error("failed to set nexthop group %d dev %s: %s",
+                              nhid, ",".join(wg_devs), e)
+            self.dataplane.fail("nexthops", ("nexthop", nhid))
+
+
+    def plan_moves(self, removed_routes, added_routes, lost):
+        """
+        returns dict of old and new wg devices of nexthop groups, most
+        routes of which move from the old to the new wg devices. the
+        routes staying on the old wg devices, and the routes of the
+        existing group for the new wg devices, if they are fewer than
+        the moving routes, are switched to other groups instead.
+        @lost: prefixes whose routes are removed along with wg devices
+        """
+
+        lost_routes = set(map(str, lost))
+        new_devs = dict([ (route.prefix, route.wg_devs)
+                          for route in added_routes ])
+
+        # key is old wg devices, value is dict of new wg devices and
+        # the number of routes moving to them
+        moving = {}
+        lost_groups = set()
+        for route in removed_routes:
+            if not route.wg_devs in self.groups:
+                continue
+            if route.prefix in lost_routes:
+                # the group is removed along with its wg devices
+                lost_groups.add(route.wg_devs)
+                continue
+            if not route.prefix in new_devs:
+                continue
+            if not route.wg_devs in moving:
+                moving[route.wg_devs] = {}
+            n = moving[route.wg_devs]
+            new = new_devs[route.prefix]
+            n[new] = n.get(new, 0) + 1
+
+        moves = {}
+        for old, n in moving.items():
+            new = max(n, key = n.get)
+            if (old in lost_groups or n[new] * 2 <= self.refs[old] or
+                new in moving or new in moves.values() or
+                self.refs.get(new, 0) >= n[new]):
+                continue
+            moves[old] = new
+
+        return moves
+
+
+    def split(self, wg_devs, count):
+        """
+        create another nexthop group for @wg_devs, to which @count
+        routes staying on @wg_devs refer before the current group is
+        moved by move(). returns id of the new group.
+        """
+
+        nhid = self.alloc_id()
+        self.set_group(nhid, wg_devs)
+        self.splits[wg_devs] = (nhid, count)
+        return nhid
+
+
+    def move(self, old, new):
+        """
+        replace wg devices of the nexthop group from @old to @new, and
+        returns its id. if a group for @new exists, its routes must be
+        switched to the moved group, and it is deleted by collect().
+        """
+
+        nhid = self.groups.pop(old)
+        refs = self.refs.pop(old)
+
+        if old in self.splits:
+            split, count = self.splits.pop(old)
+            self.groups[old] = split
+            self.refs[old] = count
+            refs -= count
+
+        if new in self.groups:
+            self.orphans.add(self.groups[new])
+            refs += self.refs[new]
+
+        self.groups[new] = nhid
+        self.refs[new] = refs
+        self.set_group(nhid, new)
+        return nhid
+
+
+    def forget_devs(self, wg_devs):
+        """
+        forget nexthops of wg devices that are deleted. kernel removes
+        the nexthops from groups, and deletes groups that become empty
+        along with their routes.
+        """
+
+        wg_devs = set(wg_devs)
+        for wg_dev in wg_devs:
+            if wg_dev in self.dev_ids:
+                self.free_id(self.dev_ids.pop(wg_dev))
+
+        for group in [ group for group in self.groups
+                       if wg_devs.issuperset(group) ]:
+            self.free_id(self.groups.pop(group))
+            del self.refs[group]
+
+
+    def reconcile(self, due):
+        """
+        recreate nexthops and nexthop groups of this table that are
+        missing or changed on the kernel.
+        @due: function called with kind and key of a difference before
+              repairing it. the repair is postponed if it returns False.
+        """
+
+        kernel = dict([ (nh["id"], nh)
+                        for nh in self.dataplane.nexthop_dump() ])
+
+        # nexthops of wg devices are recreated by set_group() with new
+        # ids, e.g., after the wg devices are recreated.
+        for wg_dev, nhid in list(self.dev_ids.items()):
+            if kernel.get(nhid, {}).get("dev") == wg_dev:
+                continue
+            if not due("nexthops", ("nexthop", nhid)):
+                continue
+            del self.dev_ids[wg_dev]
+            if nhid in kernel:
+                self.orphans.add(nhid)
+            else:
+                self.free_id(nhid)
+
+        for wg_devs, nhid in self.groups.items():
+            members = set([ self.dev_ids.get(wg_dev) for wg_dev in wg_devs ])
+            if set(kernel.get(nhid, {}).get("group", [])) == members:
+                continue
+            if due("nexthops", ("nexthop", nhid)):
+                self.set_group(nhid, wg_devs)
+
+
+    def collect(self):
+        """
+        delete nexthop groups that no routes refer to, and nexthops
+        that no groups contain.
+        """
+
+        unused = [ group for group, refs in self.refs.items() if refs == 0 ]
+        for group in unused:
+            nhid = self.groups.pop(group)
+            del self.refs[group]
+            self.delete(nhid)
+
+        used = set()
+        for group in self.groups:
+            used.update(group)
+        for wg_dev in [ wg_dev for wg_dev in self.dev_ids
+                        if not wg_dev in used ]:
+            self.delete(self.dev_ids.pop(wg_dev))
+
+        for nhid in self.orphans:
+            self.delete(nhid)
+        self.orphans = set()
+
+
+    def delete(self, nhid):
+        try:
+            self.dataplane.nexthop_del(nhid)
+        except Exception as e:
+            self.logger.error("failed to delete nexthop %d: %s", nhid, e)
+        self.free_id(nhid)
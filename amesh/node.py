@@ -1,11 +1,12 @@
 
 
+import json
 import ipaddress
 
 if not "amesh." in __name__:
-    from static import IPCMD, WGCMD, VERBOSE
+    from static import IPCMD, WGCMD, VERBOSE, ETCD_RECORD_VERSION
 else:
-    from amesh.static import IPCMD, WGCMD, VERBOSE
+    from amesh.static import IPCMD, WGCMD, VERBOSE, ETCD_RECORD_VERSION
 
 from logging import getLogger, INFO, StreamHandler
 from logging.handlers import SysLogHandler
@@ -20,23 +21,28 @@ default_logger.propagate = False
 class Node(object):
 
     def __init__(self,
-                 pubkey = None, endpoint = None, allowed_ips = set(),
-                 keepalive = 0, groups = set(), logger = None):
+                 pubkey = None, endpoint = None, allowed_ips = None,
+                 keepalive = 0, groups = None, logger = None):
 
         self.pubkey = pubkey
         self.endpoint = endpoint
-        self.allowed_ips = allowed_ips
+        self.allowed_ips = set(allowed_ips or ())
         self.keepalive = keepalive
-        self.groups = groups
+        self.groups = set(groups or ())
         self.logger = logger or default_logger
 
+        # version of the record this node is obtained from, or None
+        # when this node is obtained from per-attribute keys.
+        self.record_version = None
+
 
     def __str__(self):
 
         o = "<Node: pubkey={}, endpoint={}".format(self.pubkey, self.endpoint)
 
         if VERBOSE:
-            o += ", alowed_ips={}".format(",".join(self.allowed_ips))
+            o += ", alowed_ips={}".format(",".join(map(str,
+                                                       self.allowed_ips)))
             o += ", keepalive={}".format(self.keepalive)
             o += ", groups={}".format(" ".join(sorted(list(self.groups))))
 
@@ -49,7 +55,7 @@ class Node(object):
         lines = [
             "pubkey:      {}".format(self.pubkey),
             "endpoint:    {}".format(self.endpoint),
-            "allowed_ips: {}".format(", ".join(self.allowed_ips)),
+            "allowed_ips: {}".format(", ".join(map(str, self.allowed_ips))),
             "keepalive:   {}".format(self.keepalive),
             "groups:      {}".format(", ".join(self.groups))
         ]
@@ -115,6 +121,56 @@ class Node(object):
         if allowed_ip in self.allowed_ips:
             self.allowed_ips.remove(allowed_ip)
 
+    def update_record(self, value):
+        """
+        update this node from a record serialized by
+        serialize_for_etcd_record(). returns True if changed.
+        """
+
+        try:
+            record = json.loads(value)
+            version = record["v"]
+        except Exception as e:
+            self.logger.error("failed to parse record: %s, %s", value, e)
+            return False
+
+        if version > ETCD_RECORD_VERSION:
+            self.logger.error("unsupported record version %s", version)
+            return False
+
+        self.record_version = version
+
+        changed = False
+        kvs = [
+            ("pubkey", record.get("pubkey")),
+            ("endpoint", str(record.get("endpoint"))),
+            ("allowed_ips", ",".join(record.get("allowed_ips", []))),
+            ("keepalive", str(record.get("keepalive", 0))),
+            ("groups", ",".join(record.get("groups", []))),
+        ]
+        for k, v in kvs:
+            if self.update(k, v):
+                changed = True
+
+        return changed
+
+
+    def serialize_for_etcd_record(self, etcd_prefix, node_id):
+        """
+        serialize this node into a single key with a compact value.
+        """
+        record = {
+            "v": ETCD_RECORD_VERSION,
+            "pubkey": self.pubkey,
+            "endpoint": self.endpoint,
+            "allowed_ips": sorted(map(str, self.allowed_ips)),
+            "keepalive": int(self.keepalive),
+            "groups": sorted(self.groups),
+        }
+        value = json.dumps(record, separators = (",", ":"), sort_keys = True)
+        return { "{}/{}".format(etcd_prefix, node_id): value }
+
+
     def serialize_for_etcd(self, etcd_prefix, node_id):
         p = "{}/{}".format(etcd_prefix, node_id)
 
@@ -127,3 +183,68 @@ class Node(object):
         }
 
 
+
+
+class NodeTable(dict):
+
+    def __init__(self, *args, **kwargs):
+        """
+        NodeTable: dict of node_id and Node with an index of groups.
+        group_index is a dict of group and set of node_ids of the
+        nodes belonging to the group. index() must be called when
+        groups of a node in the table are changed.
+        """
+        super().__init__(*args, **kwargs)
+        self.group_index = {}
+
+        # groups of nodes when they were indexed
+        self.indexed_groups = {}
+
+        for node_id in self:
+            self.index(node_id)
+
+    def __setitem__(self, node_id, node):
+        super().__setitem__(node_id, node)
+        self.index(node_id)
+
+    def __delitem__(self, node_id):
+        self.unindex(node_id)
+        super().__delitem__(node_id)
+
+    def index(self, node_id):
+        """
+        update group_index for the current groups of the node.
+        """
+
+        groups = self[node_id].groups
+        old = self.indexed_groups.get(node_id, ())
+        if groups == old:
+            return
+
+        self.unindex(node_id)
+        for group in groups:
+            if not group in self.group_index:
+                self.group_index[group] = set()
+            self.group_index[group].add(node_id)
+        self.indexed_groups[node_id] = frozenset(groups)
+
+    def unindex(self, node_id):
+        for group in self.indexed_groups.pop(node_id, ()):
+            members = self.group_index[group]
+            members.discard(node_id)
+            if not members:
+                del self.group_index[group]
+
+    def select(self, groups):
+        """
+        returns node_ids of nodes sharing a group with @groups. the
+        "any" group matches all the nodes.
+        """
+
+        if "any" in groups:
+            return self.keys()
+
+        node_ids = set(self.group_index.get("any", ()))
+        for group in groups:
+            node_ids |= self.group_index.get(group, set())
+        return node_ids
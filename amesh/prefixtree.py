@@ -0,0 +1,422 @@
+
+import ipaddress
+
+
+# PrefixTreeNode.agg of a node whose aggregation is not computed yet
+UNKNOWN = object()
+
+
+class PrefixTreeNode(object):
+
+    __slots__ = ("addr", "plen", "prefix", "value", "children", "agg")
+
+    def __init__(self, addr, plen, prefix = None, value = None):
+        """
+        PrefixTreeNode: a node of PrefixTree
+        @addr: network address as an integer
+        @plen: prefix length
+        @prefix: ip_network if this node holds a value, otherwise None
+        @value: value for the prefix
+
+        agg caches key(value) that the subtree of this node aggregates
+        into, None if it does not, or UNKNOWN.
+        """
+        self.addr = addr
+        self.plen = plen
+        self.prefix = prefix
+        self.value = value
+        self.children = [ None, None ]
+        self.agg = UNKNOWN
+
+
+class PrefixTree(object):
+
+    def __init__(self):
+        """
+        PrefixTree: path-compressed binary radix tree of IP prefixes.
+        @prefix is an ipaddress.ip_network. IPv4 and IPv6 prefixes are
+        stored in separate trees.
+
+        PrefixTree works as a dict of prefix and value, and provides
+        longest prefix match, covering and covered prefixes, and
+        aggregation of contiguous prefixes.
+        """
+        self.roots = {}
+        self.count = 0
+
+        # PrefixTree of the last aggregation. values are (key(value),
+        # True if the prefix aggregates its subtree).
+        self.aggregated = None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, prefix):
+        return self.find(prefix) is not None
+
+    def __getitem__(self, prefix):
+        node = self.find(prefix)
+        if node is None:
+            raise KeyError(prefix)
+        return node.value
+
+    def __setitem__(self, prefix, value):
+        self.insert(prefix, value)
+
+    def __delitem__(self, prefix):
+        if not self.remove(prefix):
+            raise KeyError(prefix)
+
+    def __iter__(self):
+        for node in self.walk():
+            yield node.prefix
+
+    def get(self, prefix, default = None):
+        node = self.find(prefix)
+        return default if node is None else node.value
+
+    def items(self):
+        for node in self.walk():
+            yield node.prefix, node.value
+
+
+    def key(self, prefix):
+        return (int(prefix.network_address), prefix.prefixlen,
+                prefix.max_prefixlen)
+
+
+    def descend(self, prefix):
+        """
+        returns list of nodes from the root toward @prefix. the last
+        node is the node at @prefix, or the first node under @prefix
+        if exists.
+        """
+
+        addr, plen, maxbits = self.key(prefix)
+        node = self.roots.get(prefix.version)
+        path = []
+
+        while node is not None:
+            if node.plen > plen:
+                if not (node.addr ^ addr) >> (maxbits - plen):
+                    path.append(node)
+                break
+            shift = maxbits - node.plen
+            if (node.addr ^ addr) >> shift:
+                break
+            path.append(node)
+            if node.plen == plen:
+                break
+            node = node.children[(addr >> (shift - 1)) & 1]
+
+        return path
+
+
+    def find(self, prefix):
+        """
+        returns PrefixTreeNode holding the value of @prefix, or None.
+        """
+        path = self.descend(prefix)
+        if (path and path[-1].plen == prefix.prefixlen and
+            path[-1].prefix is not None):
+            return path[-1]
+        return None
+
+
+    def insert(self, prefix, value):
+
+        addr, plen, maxbits = self.key(prefix)
+        if not prefix.version in self.roots:
+            self.roots[prefix.version] = PrefixTreeNode(0, 0)
+        node = self.roots[prefix.version]
+
+        while True:
+
+            node.agg = UNKNOWN
+
+            if node.plen == plen:
+                # node for this prefix exists (maybe a glue node)
+                if node.prefix is None:
+                    node.prefix = prefix
+                    self.count += 1
+                node.value = value
+                return
+
+            b = (addr >> (maxbits - node.plen - 1)) & 1
+            child = node.children[b]
+
+            if child is None:
+                node.children[b] = PrefixTreeNode(addr, plen, prefix, value)
+                self.count += 1
+                return
+
+            diff = (addr ^ child.addr).bit_length()
+            if child.plen <= plen and diff <= maxbits - child.plen:
+                # child covers the prefix
+                node = child
+                continue
+
+            # child and prefix diverge. insert the prefix, or a glue
+            # node at the common part, between node and child.
+            common = min(plen, child.plen, maxbits - diff)
+            if common == plen:
+                new = PrefixTreeNode(addr, plen, prefix, value)
+            else:
+                new = PrefixTreeNode(addr >> (maxbits - common)
+                                     << (maxbits - common), common)
+                new.children[(addr >> (maxbits - common - 1)) & 1] = (
+                    PrefixTreeNode(addr, plen, prefix, value))
+            new.children[(child.addr >> (maxbits - common - 1)) & 1] = child
+            node.children[b] = new
+            self.count += 1
+            return
+
+
+    def remove(self, prefix):
+        """
+        remove @prefix. returns True if it was in the tree.
+        """
+
+        path = self.descend(prefix)
+        if (not path or path[-1].plen != prefix.prefixlen or
+            path[-1].prefix is None):
+            return False
+
+        for node in path:
+            node.agg = UNKNOWN
+
+        node = path.pop()
+        node.prefix = None
+        node.value = None
+        self.count -= 1
+
+        # remove glue nodes that have no longer two children. root
+        # is kept even if it is empty.
+        while path and node.prefix is None:
+            children = [ c for c in node.children if c ]
+            if len(children) == 2:
+                break
+            parent = path.pop()
+            b = parent.children.index(node)
+            parent.children[b] = children[0] if children else None
+            node = parent
+
+        return True
+
+
+    def walk(self, node = None):
+        """
+        yields PrefixTreeNodes holding values under @node (all
+        prefixes if None) in the order of address and prefix length.
+        """
+        stack = [ node ] if node else [ self.roots[v]
+                                        for v in sorted(self.roots,
+                                                        reverse = True) ]
+        while stack:
+            node = stack.pop()
+            if node.prefix is not None:
+                yield node
+            stack += [ c for c in reversed(node.children) if c ]
+
+
+    def lookup(self, address):
+        """
+        longest prefix match. returns (prefix, value) of the longest
+        prefix containing @address, or (None, None).
+        """
+        address = ipaddress.ip_address(address)
+        found = (None, None)
+        for node in self.descend(ipaddress.ip_network(address)):
+            if node.prefix is not None:
+                found = (node.prefix, node.value)
+        return found
+
+
+    def overlaps(self, prefix):
+        """
+        yields (prefix, value) of prefixes that contain @prefix,
+        longest first, and then prefixes contained in @prefix.
+        @prefix itself is excluded.
+        """
+
+        plen = prefix.prefixlen
+        path = self.descend(prefix)
+
+        for node in reversed(path):
+            if node.plen < plen and node.prefix is not None:
+                yield node.prefix, node.value
+
+        if path and (path[-1].plen > plen or
+                     path[-1].plen == plen and any(path[-1].children)):
+            for node in self.walk(path[-1]):
+                if node.plen > plen:
+                    yield node.prefix, node.value
+
+
+    def aggregate(self, key = None):
+        """
+        returns dict of prefix and key(value) where two prefixes that
+        are halves of a prefix and have the same key(value) are
+        replaced by the prefix, recursively. longest prefix match on
+        the returned dict gives the same result as on this tree.
+        @key: function to obtain comparable value, e.g., nexthop set
+        """
+
+        key = key or (lambda value: value)
+        self.aggregated = PrefixTree()
+
+        aggregated = {}
+        for version, root in self.roots.items():
+            for node in self.walk_nodes(root):
+                node.agg = UNKNOWN
+            for prefix, value, whole in self.aggregate_node(root, key,
+                                                            version):
+                self.aggregated[prefix] = (value, whole)
+                aggregated[prefix] = value
+
+        return aggregated
+
+
+    def aggregate_update(self, prefixes, key = None):
+        """
+        update the last aggregation for @prefixes, which are added,
+        removed or whose key(value) is changed since then. returns
+        dict of aggregated prefix and key(value) changed, where the
+        value is None for a removed prefix. @key must be the same as
+        that of the last aggregate().
+
+        only the subtree under the shortest prefix that aggregates
+        the changed prefix, before or after the change, is
+        aggregated again. the other prefixes are not affected.
+        """
+
+        if self.aggregated is None:
+            return self.aggregate(key)
+
+        key = key or (lambda value: value)
+
+        for prefix in prefixes:
+            for node in self.descend(prefix):
+                node.agg = UNKNOWN
+
+        regions = []
+        for prefix in prefixes:
+            region = prefix
+            for node in self.aggregated.descend(prefix):
+                if node.plen > prefix.prefixlen:
+                    break
+                if node.prefix is not None and node.value[1]:
+                    region = node.prefix
+                    break
+            for node in self.descend(prefix):
+                if node.plen >= region.prefixlen:
+                    break
+                if self.aggregate_key(node, key) is not None:
+                    region = type(prefix)((node.addr, node.plen))
+                    break
+            regions.append(region)
+
+        # regions covered by other regions are aggregated with them
+        covering = PrefixTree()
+        for region in sorted(regions, key = lambda p: p.prefixlen):
+            if not any([ node.prefix is not None and
+                         node.plen <= region.prefixlen
+                         for node in covering.descend(region) ]):
+                covering[region] = None
+
+        changed = {}
+        for region in covering:
+
+            old = {}
+            node = self.subtree(self.aggregated, region)
+            if node:
+                old = dict([ (n.prefix, n.value)
+                             for n in self.aggregated.walk(node) ])
+
+            new = {}
+            node = self.subtree(self, region)
+            if node:
+                new = dict([ (prefix, (value, whole)) for prefix, value, whole
+                             in self.aggregate_node(node, key,
+                                                    region.version) ])
+
+            for prefix in set(old) | set(new):
+                if prefix in new:
+                    self.aggregated[prefix] = new[prefix]
+                else:
+                    del self.aggregated[prefix]
+                value = new.get(prefix, (None, False))[0]
+                if old.get(prefix, (None, False))[0] != value:
+                    changed[prefix] = value
+
+        return changed
+
+
+    def subtree(self, tree, prefix):
+        """
+        returns the top node of @tree under @prefix, or None.
+        """
+        path = tree.descend(prefix)
+        if path and path[-1].plen >= prefix.prefixlen:
+            return path[-1]
+        return None
+
+
+    def walk_nodes(self, node):
+        """
+        yields all nodes under @node including glue nodes.
+        """
+        stack = [ node ]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack += [ c for c in node.children if c ]
+
+
+    def aggregate_key(self, node, key):
+        """
+        returns key(value) that the subtree of @node aggregates into,
+        i.e., the subtree is a single prefix of @node after
+        aggregation, or None. the result is cached in the node.
+        """
+
+        if node.agg is not UNKNOWN:
+            return node.agg
+
+        own = key(node.value) if node.prefix is not None else None
+        c0, c1 = node.children
+
+        agg = None
+        if not c0 and not c1:
+            agg = own
+        elif (c0 and c1 and c0.plen == node.plen + 1 and
+              c1.plen == node.plen + 1):
+            value = self.aggregate_key(c0, key)
+            if (value is not None and
+                value == self.aggregate_key(c1, key) and
+                own in (None, value)):
+                agg = value
+
+        node.agg = agg
+        return agg
+
+
+    def aggregate_node(self, node, key, version):
+        """
+        yields (prefix, key(value), whole) for the subtree of @node
+        after aggregation. whole is True if the prefix aggregates its
+        subtree.
+        """
+
+        network = (ipaddress.IPv4Network if version == 4 else
+                   ipaddress.IPv6Network)
+        stack = [ node ]
+        while stack:
+            node = stack.pop()
+            value = self.aggregate_key(node, key)
+            if value is not None:
+                yield network((node.addr, node.plen)), value, True
+                continue
+            if node.prefix is not None:
+                yield node.prefix, key(node.value), False
+            stack += [ c for c in node.children if c ]
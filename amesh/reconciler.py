@@ -0,0 +1,170 @@
+import time
+
+if not "amesh." in __name__:
+    from fib import DRIFT_KINDS
+    from metrics import Metrics
+    from static import RECONCILE_BACKOFF, RECONCILE_BACKOFF_MAX
+else:
+    from amesh.fib import DRIFT_KINDS
+    from amesh.metrics import Metrics
+    from amesh.static import RECONCILE_BACKOFF, RECONCILE_BACKOFF_MAX
+
+
+from logging import getLogger, INFO, StreamHandler
+from logging.handlers import SysLogHandler
+default_logger = getLogger(__name__)
+default_logger.setLevel(INFO)
+stream = StreamHandler()
+syslog = SysLogHandler(address = "/dev/log")
+default_logger.addHandler(stream)
+default_logger.addHandler(syslog)
+default_logger.propagate = False
+
+
+class Reconciler(object):
+
+    def __init__(self, metrics = None, backoff = RECONCILE_BACKOFF,
+                 backoff_max = RECONCILE_BACKOFF_MAX, logger = None):
+        """
+        Reconciler: repairs differences between Fib and the dataplane
+        @metrics: Metrics to count differences and repairs
+        @backoff: seconds before a difference is repaired again
+        @backoff_max: max seconds before a difference is repaired again
+        @logger: logger
+
+        reconcile() is called when due() returns True. A difference
+        is repaired as soon as it is found. If it is still found after
+        the repair, e.g., the operation failed, it is queued for retry
+        and repaired again after @backoff seconds, which doubles for
+        each retry up to @backoff_max. Differences left by failed
+        operations of Fib updates are queued by enqueue(), and
+        repaired after @backoff seconds in the same way. A difference
+        that is no longer found leaves the retry queue.
+        """
+
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.metrics = metrics or Metrics()
+        self.logger = logger or default_logger
+
+        # retry queue. key is a difference, value is the number of
+        # repairs and the time when it is repaired again.
+        self.retries = {}
+
+        # differences found in the current pass
+        self.found = set()
+        self.now = 0
+
+        # time when the last pass started
+        self.last = None
+
+        m = self.metrics
+        self.m_runs = m.counter("amesh_reconcile_runs_total",
+                                "passes comparing Fib with the dataplane")
+        self.m_failures = m.counter("amesh_reconcile_failures_total",
+                                    "passes failed to dump the dataplane")
+        self.m_seconds = m.histogram("amesh_reconcile_seconds",
+                                     "latency of reconciliation passes")
+        m.gauge("amesh_reconcile_retry_queue",
+                "differences waiting for retries",
+                function = lambda: len(self.retries))
+        self.m_drift = {}
+        self.m_repairs = {}
+        self.m_enqueued = {}
+        for kind in DRIFT_KINDS:
+            labels = { "kind": kind }
+            self.m_drift[kind] = m.gauge(
+                "amesh_reconcile_drift",
+                "differences found by the last pass", labels)
+            self.m_repairs[kind] = m.counter(
+                "amesh_reconcile_repairs_total",
+                "repairs of differences", labels)
+            self.m_enqueued[kind] = m.counter(
+                "amesh_reconcile_enqueued_total",
+                "differences queued by failed operations", labels)
+
+
+    def enqueue(self, failures):
+        """
+        queue differences left by failed operations for retry.
+        @failures: set of (kind, key), e.g., from Dataplane.failures()
+        """
+
+        now = time.monotonic()
+        for kind, key in failures:
+            self.m_enqueued[kind].inc()
+            if not key in self.retries:
+                # the failed operation counts as the first repair
+                self.retries[key] = (1, now + self.backoff)
+
+
+    def pending(self, interval):
+        """
+        returns True if a pass is due: @interval seconds after the
+        last pass, or a difference in the retry queue is due. 0 for
+        @interval disables periodic passes. passes for retries are
+        @backoff seconds apart at least.
+        """
+
+        now = time.monotonic()
+        if interval > 0 and (self.last is None or
+                             now >= self.last + interval):
+            return True
+        if self.last is not None and now < self.last + self.backoff:
+            return False
+        return any([ retry <= now for repairs, retry
+                     in self.retries.values() ])
+
+
+    def reconcile(self, fib):
+        """
+        compare @fib with the dataplane and repair the differences.
+        returns dict of kinds of differences and the numbers of them.
+        """
+
+        start = time.monotonic()
+        self.now = start
+        self.last = start
+        self.found = set()
+
+        self.m_runs.inc()
+        try:
+            drift = fib.reconcile(due = self.due)
+        except Exception:
+            self.m_failures.inc()
+            raise
+
+        # differences not found in this pass are repaired
+        for key in set(self.retries) - self.found:
+            del self.retries[key]
+
+        for kind, n in drift.items():
+            self.m_drift[kind].set(n)
+
+        self.m_seconds.observe(time.monotonic() - start)
+
+        if any(drift.values()):
+            self.logger.warning("dataplane drift: %s, %d in retry queue",
+                                ", ".join([ "{} {}".format(kind, n)
+                                            for kind, n in drift.items()
+                                            if n ]),
+                                len(self.retries))
+        return drift
+
+
+    def due(self, kind, key):
+        """
+        called by Fib.reconcile() for a difference @key. returns True
+        if it is repaired now, or False if it waits for the backoff.
+        """
+
+        self.found.add(key)
+
+        repairs, retry = self.retries.get(key, (0, 0))
+        if retry > self.now:
+            return False
+
+        backoff = min(self.backoff * 2 ** repairs, self.backoff_max)
+        self.retries[key] = (repairs + 1, self.now + backoff)
+        self.m_repairs[kind].inc()
+        return True
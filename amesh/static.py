@@ -9,6 +9,57 @@ WGCMD = "/usr/bin/wg"
 
 VERBOSE = True
 
+# control plane engine: "threads" runs the etcd maintainer and watcher
+# as threads, and "asyncio" runs them as tasks on an event loop
+ENGINE = "threads"
+
+# dataplane backend to program links and routes: "netlink" or "ipcmd"
+DATAPLANE = "ipcmd"
+
+# number of threads that program independent wg devices in parallel.
+# 1 programs them one by one.
+DATAPLANE_WORKERS = 1
+
+# install routes through kernel nexthop groups (linux 5.3 or later),
+# and nexthop ids used by amesh are allocated from NEXTHOP_ID_BASE.
+# amesh instances on a host need different bases.
+NEXTHOP_GROUPS = False
+NEXTHOP_ID_BASE = 0x41000000
+NEXTHOP_ID_RANGE = 0x100000
+
+# interval (sec) of comparing Fib with the dataplane and repairing the
+# differences, 0 disables it. a difference still found after a repair,
+# or left by a failed operation, is repaired again after the backoff
+# (sec) doubling up to the max.
+RECONCILE_INTERVAL = 0
+RECONCILE_BACKOFF = 1
+RECONCILE_BACKOFF_MAX = 60
+
+# seconds without response from a server while sending to it before
+# its wg device is withdrawn from ECMP routes, 0 disables it. liveness
+# is checked FAILOVER_CHECKS times per the timeout. withdrawn peers
+# have the probe keepalive (sec) to keep initiating handshakes.
+FAILOVER_TIMEOUT = 0
+FAILOVER_CHECKS = 3
+FAILOVER_MIN_TX_BYTES = 256
+FAILOVER_PROBE_KEEPALIVE = 1
+
 ETCD_LEASE_KEEPALIVE = 5
 ETCD_LEASE_LIFETIME = ETCD_LEASE_KEEPALIVE * 3
 
+# format of node entries on etcd: "keys" stores each attribute of a
+# node as a key, and "record" stores a node as a single key.
+ETCD_RECORD_FORMAT = "keys"
+ETCD_RECORD_VERSION = 1
+
+# publish nodes under <etcd_prefix>/groups/<group>/ of their groups,
+# and watch only the groups that self belongs to and "any"
+ETCD_GROUP_SHARDING = False
+
+# address changes on tracked devices within this window (msec) are
+# published to etcd at once
+ADDRESS_DEBOUNCE = 100
+
+# coalescing etcd watch events (msec) and max events in a batch
+ETCD_WATCH_COALESCE_WINDOW = 20
+ETCD_WATCH_COALESCE_MAX_BATCH = 1024
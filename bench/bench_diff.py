@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# micro benchmark of the set differences that Fib.update_diff()
+# performs on peers and routes. --rev runs it on amesh of a git
+# revision, e.g., the baseline, to compare before and after a change.
+#
+
+import io
+import os
+import sys
+import time
+import inspect
+import tarfile
+import argparse
+import tempfile
+import ipaddress
+import subprocess
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def import_amesh(root):
+    """
+    import Node, Peer and Route of amesh under @root.
+    """
+    global Node, Peer, Route
+
+    sys.path.insert(0, root)
+    from amesh.node import Node
+    from amesh.fib import Peer, Route
+
+
+def export_rev(rev, root):
+    """
+    extract amesh of git revision @rev into @root.
+    """
+    out = subprocess.check_output([ "git", "-C", TOPDIR, "archive",
+                                    "--format=tar", rev, "amesh" ])
+    with tarfile.open(fileobj = io.BytesIO(out)) as tar:
+        tar.extractall(root)
+
+
+def new_route(devs, prefix):
+    if "wg_devs" in inspect.signature(Route).parameters:
+        return Route(devs, prefix, None)
+
+    # Route of old revisions takes a device, and appends the others
+    route = Route(devs[0], prefix, None)
+    for dev in devs[1:]:
+        route.append_nexthop_dev(dev)
+    return route
+
+
+def make_peers(npeers, nips, changed, reverse = False):
+
+    peers = []
+    for n in range(npeers):
+        ips = [ ipaddress.ip_network((0x0a000000 + n * nips + i, 32))
+                for i in range(nips) ]
+        if reverse:
+            # same allowed_ips, different insertion order
+            ips.reverse()
+        node = Node(pubkey = "{:043d}=".format(n),
+                    endpoint = "192.168.{}.{}:51820".format(n >> 8, n & 0xff),
+                    allowed_ips = set(ips),
+                    keepalive = 10 if n < changed else 0)
+        peers.append(Peer("wg0", node, None))
+    return peers
+
+
+def make_routes(nroutes, changed):
+
+    routes = []
+    for n in range(nroutes):
+        devs = [ "wg-{:010d}".format(n % 100) ]
+        if n < changed:
+            devs.append("wg-{:010d}".format((n + 1) % 100))
+        prefix = ipaddress.ip_network((0x0a000000 + n, 32))
+        routes.append(new_route(devs, prefix))
+    return routes
+
+
+def bench(name, old, new):
+
+    start = time.perf_counter()
+    old_set = set(old)
+    new_set = set(new)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    removed = old_set - new_set
+    added = new_set - old_set
+    diff = time.perf_counter() - start
+
+    print("{:8s} {:>8d} build {:8.4f} sec, diff {:8.4f} sec, "
+          "removed {:>7d}, added {:>7d}".format(name, len(old), build, diff,
+                                              len(removed), len(added)))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--peers", type = int, default = 10000,
+                        help = "number of peers")
+    parser.add_argument("-r", "--routes", type = int, default = 100000,
+                        help = "number of routes")
+    parser.add_argument("-i", "--allowed-ips", type = int, default = 4,
+                        help = "allowed_ips per peer")
+    parser.add_argument("-c", "--changed", type = int, default = 100,
+                        help = "number of changed peers and routes")
+    parser.add_argument("--rev", default = None,
+                        help = "git revision of amesh to benchmark "
+                        "instead of the working tree")
+    args = parser.parse_args()
+
+    if args.rev:
+        tmpdir = tempfile.TemporaryDirectory()
+        export_rev(args.rev, tmpdir.name)
+        import_amesh(tmpdir.name)
+        print("amesh at {}".format(args.rev))
+    else:
+        import_amesh(TOPDIR)
+
+    # peers that differ by keepalive, and equal peers whose allowed_ips
+    # are inserted in different order (removed and added must be 0)
+    bench("peers", make_peers(args.peers, args.allowed_ips, 0),
+          make_peers(args.peers, args.allowed_ips, args.changed))
+    bench("peers-eq", make_peers(args.peers, args.allowed_ips, 0),
+          make_peers(args.peers, args.allowed_ips, 0, reverse = True))
+    bench("routes", make_routes(args.routes, 0),
+          make_routes(args.routes, args.changed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+#
+# benchmark of Fib on synthetic node tables. Fib is programmed into
+# FakeDataplane of the tests, which records kernel operations instead
+# of executing them. Results are written in JSON.
+#
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "tests"))
+
+from amesh.node import Node, NodeTable
+from amesh.fib import Fib
+from amesh.nexthop import NexthopTable
+
+from fake_dataplane import FakeDataplane
+
+
+logger = logging.getLogger("bench")
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class BenchDataplane(FakeDataplane):
+    """
+    FakeDataplane of the tests that also records route batches.
+    """
+
+    def route_batch(self, batch):
+        self.ops.append(("route_batch",))
+        super().route_batch(batch)
+
+    def state(self):
+        """
+        returns a copy of the resulting state, which restore() sets
+        back.
+        """
+        return copy.deepcopy((self.links, self.peers, self.routes,
+                              self.nexthops, self.owned_links))
+
+    def restore(self, state):
+        (self.links, self.peers, self.routes,
+         self.nexthops, self.owned_links) = state
+
+
+class Mesh(object):
+
+    def __init__(self, nodes, groups, servers, allowed_ips, seed):
+        """
+        Mesh: key/values of a synthetic mesh as stored on etcd
+        @nodes: number of nodes
+        @groups: number of groups
+        @servers: ratio of nodes having endpoints
+        @allowed_ips: number of allowed_ips per node
+        @seed: random seed
+        """
+        self.groups = groups
+        self.servers = servers
+        self.allowed_ips = allowed_ips
+        self.random = random.Random(seed)
+        self.serial = 0
+        self.kvs = {}
+        for n in range(nodes):
+            self.add()
+
+    def add(self):
+
+        n = self.serial
+        self.serial += 1
+
+        groups = set([ "g{}".format(self.random.randrange(self.groups))
+                       for x in range(self.random.randint(1, 2)) ])
+        endpoint = None
+        if self.random.random() < self.servers:
+            endpoint = "192.0.{}.{}:51820".format((n >> 8) & 0xff, n & 0xff)
+
+        # allowed_ips are /32s in 10.0.0.0/8, contiguous per node
+        base = 0x0a000000 + n * self.allowed_ips
+        ips = [ "{}.{}.{}.{}/32".format((a >> 24) & 0xff, (a >> 16) & 0xff,
+                                        (a >> 8) & 0xff, a & 0xff)
+                for a in range(base, base + self.allowed_ips) ]
+
+        node_id = "node{}".format(n)
+        self.kvs[node_id] = [
+            ("pubkey", "{:010d}{:032d}A=".format(n, 0)),
+            ("endpoint", str(endpoint)),
+            ("allowed_ips", ",".join(ips)),
+            ("keepalive", "0"),
+            ("groups", ",".join(sorted(groups))),
+        ]
+        return node_id
+
+    def remove(self, node_id):
+        del self.kvs[node_id]
+
+    def change(self, node_id):
+        # a node moves to another endpoint
+        kvs = dict(self.kvs[node_id])
+        kvs["endpoint"] = "198.51.100.{}:{}".format(
+            self.random.randrange(256), self.random.randrange(1024, 65536))
+        self.kvs[node_id] = list(kvs.items())
+
+    def node_table(self, node_ids = None):
+        node_table = NodeTable()
+        for node_id in node_ids or self.kvs:
+            node = Node(logger = logger)
+            for key, value in self.kvs[node_id]:
+                node.update(key, value)
+            node_table[node_id] = node
+        return node_table
+
+
+def self_node(groups):
+    node = Node(logger = logger)
+    node.update("pubkey", "{:042d}S=".format(0))
+    node.update("endpoint", "192.0.2.1:51820")
+    node.update("allowed_ips", "172.16.0.1/32")
+    node.update("groups", groups)
+    return node
+
+
+def measure(func):
+    start = time.perf_counter()
+    ret = func()
+    return ret, time.perf_counter() - start
+
+
+def tally_ops(dp):
+    """
+    returns dict of operations recorded by @dp and their numbers.
+    """
+    ops = {}
+    for op in dp.ops:
+        ops[op[0]] = ops.get(op[0], 0) + 1
+        if op[0] == "wg_addconf":
+            ops["wg_addconf_peers"] = (ops.get("wg_addconf_peers", 0) +
+                                       len(op[2]))
+    return ops
+
+
+def count_ops(ops):
+    # wg_addconf_peers is not an operation but peers in wg_addconf
+    return sum([ v for k, v in ops.items() if k != "wg_addconf_peers" ])
+
+
+def run_scenario(scenario, args, nodes, trace):
+    """
+    run a scenario and returns dict of the result.
+    """
+
+    mesh = Mesh(nodes, args.groups, args.servers, args.allowed_ips,
+                args.seed)
+    me = self_node(args.self_groups)
+    dp = BenchDataplane(logger = logger)
+    dp.add_link("wg0")
+    nt = None
+    if args.nexthop_groups:
+        nt = NexthopTable(dp, logger = logger)
+
+    def fib(node_table):
+        return Fib("wg0", me, node_table, "/dev/null", None,
+                   dataplane = dp, shared_dev = args.shared_device,
+                   nexthop_table = nt, logger = logger)
+
+    # install the state before the scenario
+    old = fib({} if scenario == "cold" else mesh.node_table())
+    old.update_diff(fib({}))
+    state = dp.state()
+    if nt:
+        # the full rebuild changes the nexthop table
+        old.nexthop_table = copy.deepcopy(nt, { id(dp): dp })
+
+    # change the mesh
+    if scenario in ("cold", "join"):
+        changed = [ mesh.add() ] if scenario == "join" else list(mesh.kvs)
+    elif scenario == "leave":
+        changed = [ "node{}".format(nodes // 2) ]
+        mesh.remove(changed[0])
+    elif scenario == "churn":
+        changed = mesh.random.sample(sorted(mesh.kvs),
+                                     max(1, int(nodes * args.churn)))
+        for node_id in changed:
+            mesh.change(node_id)
+
+    if trace:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    node_table, node_update = measure(mesh.node_table)
+
+    # full rebuild: Fib.__init__ and Fib.update_diff
+    dp.clear()
+    new, fib_init = measure(lambda: fib(node_table))
+    x, update_diff = measure(lambda: new.update_diff(old))
+    ops = tally_ops(dp)
+
+    # incremental update from the same old state
+    dp.clear()
+    dp.restore(state)
+    x, update_nodes = measure(lambda: old.update_nodes(node_table, changed))
+    incremental_ops = tally_ops(dp)
+
+    wall = time.perf_counter() - start
+
+    result = {
+        "scenario": scenario,
+        "nodes": nodes,
+        "changed_nodes": len(changed),
+        "peers": len(new.peers),
+        "routes": len(new.routes),
+        "wg_devices": len(set([ peer.wg_dev for peer in new.peers ])),
+        "wall_seconds": wall,
+        "node_update_seconds": node_update,
+        "fib_init_seconds": fib_init,
+        "update_diff_seconds": update_diff,
+        "update_nodes_seconds": update_nodes,
+        "ops": ops,
+        "ops_total": count_ops(ops),
+        "incremental_ops": incremental_ops,
+        "incremental_ops_total": count_ops(incremental_ops),
+    }
+
+    if trace:
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Fib benchmark")
+    parser.add_argument("-n", "--nodes", default = "1000,10000,50000",
+                        help = "comma-separated numbers of nodes")
+    parser.add_argument("-s", "--scenarios",
+                        default = "cold,join,leave,churn",
+                        help = "comma-separated scenarios")
+    parser.add_argument("-g", "--groups", type = int, default = 4,
+                        help = "number of groups")
+    parser.add_argument("--self-groups", default = "any",
+                        help = "comma-separated groups of self node")
+    parser.add_argument("-r", "--servers", type = float, default = 0.1,
+                        help = "ratio of nodes having endpoints")
+    parser.add_argument("-a", "--allowed-ips", type = int, default = 2,
+                        help = "allowed_ips per node")
+    parser.add_argument("-c", "--churn", type = float, default = 0.1,
+                        help = "ratio of nodes changed in churn scenario")
+    parser.add_argument("--shared-device", default = None,
+                        help = "shared wg device for outbound peers")
+    parser.add_argument("--nexthop-groups", action = "store_true",
+                        help = "install routes through nexthop groups")
+    parser.add_argument("--seed", type = int, default = 1,
+                        help = "random seed")
+    parser.add_argument("--no-memory", action = "store_true",
+                        help = "do not measure peak memory")
+    parser.add_argument("-o", "--output", default = "-",
+                        help = "output JSON file, '-' for stdout")
+    args = parser.parse_args()
+
+    results = []
+    for nodes in map(int, args.nodes.split(",")):
+        for scenario in args.scenarios.split(","):
+            result = run_scenario(scenario, args, nodes, False)
+            if not args.no_memory:
+                # tracemalloc slows down everything, so that peak
+                # memory is measured in another run.
+                traced = run_scenario(scenario, args, nodes, True)
+                result["peak_memory_bytes"] = traced["peak_memory_bytes"]
+            results.append(result)
+            print("{:6s} {:>6d} nodes: wall {:8.3f} sec, {:>7d} ops, "
+                  "{:>5d} incremental ops"
+                  .format(scenario, nodes, result["wall_seconds"],
+                          result["ops_total"],
+                          result["incremental_ops_total"]),
+                  file = sys.stderr)
+
+    output = {
+        "benchmark": "fib",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "groups": args.groups,
+            "self_groups": args.self_groups,
+            "servers": args.servers,
+            "allowed_ips": args.allowed_ips,
+            "churn": args.churn,
+            "seed": args.seed,
+            "shared_device": args.shared_device,
+            "nexthop_groups": args.nexthop_groups,
+        },
+        "results": results,
+    }
+
+    if args.output == "-":
+        json.dump(output, sys.stdout, indent = 2, sort_keys = True)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent = 2, sort_keys = True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import os
+import sys
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+# etcd3 ships protobuf modules generated by an old protoc, which the
+# C++ implementation of recent protobuf refuses to load.
+os.environ.setdefault("PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION", "python")
+
+
+@pytest.fixture
+def logger():
+    """
+    logger that propagates to the root logger captured by pytest,
+    instead of the syslog handler of amesh modules.
+    """
+    logger = logging.getLogger("amesh-test")
+    logger.setLevel(logging.DEBUG)
+    return logger
@@ -0,0 +1,267 @@
+import ipaddress
+
+from amesh.dataplane import Dataplane
+from amesh.node import Node
+
+
+class FakeDataplane(Dataplane):
+
+    def __init__(self, logger = None):
+        """
+        FakeDataplane: records operations instead of executing them,
+        and keeps the state that the kernel would have after them.
+
+        ops is the list of operations in the order they are issued.
+        route operations are recorded when the batch is sent. links,
+        peers, routes and nexthops are the resulting state. errors
+        are operations the kernel would reject, e.g., adding a route
+        that exists. operations in broken fail as the kernel or the
+        commands failed, e.g., "route_add" or "wg_addconf".
+        """
+        super().__init__(logger = logger)
+
+        self.ops = []
+        self.errors = []
+        self.broken = set()
+
+        # key is device, value is master device or None
+        self.links = {}
+
+        # key is wg device, value is dict of pubkey and dict of
+        # endpoint, allowed_ips, keepalive, latest_handshake,
+        # rx_bytes and tx_bytes
+        self.peers = {}
+
+        # key is prefix, value is (wg devices, nexthop id)
+        self.routes = {}
+
+        # key is nexthop id, value is dict of dev or group
+        self.nexthops = {}
+
+    def add_link(self, dev, master = None):
+        """
+        add a wg device that exists before amesh starts.
+        """
+        self.links[dev] = master
+        self.peers[dev] = {}
+
+    def clear(self):
+        self.ops = []
+
+    def route_table(self):
+        """
+        returns dict of prefix and sorted tuple of nexthop devices.
+        """
+        return dict([ (prefix, tuple(sorted(devs)))
+                      for prefix, devs in self.route_dump(None) ])
+
+    def route_devs(self, prefix):
+        devs, nhid = self.routes[prefix]
+        if nhid is None:
+            return list(devs)
+        nh = self.nexthops[nhid]
+        if "dev" in nh:
+            return [ nh["dev"] ]
+        return [ self.nexthops[m]["dev"] for m in nh["group"] ]
+
+    def route_batch(self, batch):
+        for entry in batch:
+            op, prefix, wg_devs, vrf, nhid = entry
+            self.ops.append(("route_" + op, prefix, tuple(wg_devs), nhid))
+            if "route_" + op in self.broken:
+                self.route_failed(entry, OSError("broken"))
+                continue
+            if op == "del":
+                if not prefix in self.routes:
+                    self.errors.append(("route_del", prefix))
+                    continue
+                del self.routes[prefix]
+                continue
+
+            if op == "add" and prefix in self.routes:
+                self.errors.append(("route_add", prefix))
+                continue
+            if nhid is not None and not nhid in self.nexthops:
+                self.errors.append(("route_" + op, prefix, nhid))
+                continue
+            if (nhid is None and
+                not all([ d in self.links for d in wg_devs ])):
+                self.errors.append(("route_" + op, prefix, tuple(wg_devs)))
+                continue
+            self.routes[prefix] = (tuple(wg_devs), nhid)
+
+    def route_dump(self, vrf):
+        self.flush()
+        return [ (prefix, self.route_devs(prefix)) for prefix in self.routes ]
+
+    def ipcmd_route_dump(self, vrf):
+        self.flush()
+        return [ (prefix, self.route_devs(prefix), self.routes[prefix][1])
+                 for prefix in self.routes ]
+
+    def link_exists(self, dev):
+        return dev in self.links
+
+    def link_add(self, dev, kind):
+        self.flush()
+        self.ops.append(("link_add", dev))
+        if dev in self.links:
+            self.errors.append(("link_add", dev))
+            return
+        self.links[dev] = None
+        self.peers[dev] = {}
+        self.owned_links.add(dev)
+
+    def link_del(self, dev):
+        self.flush()
+        self.ops.append(("link_del", dev))
+        if not dev in self.links:
+            self.errors.append(("link_del", dev))
+            return
+        del self.links[dev]
+        del self.peers[dev]
+        self.owned_links.discard(dev)
+
+        # routes and nexthops of the device are removed by kernel, and
+        # so are groups that become empty along with their routes.
+        for nhid in [ nhid for nhid, nh in self.nexthops.items()
+                      if nh.get("dev") == dev ]:
+            del self.nexthops[nhid]
+            for nh in self.nexthops.values():
+                if nhid in nh.get("group", []):
+                    nh["group"].remove(nhid)
+        for nhid in [ nhid for nhid, nh in self.nexthops.items()
+                      if "group" in nh and not nh["group"] ]:
+            del self.nexthops[nhid]
+        for prefix, (devs, nhid) in list(self.routes.items()):
+            if nhid is not None and not nhid in self.nexthops:
+                del self.routes[prefix]
+            elif nhid is None and dev in devs:
+                del self.routes[prefix]
+
+    def link_up(self, dev):
+        self.flush()
+        self.ops.append(("link_up", dev))
+
+    def link_set_master(self, dev, master):
+        self.flush()
+        self.ops.append(("link_set_master", dev, master))
+        self.links[dev] = master
+
+    def link_masters(self):
+        self.flush()
+        return dict(self.links)
+
+    def wg_set(self, dev, args):
+        self.flush()
+        args = list(map(str, args))
+        self.ops.append(("wg_set", dev, tuple(args)))
+        if "wg_set" in self.broken:
+            raise OSError("broken")
+        peers = self.peers[dev]
+
+        peer = None
+        i = 0
+        while i < len(args):
+            if args[i] == "private-key":
+                i += 2
+            elif args[i] == "peer":
+                pubkey = args[i + 1]
+                peer = peers.setdefault(pubkey, self.new_peer())
+                i += 2
+            elif args[i] == "remove":
+                del peers[pubkey]
+                i += 1
+            elif args[i] == "endpoint":
+                peer["endpoint"] = args[i + 1]
+                i += 2
+            elif args[i] == "allowed-ips":
+                peer["allowed_ips"] = [ p for p in args[i + 1].split(",")
+                                        if p ]
+                i += 2
+            elif args[i] == "persistent-keepalive":
+                peer["keepalive"] = int(args[i + 1])
+                i += 2
+            else:
+                raise ValueError("unknown wg set argument {}".format(args[i]))
+
+    def wg_addconf(self, dev, conf):
+        self.flush()
+        if "wg_addconf" in self.broken:
+            raise OSError("broken")
+        pubkeys = []
+        peer = None
+        for line in conf.splitlines():
+            if not " = " in line:
+                continue
+            k, v = line.split(" = ", 1)
+            if k == "PublicKey":
+                pubkeys.append(v)
+                peer = self.peers[dev].setdefault(v, self.new_peer())
+            elif k == "Endpoint":
+                peer["endpoint"] = v
+            elif k == "AllowedIPs":
+                peer["allowed_ips"] = v.split(", ")
+            elif k == "PersistentKeepalive":
+                peer["keepalive"] = int(v)
+        self.ops.append(("wg_addconf", dev, tuple(pubkeys)))
+
+    def new_peer(self):
+        return { "endpoint": None, "allowed_ips": [], "keepalive": 0,
+                 "latest_handshake": 0, "rx_bytes": 0, "tx_bytes": 0 }
+
+    def wg_dump(self):
+        self.flush()
+        return dict([ (dev, [ dict(p, pubkey = pubkey)
+                              for pubkey, p in peers.items() ])
+                      for dev, peers in self.peers.items() ])
+
+    def nexthop_supported(self):
+        return True
+
+    def nexthop_add(self, nhid, dev):
+        self.flush()
+        self.ops.append(("nexthop_add", nhid, dev))
+        self.nexthops[nhid] = { "dev": dev }
+
+    def nexthop_group(self, nhid, members):
+        self.flush()
+        self.ops.append(("nexthop_group", nhid, tuple(members)))
+        self.nexthops[nhid] = { "group": list(members) }
+
+    def nexthop_del(self, nhid):
+        self.flush()
+        self.ops.append(("nexthop_del", nhid))
+        if not nhid in self.nexthops:
+            self.errors.append(("nexthop_del", nhid))
+            return
+        del self.nexthops[nhid]
+
+    def nexthop_dump(self):
+        self.flush()
+        nexthops = []
+        for nhid, nh in self.nexthops.items():
+            nh = dict(nh, id = nhid)
+            if "group" in nh:
+                nh["group"] = list(nh["group"])
+            nexthops.append(nh)
+        return nexthops
+
+
+def make_node(pubkey, endpoint = None, allowed_ips = "", groups = "any",
+              keepalive = 0):
+    """
+    returns Node built as it is from etcd.
+    """
+    node = Node()
+    node.update("pubkey", pubkey)
+    if endpoint:
+        node.update("endpoint", endpoint)
+    node.update("allowed_ips", allowed_ips)
+    node.update("groups", groups)
+    node.update("keepalive", str(keepalive))
+    return node
+
+
+def net(prefix):
+    return ipaddress.ip_network(prefix)
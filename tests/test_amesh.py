@@ -0,0 +1,150 @@
+import types
+
+import pytest
+
+from amesh.amesh import Amesh
+from amesh.node import Node, NodeTable
+
+from fake_dataplane import make_node
+
+
+class FakeTransactions(object):
+
+    def put(self, key, value, lease = None):
+        return ("put", key, value)
+
+    def delete(self, key):
+        return ("delete", key)
+
+
+class FakeEtcd(object):
+    """
+    etcd client that applies transactions to a dict.
+    """
+
+    def __init__(self):
+        self.kv = {}
+        self.transactions = FakeTransactions()
+        self.txns = []
+
+    def transaction(self, compare, success, failure):
+        self.txns.append(success)
+        for op in success:
+            if op[0] == "put":
+                self.kv[op[1]] = op[2]
+            else:
+                self.kv.pop(op[1], None)
+        return True, []
+
+
+def make_amesh(logger, etcd, node, record_format):
+    """
+    returns Amesh with the attributes that etcd_register() uses,
+    without connecting to etcd or the dataplane.
+    """
+    a = object.__new__(Amesh)
+    a.logger = logger
+    a.etcd_client = lambda: etcd
+    a.etcd_prefix = "/amesh"
+    a.etcd_group_sharding = False
+    a.etcd_record_format = record_format
+    a.etcd_lease = types.SimpleNamespace(id = 1)
+    a.etcd_published = {}
+    a.etcd_registered = False
+    a.node_id = "me"
+    a.node = node
+    a.node_table = NodeTable()
+    a.node_shards = {}
+    return a
+
+
+@pytest.fixture
+def node():
+    return make_node("ME=", "192.0.2.1:51820", "10.0.0.0/24")
+
+
+def test_register_keys(logger, node):
+
+    etcd = FakeEtcd()
+    a = make_amesh(logger, etcd, node, "keys")
+    a.etcd_register()
+
+    # the record left by a previous process is deleted first
+    assert etcd.txns[0][0] == ("delete", "/amesh/me")
+    assert sorted(etcd.kv) == [ "/amesh/me/allowed_ips", "/amesh/me/endpoint",
+                                "/amesh/me/groups", "/amesh/me/keepalive",
+                                "/amesh/me/pubkey" ]
+
+
+def test_register_changed(logger, node):
+
+    etcd = FakeEtcd()
+    a = make_amesh(logger, etcd, node, "keys")
+    a.etcd_register()
+
+    # nothing is written when self node is unchanged, and only the
+    # changed keys are put in a single transaction otherwise.
+    a.etcd_register()
+    assert len(etcd.txns) == 1
+    node.update("endpoint", "192.0.2.2:51820")
+    a.etcd_register()
+    assert etcd.txns[1] == [ ("put", "/amesh/me/endpoint",
+                              "192.0.2.2:51820") ]
+
+    # keys self node no longer has are deleted in the transaction
+    a.etcd_group_sharding = True
+    node.update("groups", "g1")
+    a.etcd_register()
+    assert [ op[:2] for op in etcd.txns[2] ] == (
+        [ ("delete", "/amesh/me/" + k)
+          for k in ("allowed_ips", "endpoint", "groups", "keepalive",
+                    "pubkey") ] +
+        [ ("put", "/amesh/groups/g1/me/" + k)
+          for k in ("allowed_ips", "endpoint", "groups", "keepalive",
+                    "pubkey") ])
+
+
+def test_register_record(logger, node):
+
+    etcd = FakeEtcd()
+    keys = make_amesh(logger, etcd, node, "keys")
+    keys.etcd_register()
+
+    # a process restarted in the record format deletes attribute keys
+    a = make_amesh(logger, etcd, node, "record")
+    a.etcd_register()
+    assert [ op[0] for op in etcd.txns[1] ] == [ "delete" ] * 5 + [ "put" ]
+    assert list(etcd.kv) == [ "/amesh/me" ]
+
+    n = Node()
+    n.update_record(etcd.kv["/amesh/me"])
+    assert (n.pubkey, n.endpoint) == ("ME=", "192.0.2.1:51820")
+
+    # and back to the attribute keys
+    keys = make_amesh(logger, etcd, node, "keys")
+    keys.etcd_register()
+    assert not "/amesh/me" in etcd.kv
+    assert len(etcd.kv) == 5
+
+
+def test_update_node_record(logger, node):
+
+    a = make_amesh(logger, FakeEtcd(), Node(), "keys")
+    record = node.serialize_for_etcd_record("/amesh", "n1")["/amesh/n1"]
+
+    assert a.apply_etcd_kv("n1", None, record, "put")
+    assert a.node_table["n1"].endpoint == "192.0.2.1:51820"
+    assert a.node_table.group_index == { "any": { "n1" } }
+
+    # attribute keys left by the previous process are ignored
+    assert not a.apply_etcd_kv("n1", "endpoint", "192.0.2.9:51820", "put")
+    assert not a.apply_etcd_kv("n1", "endpoint", None, "delete")
+    assert a.node_table["n1"].endpoint == "192.0.2.1:51820"
+
+    # deletion of the record removes the node
+    assert a.apply_etcd_kv("n1", None, None, "delete")
+    assert not "n1" in a.node_table
+
+    # self node is not added to the node table
+    assert not a.apply_etcd_kv("me", None, record, "put")
+    assert a.node_table == {}
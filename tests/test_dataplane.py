@@ -0,0 +1,177 @@
+import errno
+import struct
+
+import pytest
+
+pytest.importorskip("pyroute2")
+from pyroute2 import NetlinkError
+from pyroute2.netlink.rtnl.rtmsg import rtmsg
+
+from amesh.dataplane import Dataplane, NetlinkDataplane
+from amesh.dataplane import (RTM_NEWROUTE, RTM_DELROUTE, NLMSG_ERROR,
+                             NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE,
+                             NLM_F_EXCL, NLM_F_REPLACE, RTA_NH_ID)
+
+
+@pytest.fixture
+def dp(logger):
+    """
+    NetlinkDataplane that encodes messages without netlink sockets.
+    """
+    dp = object.__new__(NetlinkDataplane)
+    Dataplane.__init__(dp, logger = logger)
+    dp.ifindex_cache = { "wg-a": 10, "wg-b": 11 }
+    dp.vrf_table_cache = { "vrf1": 1000 }
+    return dp
+
+
+class FakeIPRoute(object):
+    """
+    IPRoute of links whose ifindexes are in @indexes.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.links = []
+
+    def link_lookup(self, ifname):
+        return [ self.indexes[ifname] ] if ifname in self.indexes else []
+
+    def link(self, command, index, **kwargs):
+        for idx in [ index ] + list(kwargs.values()):
+            if isinstance(idx, int) and not idx in self.indexes.values():
+                raise NetlinkError(errno.ENODEV, "No such device")
+        self.links.append((command, index, kwargs))
+
+
+class FakeSocket(object):
+    """
+    netlink socket that acks route messages, and rejects routes to
+    ifindexes not in @ipr with ENODEV.
+    """
+
+    def __init__(self, ipr):
+        self.ipr = ipr
+        self.sent = []
+        self.acks = []
+
+    def send(self, data):
+        offset = 0
+        while offset < len(data):
+            length = struct.unpack_from("=I", data, offset)[0]
+            msg = decode(data[offset:offset + length])
+            oif = msg.get_attr("RTA_OIF")
+            self.sent.append((msg.get_attr("RTA_DST"), oif))
+            error = 0
+            if not oif in self.ipr.indexes.values():
+                error = -errno.ENODEV
+            self.acks.append(ack(msg["header"]["sequence_number"], error))
+            offset += length
+
+    def recv(self, size):
+        acks = b"".join(self.acks)
+        self.acks = []
+        return acks
+
+
+def decode(data):
+    msg = rtmsg(data)
+    msg.decode()
+    return msg
+
+
+def ack(seq, error):
+    return struct.pack("=IHHIIi", 36, NLMSG_ERROR, 0, seq, 0, error) + \
+        b"\0" * 16
+
+
+def test_abstract():
+
+    with pytest.raises(TypeError):
+        Dataplane()
+
+
+def test_route_add(dp):
+
+    msg = decode(dp.route_msg(7, "add", "10.0.0.0/24", ("wg-a",), None,
+                              None))
+    assert msg["header"]["type"] == RTM_NEWROUTE
+    assert msg["header"]["sequence_number"] == 7
+    assert msg["header"]["flags"] == (NLM_F_REQUEST | NLM_F_ACK |
+                                      NLM_F_CREATE | NLM_F_EXCL)
+    assert msg["dst_len"] == 24
+    assert msg.get_attr("RTA_DST") == "10.0.0.0"
+    assert msg.get_attr("RTA_TABLE") == 254
+    assert msg.get_attr("RTA_OIF") == 10
+
+
+def test_route_replace_multipath(dp):
+
+    msg = decode(dp.route_msg(1, "replace", "fd00::/64", ("wg-a", "wg-b"),
+                              "vrf1", None))
+    assert msg["header"]["flags"] == (NLM_F_REQUEST | NLM_F_ACK |
+                                      NLM_F_CREATE | NLM_F_REPLACE)
+    assert msg.get_attr("RTA_TABLE") == 1000
+    nexthops = msg.get_attr("RTA_MULTIPATH")
+    assert [ nh["oif"] for nh in nexthops ] == [ 10, 11 ]
+    assert [ nh.get_attr("RTA_GATEWAY") for nh in nexthops ] == [
+        "fe80::1", "fe80::1" ]
+
+
+def test_route_nexthop_id_and_del(dp):
+
+    data = dp.route_msg(1, "replace", "10.0.0.0/24", ("wg-a",), None, 100)
+    msg = decode(data)
+    assert msg.get_attr("RTA_OIF") is None
+
+    # RTA_NH_ID is the last attribute, which pyroute2 may not decode
+    assert data[-8:] == struct.pack("=HHI", 8, RTA_NH_ID, 100)
+
+    msg = decode(dp.route_msg(2, "del", "10.0.0.0/24", ("wg-a",), None,
+                              None))
+    assert msg["header"]["type"] == RTM_DELROUTE
+    assert msg["scope"] == 255
+    assert msg.get_attr("RTA_OIF") is None
+
+
+def test_route_ack(dp):
+
+    a = ("add", "10.0.0.0/24", ("wg-a",), None, None)
+    b = ("add", "10.0.1.0/24", ("wg-a",), None, None)
+    pending = { 1: a, 2: b, 3: a }
+    dp.route_ack(ack(1, 0) + ack(2, -17), pending)
+    assert pending == { 3: a }
+
+    failures = dp.metrics.counter("amesh_dataplane_route_failures_total",
+                                  "route operations failed",
+                                  { "op": "add" })
+    assert failures.value == 1
+
+
+def test_route_stale_ifindex(dp):
+
+    # wg-a is re-created with another ifindex, and wg-b is deleted
+    dp.ipr = FakeIPRoute({ "wg-a": 20 })
+    dp.sock = FakeSocket(dp.ipr)
+    dp.seq = 0
+    dp.route_batch([ ("add", "10.0.0.0/24", ("wg-a",), None, None),
+                     ("add", "10.0.1.0/24", ("wg-b",), None, None) ])
+
+    assert dp.sock.sent == [ ("10.0.0.0", 10), ("10.0.1.0", 11),
+                             ("10.0.0.0", 20) ]
+    assert dp.ifindex_cache == { "wg-a": 20 }
+    assert dp.failures() == set([
+        ("routes_missing", ("route", "10.0.1.0/24")) ])
+
+
+def test_link_stale_ifindex(dp):
+
+    dp.ipr = FakeIPRoute({ "wg-a": 20, "vrf1": 30 })
+    dp.ifindex_cache["vrf1"] = 12
+    dp.link_up("wg-a")
+    dp.link_set_master("wg-a", "vrf1")
+    assert dp.ipr.links == [ ("set", 20, { "state": "up" }),
+                             ("set", 20, { "master": 30 }) ]
+
+    with pytest.raises(RuntimeError):
+        dp.link_up("wg-b")
@@ -0,0 +1,132 @@
+import pytest
+
+pytest.importorskip("pyroute2")
+from pyroute2.netlink.rtnl import (RTM_NEWADDR, RTM_DELADDR, RTM_NEWLINK,
+                                   RTM_DELLINK)
+from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+
+import amesh.devtracker
+from amesh.devtracker import DevTracker
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.data = []
+
+    def recv(self, size):
+        return self.data.pop(0)
+
+
+class Links(object):
+    """
+    if_indextoname() of links that tests create and delete.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.lookups = 0
+
+    def __call__(self, ifindex):
+        self.lookups += 1
+        if not ifindex in self.names:
+            raise OSError("no such device")
+        return self.names[ifindex]
+
+
+def addr_msg(ifindex, address, prefixlen = 24, msgtype = RTM_NEWADDR):
+    msg = ifaddrmsg()
+    msg["header"]["type"] = msgtype
+    msg["family"] = 2
+    msg["prefixlen"] = prefixlen
+    msg["index"] = ifindex
+    msg["attrs"] = [ ("IFA_ADDRESS", address), ("IFA_LOCAL", address) ]
+    msg.encode()
+    return bytes(msg.data)
+
+
+def del_msg(ifindex, address):
+    return addr_msg(ifindex, address, msgtype = RTM_DELADDR)
+
+
+def link_msg(msgtype, ifindex, dev):
+    msg = ifinfmsg()
+    msg["header"]["type"] = msgtype
+    msg["index"] = ifindex
+    msg["attrs"] = [ ("IFLA_IFNAME", dev) ]
+    msg.encode()
+    return bytes(msg.data)
+
+
+@pytest.fixture
+def links(monkeypatch):
+    links = Links()
+    monkeypatch.setattr(amesh.devtracker.socket, "if_indextoname", links)
+    return links
+
+
+@pytest.fixture
+def tracker(logger):
+    tracker = DevTracker([ "eth0" ], logger = logger)
+    tracker.sock = FakeSocket()
+    return tracker
+
+
+def receive(tracker, *msgs):
+    tracker.sock.data.append(b"".join(msgs))
+    tracker.read()
+    popped = []
+    while tracker.queued():
+        msg = tracker.pop()
+        popped.append((msg["action"], msg["device"], str(msg["address"])))
+    return popped
+
+
+def test_recreated_device(tracker, links):
+
+    links.names[2] = "eth0"
+    assert receive(tracker, addr_msg(2, "10.0.0.1")) == [
+        ("RTM_NEWADDR", "eth0", "10.0.0.0/24") ]
+
+    # the device is deleted and created again with another ifindex.
+    # addresses are deleted before the link, and resolved by the cache
+    # after the device is gone.
+    del links.names[2]
+    links.names[5] = "eth0"
+    assert receive(tracker, link_msg(RTM_NEWLINK, 2, "eth0"),
+                   del_msg(2, "10.0.0.1"), link_msg(RTM_DELLINK, 2, "eth0"),
+                   link_msg(RTM_NEWLINK, 5, "eth0"),
+                   addr_msg(5, "10.0.1.1")) == [
+        ("RTM_DELADDR", "eth0", "10.0.0.0/24"),
+        ("RTM_NEWADDR", "eth0", "10.0.1.0/24") ]
+    assert tracker.ifindexes == { 5: "eth0" }
+
+    # re-created without the link notification, e.g., lost on overrun
+    links.names[6] = "eth0"
+    assert receive(tracker, addr_msg(6, "10.0.2.1")) == [
+        ("RTM_NEWADDR", "eth0", "10.0.2.0/24") ]
+    assert tracker.ifindexes == { 6: "eth0" }
+
+
+def test_untracked_device(tracker, links):
+
+    links.names[2] = "eth0"
+    links.names[3] = "eth1"
+    assert receive(tracker, addr_msg(2, "10.0.0.1"),
+                   addr_msg(3, "10.0.1.1"), addr_msg(3, "10.0.2.1")) == [
+        ("RTM_NEWADDR", "eth0", "10.0.0.0/24") ]
+
+    # untracked devices are looked up once
+    assert links.lookups == 2
+    receive(tracker, addr_msg(3, "10.0.3.1"))
+    assert links.lookups == 2
+
+    # an untracked device renamed to a tracked one
+    links.names[3] = "eth0"
+    del links.names[2]
+    assert receive(tracker, link_msg(RTM_DELLINK, 2, "eth0"),
+                   link_msg(RTM_NEWLINK, 3, "eth0"),
+                   addr_msg(3, "10.0.4.1")) == [
+        ("RTM_NEWADDR", "eth0", "10.0.4.0/24") ]
+    assert tracker.ifindexes == { 3: "eth0" }
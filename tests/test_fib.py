@@ -0,0 +1,453 @@
+import random
+
+import pytest
+
+from amesh.fib import Fib, Peer, Route
+from amesh.nexthop import NexthopTable
+from amesh.node import NodeTable
+
+from fake_dataplane import FakeDataplane, make_node, net
+
+
+PRVKEY = "/etc/amesh/private.key"
+
+S1 = "S1" + "x" * 41 + "="
+S2 = "S2" + "x" * 41 + "="
+C1 = "C1" + "x" * 41 + "="
+DEV1 = "wg-S1xxxxxxxx"
+DEV2 = "wg-S2xxxxxxxx"
+
+
+def make_fib(node_table, dp, self_node, logger, **kwargs):
+    return Fib("wg0", self_node, node_table, PRVKEY, None,
+               dataplane = dp, logger = logger, **kwargs)
+
+
+def build(node_table, dp, self_node, logger, **kwargs):
+    """
+    returns Fib installed to @dp from scratch.
+    """
+    fib = make_fib(node_table, dp, self_node, logger, **kwargs)
+    fib.update_diff(make_fib({}, dp, self_node, logger, **kwargs))
+    dp.clear()
+    return fib
+
+
+def assert_installed(fib, dp):
+    """
+    the dataplane has exactly the peers and routes of @fib.
+    """
+    assert dp.errors == []
+    assert dp.route_table() == dict([ (route.prefix, route.wg_devs)
+                                      for route in fib.routes ])
+    installed = set()
+    for wg_dev, peers in dp.wg_dump().items():
+        for p in peers:
+            installed.add((wg_dev, p["pubkey"],
+                           tuple(sorted(p["allowed_ips"]))))
+    assert installed == set([ (peer.wg_dev, peer.pubkey,
+                               tuple(sorted(map(str, peer.allowed_ips))))
+                              for peer in fib.peers ])
+
+
+@pytest.fixture
+def client():
+    return make_node("ME" + "x" * 41 + "=", allowed_ips = "10.255.0.0/24")
+
+
+@pytest.fixture
+def server():
+    return make_node("ME" + "x" * 41 + "=", endpoint = "192.0.2.254:51820",
+                     allowed_ips = "10.255.0.0/24")
+
+
+@pytest.fixture
+def dp(logger):
+    dp = FakeDataplane(logger = logger)
+    dp.add_link("wg0")
+    return dp
+
+
+def test_server_joins(dp, client, logger):
+
+    nt = NodeTable()
+    fib = build(nt, dp, client, logger)
+
+    nt["s1"] = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24")
+    fib.update_nodes(nt, [ "s1" ])
+
+    assert dp.ops == [
+        ("link_add", DEV1),
+        ("link_up", DEV1),
+        ("wg_set", DEV1, ("private-key", PRVKEY)),
+        ("wg_addconf", DEV1, (S1,)),
+        ("route_add", "10.1.0.0/24", (DEV1,), None),
+    ]
+    assert dp.peers[DEV1][S1]["endpoint"] == "192.0.2.1:51820"
+    assert_installed(fib, dp)
+
+
+def test_server_leaves(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"))
+    fib = build(nt, dp, client, logger)
+
+    del nt["s1"]
+    fib.update_nodes(nt, [ "s1" ])
+
+    # the route is removed by kernel along with the wg device
+    assert dp.ops == [ ("link_del", DEV1) ]
+    assert dp.routes == {}
+    assert_installed(fib, dp)
+
+
+def test_client_joins_and_leaves(dp, server, logger):
+
+    nt = NodeTable()
+    fib = build(nt, dp, server, logger)
+
+    nt["c1"] = make_node(C1, None, "10.2.0.0/24")
+    fib.update_nodes(nt, [ "c1" ])
+    assert dp.ops == [
+        ("wg_addconf", "wg0", (C1,)),
+        ("route_add", "10.2.0.0/24", ("wg0",), None),
+    ]
+    assert_installed(fib, dp)
+
+    dp.clear()
+    del nt["c1"]
+    fib.update_nodes(nt, [ "c1" ])
+    assert dp.ops == [
+        ("route_del", "10.2.0.0/24", ("wg0",), None),
+        ("wg_set", "wg0", ("peer", C1, "remove")),
+    ]
+    assert_installed(fib, dp)
+
+
+def test_endpoint_changes(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"))
+    fib = build(nt, dp, client, logger)
+
+    nt["s1"].update("endpoint", "192.0.2.11:51820")
+    fib.update_nodes(nt, [ "s1" ])
+
+    # the peer is updated in place. the wg device and route are kept.
+    assert dp.ops == [
+        ("wg_set", DEV1, ("peer", S1, "endpoint", "192.0.2.11:51820")),
+    ]
+    assert dp.peers[DEV1][S1]["endpoint"] == "192.0.2.11:51820"
+    assert_installed(fib, dp)
+
+
+def test_allowed_ips_change(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"))
+    fib = build(nt, dp, client, logger)
+
+    nt["s1"].update("allowed_ips", "10.1.0.0/24,10.3.0.0/24")
+    fib.update_nodes(nt, [ "s1" ])
+
+    assert dp.ops == [
+        ("wg_set", DEV1, ("peer", S1, "allowed-ips",
+                          "10.1.0.0/24,10.3.0.0/24")),
+        ("route_add", "10.3.0.0/24", (DEV1,), None),
+    ]
+    assert_installed(fib, dp)
+
+
+def test_unchanged_node(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"))
+    fib = build(nt, dp, client, logger)
+
+    fib.update_nodes(nt, [ "s1" ])
+    assert dp.ops == []
+
+
+def test_server_becomes_client(dp, server, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"))
+    fib = build(nt, dp, server, logger)
+    assert dp.route_table() == { "10.1.0.0/24": (DEV1,) }
+
+    nt["s1"].update("endpoint", None)
+    fib.update_nodes(nt, [ "s1" ])
+
+    # the outbound device is removed with its route, and the route
+    # is installed again via the device for incoming connections.
+    # the incoming peer has nothing to update for the lost endpoint.
+    assert dp.ops == [
+        ("link_del", DEV1),
+        ("route_add", "10.1.0.0/24", ("wg0",), None),
+    ]
+    assert_installed(fib, dp)
+
+
+def test_client_becomes_server(dp, server, logger):
+
+    nt = NodeTable(s1 = make_node(S1, None, "10.1.0.0/24"))
+    fib = build(nt, dp, server, logger)
+    assert dp.route_table() == { "10.1.0.0/24": ("wg0",) }
+
+    nt["s1"].update("endpoint", "192.0.2.1:51820")
+    fib.update_nodes(nt, [ "s1" ])
+
+    assert dp.ops == [
+        ("route_del", "10.1.0.0/24", ("wg0",), None),
+        ("wg_set", "wg0", ("peer", S1, "endpoint", "192.0.2.1:51820")),
+        ("link_add", DEV1),
+        ("link_up", DEV1),
+        ("wg_set", DEV1, ("private-key", PRVKEY)),
+        ("wg_addconf", DEV1, (S1,)),
+        ("route_add", "10.1.0.0/24", (DEV1,), None),
+    ]
+    assert_installed(fib, dp)
+
+
+def test_peer_update_args():
+
+    def peer(endpoint, allowed_ips = "10.1.0.0/24", keepalive = 0,
+             outbound = True):
+        node = make_node(S1, endpoint, allowed_ips, keepalive = keepalive)
+        return Peer(DEV1 if outbound else "wg0", node, None,
+                    outbound = outbound)
+
+    old = peer("192.0.2.1:51820")
+    assert peer("192.0.2.1:51820").wg_update_args(old) == []
+    assert peer("192.0.2.1:51820", keepalive = 25).wg_update_args(old) == [
+        "peer", S1, "persistent-keepalive", "25" ]
+    assert peer("192.0.2.1:51820", "").wg_update_args(old) == [
+        "peer", S1, "allowed-ips", "" ]
+
+    # 'wg set' cannot unset an endpoint. the outbound peer is removed
+    # and added again, and the roaming endpoint of an inbound peer is
+    # left as it is.
+    assert peer(None, keepalive = 25).wg_update_args(old) == [
+        "peer", S1, "remove", "peer", S1, "allowed-ips", "10.1.0.0/24",
+        "persistent-keepalive", "25" ]
+    old = peer("192.0.2.1:51820", outbound = False)
+    assert peer(None, outbound = False).wg_update_args(old) == []
+
+
+def test_value_objects():
+
+    node = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24,fd00::/64")
+    peer = Peer(DEV1, node, None, outbound = True)
+    route = Route([ DEV1 ], "10.1.0.0/24", None)
+
+    # equal values built separately, e.g., by different Fibs
+    same = make_node(S1, "192.0.2.1:51820", "fd00::/64,10.1.0.0/24")
+    assert peer == Peer(DEV1, same, None, outbound = True)
+    assert hash(peer) == hash(Peer(DEV1, same, None, outbound = True))
+    assert peer != Peer(DEV1, same, None, outbound = False)
+    assert route == Route([ DEV1 ], net("10.1.0.0/24"), None)
+    assert route != Route([ DEV1, DEV2 ], "10.1.0.0/24", None)
+
+    # other types are not equal, and do not raise
+    assert peer != route and route != peer
+    assert route != ((DEV1,), "10.1.0.0/24")
+    assert route.__eq__(None) is NotImplemented
+    assert peer.__eq__(None) is NotImplemented
+
+
+def test_ecmp_failover(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.0.0.0/24"),
+                   s2 = make_node(S2, "192.0.2.2:51820", "10.0.0.0/24"))
+    fib = build(nt, dp, client, logger)
+    assert dp.route_table() == { "10.0.0.0/24": (DEV1, DEV2) }
+
+    assert fib.set_down_devs({ DEV1 }) == 1
+    assert dp.ops == [
+        ("route_del", "10.0.0.0/24", (DEV1, DEV2), None),
+        ("route_add", "10.0.0.0/24", (DEV2,), None),
+    ]
+    assert dp.route_table() == { "10.0.0.0/24": (DEV2,) }
+
+    # the last nexthop is kept even if it is down
+    dp.clear()
+    assert fib.set_down_devs({ DEV1, DEV2 }) == 1
+    assert dp.route_table() == { "10.0.0.0/24": (DEV1, DEV2) }
+
+    dp.clear()
+    fib.set_down_devs({ DEV2 })
+    fib.set_down_devs(set())
+    assert dp.route_table() == { "10.0.0.0/24": (DEV1, DEV2) }
+    assert_installed(fib, dp)
+
+    # a server leaving while the other is down
+    fib.set_down_devs({ DEV2 })
+    del nt["s1"]
+    fib.update_nodes(nt, [ "s1" ])
+    assert dp.route_table() == { "10.0.0.0/24": (DEV2,) }
+    assert_installed(fib, dp)
+
+
+def test_ecmp_failover_nexthop_groups(dp, client, logger):
+
+    prefixes = "10.0.0.0/24,10.0.1.0/24"
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", prefixes),
+                   s2 = make_node(S2, "192.0.2.2:51820", prefixes))
+    table = NexthopTable(dp, id_base = 100, logger = logger)
+    fib = build(nt, dp, client, logger, nexthop_table = table)
+    group = dp.routes["10.0.0.0/24"][1]
+    assert dp.routes["10.0.1.0/24"][1] == group
+
+    # the nexthop group moves to the live device instead of the
+    # routes, and the nexthop of the down device is no longer used.
+    nh1 = table.dev_ids[DEV1]
+    nh2 = table.dev_ids[DEV2]
+    fib.set_down_devs({ DEV1 })
+    assert dp.ops == [
+        ("nexthop_group", group, (nh2,)),
+        ("nexthop_del", nh1),
+    ]
+    assert dp.route_table() == { "10.0.0.0/24": (DEV2,),
+                                 "10.0.1.0/24": (DEV2,) }
+    assert_installed(fib, dp)
+
+    dp.clear()
+    fib.set_down_devs(set())
+    nh1 = table.dev_ids[DEV1]
+    assert dp.ops == [
+        ("nexthop_add", nh1, DEV1),
+        ("nexthop_group", group, (nh1, nh2)),
+    ]
+    assert dp.route_table() == { "10.0.0.0/24": (DEV1, DEV2),
+                                 "10.0.1.0/24": (DEV1, DEV2) }
+    assert_installed(fib, dp)
+
+
+def test_reconcile_repairs(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"),
+                   s2 = make_node(S2, "192.0.2.2:51820", "10.2.0.0/24"))
+    fib = build(nt, dp, client, logger)
+    assert all([ n == 0 for n in fib.reconcile().values() ])
+    assert dp.ops == []
+
+    # a route removed and a peer added by other tools
+    del dp.routes["10.1.0.0/24"]
+    dp.wg_set("wg0", [ "peer", C1, "allowed-ips", "10.3.0.0/24" ])
+    dp.clear()
+
+    drift = fib.reconcile()
+    assert drift["routes_missing"] == 1
+    assert drift["peers_extra"] == 1
+    assert dp.ops == [
+        ("wg_set", "wg0", ("peer", C1, "remove")),
+        ("route_replace", "10.1.0.0/24", (DEV1,), None),
+    ]
+    assert_installed(fib, dp)
+
+
+def test_reconcile_ignores_other_devices(dp, client, logger):
+
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24"))
+    fib = build(nt, dp, client, logger)
+
+    # a wg device of another amesh instance in the same VRF, which
+    # this process did not create
+    other = "wg-C1xxxxxxxx"
+    dp.add_link(other)
+    dp.wg_set(other, [ "peer", C1, "allowed-ips", "10.3.0.0/24" ])
+    dp.route_batch([ ("add", "10.3.0.0/24", [ other ], None, None) ])
+    dp.clear()
+
+    assert all([ n == 0 for n in fib.reconcile().values() ])
+    assert dp.ops == []
+
+    # a dedicated wg device created by this process without peers
+    dp.owned_links.add(other)
+    drift = fib.reconcile()
+    assert drift["links_extra"] == 1
+    assert dp.ops == [ ("link_del", other) ]
+    assert_installed(fib, dp)
+
+
+def test_failures_are_repaired(dp, client, logger):
+
+    nt = NodeTable()
+    fib = build(nt, dp, client, logger)
+
+    dp.broken = set([ "route_add", "wg_addconf" ])
+    nt["s1"] = make_node(S1, "192.0.2.1:51820", "10.1.0.0/24")
+    fib.update_nodes(nt, [ "s1" ])
+    failures = dp.failures()
+    assert failures == set([
+        ("peers_missing", ("peer", DEV1, S1)),
+        ("routes_missing", ("route", "10.1.0.0/24")),
+    ])
+    assert dp.failures() == set()
+
+    # the differences left by the failures are found by the keys
+    dp.broken = set()
+    found = set()
+    def due(kind, key):
+        found.add((kind, key))
+        return True
+    fib.reconcile(due)
+    assert found == failures
+    assert_installed(fib, dp)
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    { "aggregate": True },
+    { "shared_dev": "wg-shared" },
+    { "nexthop_table": True },
+    { "aggregate": True, "nexthop_table": True },
+])
+@pytest.mark.parametrize("self_endpoint", [ None, "192.0.2.254:51820" ])
+def test_update_nodes_matches_rebuild(logger, options, self_endpoint):
+    """
+    Fib updated incrementally by update_nodes() equals Fib built from
+    the node table, and the dataplane has the same peers and routes.
+    """
+
+    rand = random.Random(1)
+    prefixes = [ "10.0.{}.0/24".format(n) for n in range(8) ] + [
+        "10.0.0.0/23", "10.0.0.0/22", "10.0.4.0/22", "fd00::/64" ]
+
+    def random_node(n):
+        endpoint = None
+        if rand.random() < 0.5:
+            endpoint = "192.0.2.{}:51820".format(n)
+        return make_node("N{:02d}".format(n) + "x" * 40 + "=", endpoint,
+                         ",".join(rand.sample(prefixes, rand.randint(0, 3))),
+                         rand.choice([ "any", "g1", "g2", "g1,g2" ]),
+                         rand.choice([ 0, 25 ]))
+
+    dp = FakeDataplane(logger = logger)
+    dp.add_link("wg0")
+    me = make_node("ME" + "x" * 41 + "=", self_endpoint, "10.255.0.0/24",
+                   "g1")
+
+    def kwargs():
+        kw = dict(options)
+        if kw.get("nexthop_table"):
+            kw["nexthop_table"] = table
+        return kw
+
+    table = NexthopTable(dp, id_base = 100, logger = logger)
+    nt = NodeTable()
+    fib = build(nt, dp, me, logger, **kwargs())
+
+    for step in range(150):
+        node_ids = set()
+        for i in range(rand.randint(1, 3)):
+            node_id = "n{}".format(rand.randint(0, 9))
+            if rand.random() < 0.3:
+                if node_id in nt:
+                    del nt[node_id]
+            else:
+                nt[node_id] = random_node(int(node_id[1:]))
+            node_ids.add(node_id)
+
+        fib.update_nodes(nt, node_ids)
+
+        full = make_fib(nt, FakeDataplane(), me, logger, **kwargs())
+        assert fib.peers == full.peers
+        assert fib.routes == full.routes
+        assert_installed(fib, dp)
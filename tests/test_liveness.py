@@ -0,0 +1,134 @@
+import pytest
+
+import amesh.liveness
+from amesh.fib import Fib
+from amesh.liveness import LivenessMonitor
+from amesh.node import NodeTable
+
+from fake_dataplane import FakeDataplane, make_node
+
+
+S1 = "S1" + "x" * 41 + "="
+S2 = "S2" + "x" * 41 + "="
+DEV1 = "wg-S1xxxxxxxx"
+DEV2 = "wg-S2xxxxxxxx"
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(amesh.liveness.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def dp(logger):
+    dp = FakeDataplane(logger = logger)
+    dp.add_link("wg0")
+    return dp
+
+
+@pytest.fixture
+def fib(dp, logger):
+    """
+    Fib of a client with ECMP routes via two servers.
+    """
+    me = make_node("ME" + "x" * 41 + "=", allowed_ips = "10.255.0.0/24")
+    nt = NodeTable(s1 = make_node(S1, "192.0.2.1:51820", "10.0.0.0/24",
+                                  keepalive = 25),
+                   s2 = make_node(S2, "192.0.2.2:51820", "10.0.0.0/24"))
+    empty = Fib("wg0", me, {}, "/etc/amesh/private.key", None,
+                dataplane = dp, logger = logger)
+    fib = Fib("wg0", me, nt, "/etc/amesh/private.key", None,
+              dataplane = dp, logger = logger)
+    fib.update_diff(empty)
+    dp.clear()
+    return fib
+
+
+def traffic(dp, wg_dev, pubkey, tx = 0, rx = 0, handshake = 0):
+    p = dp.peers[wg_dev][pubkey]
+    p["tx_bytes"] += tx
+    p["rx_bytes"] += rx
+    p["latest_handshake"] += handshake
+
+
+def test_down_and_restore(dp, fib, clock, logger):
+
+    lm = LivenessMonitor(5, probe_keepalive = 1, min_tx_bytes = 1000,
+                         logger = logger)
+    assert lm.check(fib) == set()
+
+    # sending without response, but not for the timeout yet
+    for n in range(4):
+        clock.now += 1
+        traffic(dp, DEV1, S1, tx = 500)
+        traffic(dp, DEV2, S2, tx = 500, rx = 100)
+        assert lm.check(fib) == set()
+    assert dp.ops == []
+
+    clock.now += 1
+    traffic(dp, DEV1, S1, tx = 500)
+    assert lm.check(fib) == { DEV1 }
+    assert dp.ops == [
+        ("wg_set", DEV1, ("peer", S1, "persistent-keepalive", "1")),
+        ("route_del", "10.0.0.0/24", (DEV1, DEV2), None),
+        ("route_add", "10.0.0.0/24", (DEV2,), None),
+    ]
+    assert dp.route_table() == { "10.0.0.0/24": (DEV2,) }
+    assert lm.m_withdrawals.value == 1
+
+    # still down, and nothing changes
+    dp.clear()
+    clock.now += 1
+    traffic(dp, DEV1, S1, tx = 500)
+    assert lm.check(fib) == { DEV1 }
+    assert dp.ops == []
+
+    # the probe keepalive is set again if the peer is updated
+    dp.peers[DEV1][S1]["keepalive"] = 25
+    assert lm.check(fib) == { DEV1 }
+    assert dp.ops == [
+        ("wg_set", DEV1, ("peer", S1, "persistent-keepalive", "1")),
+    ]
+
+    # a handshake restores the device and its keepalive
+    dp.clear()
+    clock.now += 1
+    traffic(dp, DEV1, S1, handshake = 1)
+    assert lm.check(fib) == set()
+    assert dp.ops == [
+        ("wg_set", DEV1, ("peer", S1, "persistent-keepalive", "25")),
+        ("route_del", "10.0.0.0/24", (DEV2,), None),
+        ("route_add", "10.0.0.0/24", (DEV1, DEV2), None),
+    ]
+    assert dp.peers[DEV1][S1]["keepalive"] == 25
+    assert dp.route_table() == { "10.0.0.0/24": (DEV1, DEV2) }
+    assert lm.m_restorations.value == 1
+
+
+def test_idle_peer(dp, fib, clock, logger):
+
+    lm = LivenessMonitor(5, probe_keepalive = 1, min_tx_bytes = 1000,
+                         logger = logger)
+
+    # no response for long, but little is sent
+    for n in range(20):
+        clock.now += 1
+        traffic(dp, DEV1, S1, tx = 32)
+        assert lm.check(fib) == set()
+
+    # counters reset by reinstalling the peer are not regarded as sent
+    dp.peers[DEV1][S1]["tx_bytes"] = 0
+    clock.now += 1
+    assert lm.check(fib) == set()
+    assert dp.ops == []
@@ -0,0 +1,203 @@
+import pytest
+
+from amesh.fib import Route
+from amesh.nexthop import NexthopTable
+
+from fake_dataplane import FakeDataplane
+
+
+A = ("wg-a",)
+B = ("wg-b",)
+AB = ("wg-a", "wg-b")
+
+
+@pytest.fixture
+def dp(logger):
+    dp = FakeDataplane(logger = logger)
+    for dev in ("wg-a", "wg-b", "wg-c"):
+        dp.add_link(dev)
+    return dp
+
+
+@pytest.fixture
+def table(dp, logger):
+    return NexthopTable(dp, id_base = 100, logger = logger)
+
+
+def routes(wg_devs, first, n):
+    return [ Route(wg_devs, "10.0.{}.0/24".format(i), None)
+             for i in range(first, first + n) ]
+
+
+def test_acquire_release(dp, table):
+
+    assert table.acquire(AB) == 100
+    assert dp.ops == [
+        ("nexthop_add", 101, "wg-a"),
+        ("nexthop_add", 102, "wg-b"),
+        ("nexthop_group", 100, (101, 102)),
+    ]
+
+    # routes via the same wg devices share the group
+    dp.clear()
+    assert table.acquire(AB) == 100
+    assert table.acquire(A) == 103
+    assert dp.ops == [ ("nexthop_group", 103, (101,)) ]
+    assert table.refs == { AB: 2, A: 1 }
+
+    # unused groups and nexthops are deleted by collect()
+    dp.clear()
+    table.release(AB)
+    table.release(A)
+    table.collect()
+    assert dp.ops == [ ("nexthop_del", 103) ]
+    assert table.groups == { AB: 100 }
+
+    dp.clear()
+    table.release(AB)
+    table.release(AB)
+    assert table.refs == { AB: 0 }
+    table.collect()
+    assert dp.ops == [
+        ("nexthop_del", 100),
+        ("nexthop_del", 101),
+        ("nexthop_del", 102),
+    ]
+    assert dp.nexthops == {}
+    assert table.groups == {} and table.dev_ids == {}
+
+    # ids are reused
+    assert table.acquire(B) in (100, 101, 102, 103)
+
+
+def test_plan_moves(table):
+
+    for n in range(10):
+        table.acquire(AB)
+    for n in range(2):
+        table.acquire(A)
+
+    # 8 of 10 routes move from AB to A, which has 2 routes
+    old = routes(AB, 0, 10)
+    new = routes(A, 0, 8) + routes(AB, 8, 2)
+    removed = set(old) - set(new)
+    added = set(new) - set(old)
+    assert table.plan_moves(removed, added, []) == { AB: A }
+
+    # half of the routes are not enough to move
+    new = routes(A, 0, 5) + routes(AB, 5, 5)
+    removed = set(old) - set(new)
+    added = set(new) - set(old)
+    assert table.plan_moves(removed, added, []) == {}
+
+    # the group is removed along with the wg device
+    new = routes(A, 0, 10)
+    removed = set(old) - set(new)
+    added = set(new) - set(old)
+    assert table.plan_moves(removed, added, [ r.prefix for r in old ]) == {}
+
+    # the target group has more routes than moving ones
+    for n in range(20):
+        table.acquire(A)
+    assert table.plan_moves(removed, added, []) == {}
+
+
+def test_split_and_move(dp, table):
+
+    for n in range(10):
+        table.acquire(AB)
+    for n in range(2):
+        table.acquire(A)
+    dp.clear()
+
+    # 2 routes stay on AB, and 8 routes move to A along with the group
+    split = table.split(AB, 2)
+    assert split == 104
+    assert table.move(AB, A) == 100
+    assert dp.ops == [
+        ("nexthop_group", 104, (101, 102)),
+        ("nexthop_group", 100, (101,)),
+    ]
+    assert table.groups == { AB: 104, A: 100 }
+    assert table.refs == { AB: 2, A: 10 }
+
+    # the previous group for A is deleted
+    dp.clear()
+    table.collect()
+    assert dp.ops == [ ("nexthop_del", 103) ]
+    assert dp.nexthops == { 100: { "group": [ 101 ] },
+                            101: { "dev": "wg-a" },
+                            102: { "dev": "wg-b" },
+                            104: { "group": [ 101, 102 ] } }
+
+
+def test_forget_devs(dp, table):
+
+    table.acquire(AB)
+    table.acquire(B)
+    table.forget_devs([ "wg-b" ])
+    assert table.groups == { AB: 100 }
+    assert table.dev_ids == { "wg-a": 101 }
+    assert sorted(table.free_ids) == [ 102, 103 ]
+
+
+def test_load(dp, table, logger):
+
+    table.acquire(AB)
+    table.acquire(A)
+
+    # another nexthop outside of the id range is left as it is
+    dp.nexthop_add(5, "wg-c")
+
+    loaded = NexthopTable(dp, id_base = 100, logger = logger)
+    loaded.load()
+    assert loaded.groups == { AB: 100, A: 103 }
+    assert loaded.dev_ids == { "wg-a": 101, "wg-b": 102 }
+    assert loaded.refs == { AB: 0, A: 0 }
+    assert loaded.next_id == 104
+
+    dp.clear()
+    loaded.collect()
+    assert sorted(dp.ops) == [ ("nexthop_del", n) for n in range(100, 104) ]
+    assert list(dp.nexthops) == [ 5 ]
+
+
+def test_reconcile(dp, table):
+
+    table.acquire(AB)
+    found = []
+
+    def due(kind, key):
+        found.append((kind, key))
+        return True
+
+    # nothing to repair
+    table.reconcile(due)
+    assert found == []
+
+    # a group changed on the kernel is restored
+    dp.nexthops[100] = { "group": [ 101 ] }
+    dp.clear()
+    table.reconcile(due)
+    assert found == [ ("nexthops", ("nexthop", 100)) ]
+    assert dp.ops == [ ("nexthop_group", 100, (101, 102)) ]
+
+    # a missing nexthop is recreated with a new id
+    found.clear()
+    del dp.nexthops[102]
+    dp.nexthops[100] = { "group": [ 101 ] }
+    dp.clear()
+    table.reconcile(due)
+    assert found == [ ("nexthops", ("nexthop", 102)),
+                      ("nexthops", ("nexthop", 100)) ]
+    assert dp.ops == [
+        ("nexthop_add", 102, "wg-b"),
+        ("nexthop_group", 100, (101, 102)),
+    ]
+
+    # repair is postponed when not due
+    found.clear()
+    dp.nexthops[100] = { "group": [ 101 ] }
+    dp.clear()
+    table.reconcile(lambda kind, key: False)
+    assert dp.ops == []
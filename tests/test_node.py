@@ -0,0 +1,76 @@
+import json
+
+from amesh.node import Node, NodeTable
+from amesh.static import ETCD_RECORD_VERSION
+
+from fake_dataplane import make_node, net
+
+
+def test_group_index():
+
+    nt = NodeTable(a = make_node("A=", groups = "g1,g2"),
+                   b = make_node("B=", groups = "g2"),
+                   c = make_node("C=", groups = "any"))
+    assert nt.group_index == { "g1": { "a" }, "g2": { "a", "b" },
+                               "any": { "c" } }
+
+    # nodes in the "any" group are selected by all groups
+    assert nt.select({ "g1" }) == { "a", "c" }
+    assert nt.select({ "g2" }) == { "a", "b", "c" }
+    assert nt.select({ "g3" }) == { "c" }
+    assert set(nt.select({ "any" })) == { "a", "b", "c" }
+
+    # groups of a node in the table are changed
+    nt["b"].update("groups", "g1")
+    nt.index("b")
+    assert nt.group_index == { "g1": { "a", "b" }, "g2": { "a" },
+                               "any": { "c" } }
+
+    nt["d"] = make_node("D=", groups = "g3")
+    assert nt.select({ "g3" }) == { "c", "d" }
+
+    del nt["a"]
+    del nt["d"]
+    assert nt.group_index == { "g1": { "b" }, "any": { "c" } }
+    assert nt.indexed_groups == { "b": { "g1" }, "c": { "any" } }
+
+
+def test_record_roundtrip():
+
+    node = make_node("A=", "192.0.2.1:51820", "10.0.1.0/24,10.0.0.0/24",
+                     groups = "g2,g1", keepalive = 25)
+    kvs = node.serialize_for_etcd_record("/amesh", "n1")
+    assert list(kvs) == [ "/amesh/n1" ]
+    record = json.loads(kvs["/amesh/n1"])
+    assert record == { "v": ETCD_RECORD_VERSION, "pubkey": "A=",
+                       "endpoint": "192.0.2.1:51820",
+                       "allowed_ips": [ "10.0.0.0/24", "10.0.1.0/24" ],
+                       "keepalive": 25, "groups": [ "g1", "g2" ] }
+
+    n = Node()
+    assert n.update_record(kvs["/amesh/n1"])
+    assert n.record_version == ETCD_RECORD_VERSION
+    assert (n.pubkey, n.endpoint, n.allowed_ips, n.keepalive, n.groups) == \
+        ("A=", "192.0.2.1:51820", { net("10.0.0.0/24"), net("10.0.1.0/24") },
+         25, { "g1", "g2" })
+
+    # the same record does not change the node
+    assert not n.update_record(kvs["/amesh/n1"])
+
+    # a node without endpoint
+    node = make_node("B=", None, "")
+    n = Node()
+    n.update_record(node.serialize_for_etcd_record("/amesh", "n2")
+                    ["/amesh/n2"])
+    assert n.endpoint is None and n.allowed_ips == set()
+
+
+def test_record_rejected():
+
+    n = make_node("A=", "192.0.2.1:51820", "10.0.0.0/24")
+
+    record = json.dumps({ "v": ETCD_RECORD_VERSION + 1, "pubkey": "B=" })
+    assert not n.update_record(record)
+    assert not n.update_record("{broken")
+    assert not n.update_record(json.dumps({ "pubkey": "B=" }))
+    assert n.pubkey == "A=" and n.record_version is None
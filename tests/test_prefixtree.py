@@ -0,0 +1,193 @@
+import random
+import ipaddress
+
+import pytest
+
+from amesh.prefixtree import PrefixTree
+
+
+def net(prefix):
+    return ipaddress.ip_network(prefix)
+
+
+def tree(*prefixes, value = "a"):
+    t = PrefixTree()
+    for prefix in prefixes:
+        t[net(prefix)] = value
+    return t
+
+
+def test_dict_operations():
+
+    t = tree("10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24", "fd00::/64")
+    assert len(t) == 4
+    assert net("10.1.0.0/16") in t
+    assert not net("10.2.0.0/16") in t
+    assert t.get(net("10.2.0.0/16")) is None
+
+    t[net("10.1.0.0/16")] = "b"
+    assert len(t) == 4
+    assert t[net("10.1.0.0/16")] == "b"
+
+    # IPv4 prefixes first, in the order of address and length
+    assert list(t) == [ net("10.0.0.0/8"), net("10.1.0.0/16"),
+                        net("10.1.2.0/24"), net("fd00::/64") ]
+
+    del t[net("10.1.0.0/16")]
+    assert len(t) == 3
+    assert not net("10.1.0.0/16") in t
+    assert net("10.1.2.0/24") in t
+    with pytest.raises(KeyError):
+        del t[net("10.1.0.0/16")]
+    with pytest.raises(KeyError):
+        t[net("10.1.0.0/16")]
+
+
+def test_glue_nodes():
+
+    # 10.0.0.0/24 and 10.0.2.0/24 are joined by a glue node at /22,
+    # which does not hold a value.
+    t = tree("10.0.0.0/24", "10.0.2.0/24")
+    assert not net("10.0.0.0/22") in t
+    assert len(t) == 2
+
+    t[net("10.0.0.0/22")] = "b"
+    assert t[net("10.0.0.0/22")] == "b"
+    assert len(t) == 3
+
+    del t[net("10.0.0.0/24")]
+    del t[net("10.0.2.0/24")]
+    assert list(t.items()) == [ (net("10.0.0.0/22"), "b") ]
+
+
+def test_lookup():
+
+    t = PrefixTree()
+    t[net("10.0.0.0/8")] = "a"
+    t[net("10.1.0.0/16")] = "b"
+    t[net("10.1.2.128/25")] = "c"
+
+    assert t.lookup("10.1.2.200") == (net("10.1.2.128/25"), "c")
+    assert t.lookup("10.1.2.1") == (net("10.1.0.0/16"), "b")
+    assert t.lookup("10.2.0.1") == (net("10.0.0.0/8"), "a")
+    assert t.lookup("192.0.2.1") == (None, None)
+    assert t.lookup("fd00::1") == (None, None)
+
+
+def test_overlaps():
+
+    t = tree("10.0.0.0/8", "10.1.0.0/16", "10.1.1.0/24", "10.1.2.0/24",
+             "10.2.0.0/16")
+
+    # covering prefixes longest first, and then covered prefixes
+    assert [ p for p, v in t.overlaps(net("10.1.0.0/16")) ] == [
+        net("10.0.0.0/8"), net("10.1.1.0/24"), net("10.1.2.0/24") ]
+    assert [ p for p, v in t.overlaps(net("10.1.0.0/20")) ] == [
+        net("10.1.0.0/16"), net("10.0.0.0/8"), net("10.1.1.0/24"),
+        net("10.1.2.0/24") ]
+    assert [ p for p, v in t.overlaps(net("10.3.0.0/16")) ] == [
+        net("10.0.0.0/8") ]
+    assert list(t.overlaps(net("192.0.2.0/24"))) == []
+
+
+def test_aggregate():
+
+    t = tree("10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24", "10.0.3.0/24")
+    assert t.aggregate() == { net("10.0.0.0/22"): "a" }
+
+    # halves with different values are not aggregated
+    t[net("10.0.3.0/24")] = "b"
+    assert t.aggregate() == { net("10.0.0.0/23"): "a",
+                              net("10.0.2.0/24"): "a",
+                              net("10.0.3.0/24"): "b" }
+
+    # a covering prefix with the same value is absorbed, and one with
+    # another value is kept
+    t = tree("10.0.0.0/23", "10.0.0.0/24", "10.0.1.0/24")
+    assert t.aggregate() == { net("10.0.0.0/23"): "a" }
+    t[net("10.0.0.0/23")] = "b"
+    assert t.aggregate() == { net("10.0.0.0/24"): "a",
+                              net("10.0.1.0/24"): "a",
+                              net("10.0.0.0/23"): "b" }
+
+    # key of values
+    t = PrefixTree()
+    t[net("fd00::/65")] = { "wg0": 1 }
+    t[net("fd00:0:0:0:8000::/65")] = { "wg0": 2 }
+    assert t.aggregate(key = lambda v: tuple(sorted(v))) == {
+        net("fd00::/64"): ("wg0",) }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_aggregate_update(seed):
+    """
+    aggregate_update() gives the same aggregation as aggregate() after
+    prefixes are added, removed, or their values are changed in place.
+    """
+
+    rand = random.Random(seed)
+
+    def random_prefix():
+        plen = rand.randint(20, 26)
+        addr = 0x0a000000 | rand.getrandbits(8) << 6
+        return ipaddress.ip_network((addr >> (32 - plen) << (32 - plen),
+                                     plen))
+
+    key = lambda value: value[0]
+    t = PrefixTree()
+    values = {}
+    for n in range(40):
+        prefix = random_prefix()
+        values[prefix] = [ rand.choice("ab") ]
+        t[prefix] = values[prefix]
+
+    aggregated = t.aggregate(key = key)
+    for step in range(100):
+        changed = set()
+        for n in range(rand.randint(1, 4)):
+            r = rand.random()
+            if r < 0.4 or not values:
+                prefix = random_prefix()
+                values[prefix] = [ rand.choice("ab") ]
+                t[prefix] = values[prefix]
+            elif r < 0.7:
+                prefix = rand.choice(list(values))
+                del values[prefix]
+                del t[prefix]
+            else:
+                prefix = rand.choice(list(values))
+                values[prefix][0] = rand.choice("ab")
+            changed.add(prefix)
+
+        for prefix, value in t.aggregate_update(changed, key = key).items():
+            if value is None:
+                del aggregated[prefix]
+            else:
+                aggregated[prefix] = value
+
+        full = PrefixTree()
+        for prefix, value in values.items():
+            full[prefix] = value
+        assert aggregated == full.aggregate(key = key)
+
+
+def test_aggregate_update_changes():
+
+    t = tree("10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24")
+    assert t.aggregate() == { net("10.0.0.0/23"): "a",
+                              net("10.0.2.0/24"): "a" }
+
+    # only changed aggregated prefixes are returned
+    t[net("10.0.3.0/24")] = "a"
+    assert t.aggregate_update([ net("10.0.3.0/24") ]) == {
+        net("10.0.0.0/23"): None, net("10.0.2.0/24"): None,
+        net("10.0.0.0/22"): "a" }
+
+    t[net("10.0.8.0/24")] = "b"
+    assert t.aggregate_update([ net("10.0.8.0/24") ]) == {
+        net("10.0.8.0/24"): "b" }
+
+    del t[net("10.0.1.0/24")]
+    assert t.aggregate_update([ net("10.0.1.0/24") ]) == {
+        net("10.0.0.0/22"): None, net("10.0.0.0/24"): "a",
+        net("10.0.2.0/23"): "a" }
@@ -0,0 +1,148 @@
+import pytest
+
+import amesh.reconciler
+from amesh.fib import DRIFT_KINDS
+from amesh.reconciler import Reconciler
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DriftingFib(object):
+    """
+    Fib whose dataplane has the differences in @keys, which are
+    repaired when the reconciler says they are due, and come back
+    while @failing is True.
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.failing = True
+        self.repaired = []
+
+    def reconcile(self, due):
+        drift = dict.fromkeys(DRIFT_KINDS, 0)
+        for key in sorted(self.keys):
+            drift["routes_missing"] += 1
+            if due("routes_missing", key):
+                self.repaired.append(key)
+        if not self.failing:
+            self.keys = set()
+        return drift
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(amesh.reconciler.time, "monotonic", clock)
+    return clock
+
+
+def test_backoff(clock, logger):
+
+    r = Reconciler(backoff = 1, backoff_max = 8, logger = logger)
+    key = ("route", "10.0.0.0/24")
+    fib = DriftingFib([ key ])
+
+    # repaired on the first pass, and then after 1, 2, 4, 8, 8 sec
+    repaired_at = []
+    for n in range(40):
+        fib.repaired = []
+        drift = r.reconcile(fib)
+        assert drift["routes_missing"] == 1
+        if fib.repaired:
+            repaired_at.append(n)
+        clock.now += 1
+    assert repaired_at == [ 0, 1, 3, 7, 15, 23, 31, 39 ]
+    assert r.retries[key][0] == 8
+
+
+def test_retry_queue(clock, logger):
+
+    r = Reconciler(backoff = 1, backoff_max = 8, logger = logger)
+    a = ("route", "10.0.0.0/24")
+    b = ("peer", "wg0", "x")
+    fib = DriftingFib([ a, b ])
+
+    r.reconcile(fib)
+    assert set(r.retries) == set([ a, b ])
+    assert r.m_repairs["routes_missing"].value == 2
+
+    # a difference no longer found leaves the retry queue, and is
+    # repaired immediately when it is found again.
+    fib.keys = set([ b ])
+    clock.now += 0.5
+    fib.repaired = []
+    r.reconcile(fib)
+    assert set(r.retries) == set([ b ])
+    assert fib.repaired == []
+
+    fib.keys = set([ a, b ])
+    clock.now += 0.1
+    r.reconcile(fib)
+    assert fib.repaired == [ a ]
+
+    # repaired differences leave the queue on the next pass
+    fib.failing = False
+    clock.now += 10
+    r.reconcile(fib)
+    assert r.reconcile(fib) == dict.fromkeys(DRIFT_KINDS, 0)
+    assert r.retries == {}
+
+
+def test_enqueue(clock, logger):
+
+    r = Reconciler(backoff = 1, backoff_max = 8, logger = logger)
+    key = ("route", "10.0.0.0/24")
+    assert not r.pending(0)
+    assert r.pending(30)
+
+    # a failed operation is retried after the backoff without
+    # periodic passes
+    r.enqueue(set([ ("routes_missing", key) ]))
+    assert r.m_enqueued["routes_missing"].value == 1
+    assert not r.pending(0)
+    clock.now += 1
+    assert r.pending(0)
+
+    fib = DriftingFib([ key ])
+    r.reconcile(fib)
+    assert fib.repaired == [ key ]
+    assert r.retries[key] == (2, clock.now + 2)
+
+    # queued again while in the queue, the backoff is kept
+    r.enqueue(set([ ("routes_missing", key) ]))
+    assert r.retries[key] == (2, clock.now + 2)
+    clock.now += 1
+    assert not r.pending(0)
+
+    # the periodic pass is due regardless of the queue
+    assert r.pending(1)
+    clock.now += 1
+    assert r.pending(0)
+
+    fib.failing = False
+    r.reconcile(fib)
+    r.reconcile(fib)
+    assert r.retries == {}
+    clock.now += 10
+    assert not r.pending(0)
+
+
+def test_failure(clock, logger):
+
+    class BrokenFib(object):
+        def reconcile(self, due):
+            raise OSError("dump failed")
+
+    r = Reconciler(logger = logger)
+    with pytest.raises(OSError):
+        r.reconcile(BrokenFib())
+    assert r.m_runs.value == 1
+    assert r.m_failures.value == 1